@@ -0,0 +1,13 @@
+# Production server settings, used with `gunicorn -c backend/gunicorn.conf.py` from
+# the root of the repository
+
+wsgi_app = "server.main:create_app()"
+bind = "0.0.0.0:8000"
+workers = 8
+
+# Content event streams stay open for minutes at a time, so each worker serves
+# requests on threads rather than one at a time. Each worker holds at most
+# api.EVENTS_MAX_STREAMS streams open, which leaves the rest of its threads for
+# everything else.
+worker_class = "gthread"
+threads = 32
@@ -1,46 +1,149 @@
 from http import HTTPStatus
+import hashlib
+import hmac
 import json
-import pandas as pd
+import os
+import threading
+import time
 import flask
 import zipfile
-import PIL.Image
+from collections import defaultdict
+from datetime import datetime, timezone
 import io
+from concurrent.futures.process import BrokenProcessPool
+from typing import Iterator, Optional
+from urllib.parse import urlparse
+import PIL.Image
 from flask import Blueprint, Response, redirect, url_for, current_app, render_template
+from werkzeug.datastructures import MultiDict
+from werkzeug.http import quote_etag
 from flask_login import (
     login_user,
     logout_user,
     current_user,
 )
-from server import free_form_content
+from server import free_form_content, metrics
+from server.blob_response import blob_response
+from server.department import people_import
 from server.department.department import Department
 from server.user import User
-from server.database import DatabaseController
+from server.database import RSS_REQUEST_RESOLUTION, DatabaseController
 from server.department.file import File
 from server.department.person import Person
-from server.display import Display
-from server.free_form_content import BinaryContent
+from server.display import Display, RenderedLayout
+from server.display_token import request_display_token
+from server.free_form_content import FreeFormContent, LocalImage
 from server.free_form_content.content_stream import ContentStream
+from server.image_variants import WEBP_MIME_TYPE, make_variants
+from server.loadshedding import current_summary
+from server.notifier import content_changed
 
 
 blueprint = Blueprint("api", __name__, url_prefix="/api")
 
+# The maximum number of content events a single /api/content?since=<cursor>
+# response covers
+CONTENT_DELTA_LIMIT = 500
+# The maximum number of posts a single /api/content response holds
+CONTENT_PAGE_LIMIT = 100
+# The maximum number of feeds a single /api/rss request can ask for, and the
+# maximum number of items its response holds
+RSS_FEED_LIMIT = 20
+RSS_RESPONSE_LIMIT = 100
+# The maximum number of posts a single /api/content/batch request can make
+CONTENT_BATCH_LIMIT = 1000
+# How often a content event stream re-checks the database for changes made by
+# other processes, in seconds
+EVENTS_POLL_INTERVAL = 2
+# How often a comment is sent down an idle event stream to keep it alive, in seconds
+EVENTS_KEEPALIVE_INTERVAL = 15
+# How long an event stream is kept open before the client is made to reconnect,
+# in seconds. This stops long-lived connections from tying up a worker forever.
+EVENTS_MAX_DURATION = 60 * 5
+# How many event streams each process holds open at once. Each open stream ties up
+# one of the process's worker threads, so this must stay well below the threads
+# each worker has (see backend/gunicorn.conf.py) to leave the rest for other
+# requests. Clients which are turned away poll instead.
+EVENTS_MAX_STREAMS = 8
+# How long clients which are turned away should wait before trying again, in seconds
+EVENTS_RETRY_AFTER = 60
+
+_event_stream_slots = threading.BoundedSemaphore(EVENTS_MAX_STREAMS)
+
+
+def can_read(department_id: int) -> bool:
+    """
+    This is not an API call but a function which checks whether the current request
+    may read what screens of the given department show: either it comes from a
+    display of the department with a valid token, or from a logged in user. Display
+    tokens are checked first, so screens never need a session.
+    """
+    token = request_display_token()
+    if token is not None:
+        return token[0] == department_id
+    return current_user.is_authenticated
+
+
+def can_read_streams(streams: list[int | str]) -> bool:
+    """
+    This is not an API call but a function which checks whether the current request
+    may read the given content streams: either it comes from a display with a valid
+    token which may read every one of them (see
+    `DatabaseController.can_display_read_streams`), or from a logged in user
+    """
+    token = request_display_token()
+    if token is not None:
+        return DatabaseController.get().can_display_read_streams(
+            token[0], token[1], streams
+        )
+    return current_user.is_authenticated
+
+
+def can_read_feeds(urls: list[str]) -> bool:
+    """
+    This is not an API call but a function which checks whether the current request
+    may read the given RSS feeds: either it comes from a display with a valid token
+    which shows every one of them, or from a logged in user
+    """
+    token = request_display_token()
+    if token is not None:
+        display = DatabaseController.get().fetch_display_by_id(token[1])
+        return display is not None and all(display.references(url) for url in urls)
+    return current_user.is_authenticated
+
 
 @blueprint.route("/loadshedding_schedule", methods=["GET"])
 def loadshedding():
+    """The /api/loadshedding_schedule endpoint.
+
+    GETting this endpoint returns the summary of the stored loadshedding schedule
+    for the region given by the `region` query parameter (1 by default): the current
+    `stage`, the `next` outage and the upcoming `events`, as of now. The response has
+    an ETag so that displays get 304 Not Modified until it changes.
+
+    Returns 404 if the region's schedule hasn't been fetched yet.
     """
-    Returns the stored loadshedding schedule
-    Right now it is locked to the region of UCT
+    summary = loadshedding_summary(flask.request.args.get("region", 1, type=int))
+    if summary is None:
+        return flask.abort(404)
+
+    summary_json, summary_hash = summary
+    response = Response(summary_json, content_type="application/json")
+    response.set_etag(summary_hash)
+    response.cache_control.no_cache = True
+    return response.make_conditional(flask.request)
+
+
+def loadshedding_summary(region: int) -> Optional[tuple[bytes, str]]:
     """
-    try:
-        schedule_data = DatabaseController.get().fetch_loadshedding_schedule(1)
-        schedule_json = json.dumps(schedule_data, indent=4)
-        response = Response(schedule_json, content_type="application/json")
-        if schedule_json:
-            return response
-        else:
-            return flask.abort(500)
-    except Exception:
-        return flask.abort(500)
+    This is not an API call but a function which returns the summary of the given
+    region's stored loadshedding schedule as of now, along with its ETag, or None if
+    the schedule hasn't been fetched yet
+    """
+    summary = DatabaseController.get().fetch_loadshedding_summary(region)
+    if summary is None:
+        return None
+    return current_summary(summary[0], datetime.now(timezone.utc))
 
 
 @blueprint.route("/health", methods=["GET"])
@@ -102,6 +205,33 @@ def list_users():
     return Response(response_data, content_type="application/json")
 
 
+@blueprint.route("/metrics", methods=["GET"])
+def metrics_report():
+    """The /api/metrics endpoint.
+
+    GETting this endpoint returns the metrics of every server process in the
+    Prometheus text format. Superusers can read them, as can scrapers which send the
+    token in the CAMPUSIGN_METRICS_TOKEN environment variable as a bearer token.
+    """
+    token = os.environ.get("CAMPUSIGN_METRICS_TOKEN")
+    authorization = flask.request.authorization
+    if not (
+        token
+        and authorization is not None
+        and authorization.type == "bearer"
+        and hmac.compare_digest(authorization.token or "", token)
+    ):
+        if not current_user.is_authenticated:
+            return current_app.login_manager.unauthorized()
+        if current_user.permissions != "superuser":
+            flask.abort(401)
+
+    return Response(
+        metrics.render(DatabaseController.get()),
+        content_type="text/plain; version=0.0.4; charset=utf-8",
+    )
+
+
 @blueprint.route("/content", methods=["POST", "GET"])
 def content():
     """The /api/content endpoint.
@@ -109,59 +239,548 @@ def content():
     GETting this endpoint will return a list of all the content in the given streams
     (which are given by query parameters) in the reverse order of posting
     (most recent to least recent). Binary blobs will not be fetched and must be
-    fetched separately using the /api/content/<id>/blob endpoint.
+    fetched separately using the /api/content/<id>/blob endpoint. The response has
+    an ETag, and a request with a matching If-None-Match gets 304 Not Modified
+    without the content being fetched.
+
+    At most `last` posts are returned, which is taken to be between 1 and
+    CONTENT_PAGE_LIMIT. Older posts can be fetched a page at a time by passing the
+    `before` cursor of the response back as `before=<cursor>`, and newer ones by
+    passing the `after` cursor back as `after=<cursor>`. There is no `before` if
+    there are no older posts.
+
+    The X-Content-Cursor response header is a cursor which can be passed as
+    `since=<cursor>` in a later GET to only fetch what changed in the meantime. The
+    response to that is a JSON object with the posts `added` since the cursor, the
+    IDs of posts `deleted` since the cursor and a new `cursor`. If `more` is true,
+    there were too many changes to send at once and the client should immediately
+    ask again with the new cursor. If `reset` is true, the cursor is too old for
+    what changed since to be known, and the client should fetch the content again.
 
     POSTing to this endpoint with a form representing a new content post will create
     the post in the given stream and return the ID and post time upon success.
+
+    Displays can GET this endpoint with their display token instead of logging in.
     """
-    if not current_user.is_authenticated:
-        return current_app.login_manager.unauthorized()
     streams = flask.request.args.getlist("stream")
-    limit = int(last if (last := flask.request.args.get("last")) else 0) or None
+    if not can_read_streams(streams):
+        return current_app.login_manager.unauthorized()
+    streams = parse_streams(streams)
+    limit = page_limit(flask.request.args.get("last", type=int))
+    since = flask.request.args.get("since", type=int)
+    before = parse_page_cursor(flask.request.args.get("before"))
+    after = parse_page_cursor(flask.request.args.get("after"))
+
+    if flask.request.method == "GET" and since is not None:
+        return content_delta(streams, since)
+    elif flask.request.method == "GET":
+        db = DatabaseController.get()
+        version = db.fetch_content_version(streams)
+        expiry = db.fetch_content_last_expiry(streams)
+        etag = content_etag(streams, limit, before, after, version, expiry)
 
-    if flask.request.method == "GET":
-        return {
-            "content": [
-                post.to_http_json()
-                for post in DatabaseController.get().fetch_content_in_streams(
-                    streams, limit=limit
+        if flask.request.if_none_match.contains(etag):
+            response = Response(status=HTTPStatus.NOT_MODIFIED)
+        else:
+            response = flask.make_response(
+                content_page(
+                    db, streams, limit, before, flask.request.args.get("after")
                 )
-            ]
-        }
+            )
+
+        response.set_etag(etag)
+        response.cache_control.no_cache = True
+        response.headers["X-Content-Cursor"] = str(version)
+        return response
     elif flask.request.method == "POST":
         if not current_user.is_authenticated:
             return current_app.login_manager.unauthorized()
 
-        content_id, posted = DatabaseController.get().post_content(
-            free_form_content.from_form(flask.request.form, flask.request.files)
-        )
+        try:
+            post = free_form_content.from_form(flask.request.form, flask.request.files)
+        except Exception:
+            return flask.abort(400, description="The post is invalid")
+        content_id, posted = DatabaseController.get().post_content(post)
+
+        if isinstance(post, LocalImage):
+            add_image_variants([(content_id, post)])
 
         return {"id": content_id, "posted": posted}
 
 
+def parse_streams(streams: list[str]) -> list[int]:
+    """
+    This is not an API call but a function which parses the given content stream
+    IDs from a request, aborting it with 400 Bad Request if any isn't an integer
+    """
+    try:
+        return [int(stream) for stream in streams]
+    except ValueError:
+        flask.abort(400, description="Invalid stream")
+
+
+def page_limit(last: Optional[int]) -> int:
+    """
+    This is not an API call but a function which returns how many posts a page of
+    content from /api/content holds when the `last` posts are asked for: as many as
+    it can if no number is given, and otherwise between 1 and CONTENT_PAGE_LIMIT
+    """
+    if not last:
+        return CONTENT_PAGE_LIMIT
+    return max(1, min(last, CONTENT_PAGE_LIMIT))
+
+
+def content_etag(
+    streams: list[int],
+    limit: int,
+    before: Optional[tuple[int, int]],
+    after: Optional[tuple[int, int]],
+    version: int,
+    expiry: int,
+) -> str:
+    """
+    This is not an API call but a function which returns the ETag of a page of
+    content from /api/content, given the content version of its streams and when
+    content in them last expired
+    """
+    key = f"{sorted(set(streams))}:{limit}:{before}:{after}:{version}:{expiry}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def content_page(
+    db: DatabaseController,
+    streams: list[int],
+    limit: int,
+    before: Optional[tuple[int, int]],
+    after_cursor: Optional[str],
+) -> dict:
+    """
+    This is not an API call but a function which fetches a page of content as
+    returned by /api/content, with the `before` and `after` cursors of the page
+    """
+    after = parse_page_cursor(after_cursor)
+    posts = db.fetch_content_in_streams(
+        streams, limit=limit, before=before, after=after
+    )
+    page = {"content": [post.to_http_json() for post in posts]}
+    if len(posts) == limit:
+        page["before"] = page_cursor(posts[-1])
+    if posts or after:
+        page["after"] = page_cursor(posts[0]) if posts else after_cursor
+    return page
+
+
+def display_bootstrap(department_id: int, rendered: RenderedLayout) -> dict:
+    """
+    This is not an API call but a function which gathers the data the widgets of
+    the given rendered layout would otherwise fetch one at a time when the display
+    starts, so that it can be sent along with the layout. Each piece is what the
+    matching API call would return, along with the ETag (and for content, the
+    cursor) it would have, so that the widgets carry on with conditional requests.
+
+    Content is keyed by its streams and fetch amount, and loadshedding schedules by
+    region, in the same way as the widgets which use them.
+    """
+    db = DatabaseController.get()
+    bootstrap = {"content": {}, "people": None, "loadshedding": {}}
+
+    for stream_ids, fetch_amount in rendered.bindings.content:
+        key = f"{','.join(map(str, stream_ids))}:{fetch_amount}"
+        streams = list(stream_ids)
+        try:
+            limit = page_limit(int(fetch_amount))
+        except ValueError:
+            limit = page_limit(None)
+
+        version = db.fetch_content_version(streams)
+        expiry = db.fetch_content_last_expiry(streams)
+        bootstrap["content"][key] = {
+            "page": content_page(db, streams, limit, None, None),
+            "etag": quote_etag(
+                content_etag(streams, limit, None, None, version, expiry)
+            ),
+            "cursor": version,
+        }
+
+    if rendered.bindings.people:
+        people = db.fetch_department_people_json(department_id)
+        if people is not None:
+            people_json, etag = people
+            bootstrap["people"] = {
+                "people": json.loads(people_json)["people"],
+                "etag": quote_etag(etag),
+            }
+
+    for region in rendered.bindings.regions:
+        try:
+            summary = loadshedding_summary(int(region))
+        except ValueError:
+            summary = loadshedding_summary(1)
+        if summary is not None:
+            summary_json, summary_hash = summary
+            bootstrap["loadshedding"][region] = {
+                "schedule": json.loads(summary_json),
+                "etag": quote_etag(summary_hash),
+            }
+
+    return bootstrap
+
+
+def display_bootstrap_version(department_id: int, rendered: RenderedLayout) -> str:
+    """
+    This is not an API call but a function which returns a version of the data
+    display_bootstrap would gather for the given rendered layout, which changes
+    whenever that data does. Only the versions and hashes the data is checked by
+    are read, so that a display whose page hasn't changed can be answered without
+    gathering its data.
+    """
+    db = DatabaseController.get()
+    versions = []
+
+    for stream_ids, _ in rendered.bindings.content:
+        streams = list(stream_ids)
+        versions.append(db.fetch_content_version(streams))
+        versions.append(db.fetch_content_last_expiry(streams))
+
+    if rendered.bindings.people:
+        people = db.fetch_department_people_json(department_id)
+        versions.append(people[1] if people is not None else None)
+
+    for region in rendered.bindings.regions:
+        try:
+            summary = loadshedding_summary(int(region))
+        except ValueError:
+            summary = loadshedding_summary(1)
+        versions.append(summary[1] if summary is not None else None)
+
+    return hashlib.sha256(repr(versions).encode()).hexdigest()
+
+
+def page_cursor(post: FreeFormContent) -> str:
+    """
+    This is not an API call but a function which returns the cursor for paging
+    through content from the given post, as used by /api/content
+    """
+    return f"{int(post.posted.timestamp())}-{post.id}"
+
+
+def parse_page_cursor(cursor: Optional[str]) -> Optional[tuple[int, int]]:
+    """
+    This is not an API call but a function which parses a cursor returned by
+    `page_cursor` into a (posted, id) pair
+    """
+    if cursor is None:
+        return None
+
+    posted, _, content_id = cursor.partition("-")
+    if not posted.isdigit() or not content_id.isdigit():
+        return flask.abort(400, description="Invalid cursor")
+    return int(posted), int(content_id)
+
+
+@blueprint.route("/content/batch", methods=["POST"])
+def content_batch():
+    """The /api/content/batch endpoint.
+
+    POSTing to this endpoint creates many posts at once in a single transaction and
+    returns the ID and post time of each, in order, as
+    {"posts": [{"id": ..., "posted": ...}, ...]}. The body is either:
+
+    - JSON of the form {"posts": [...]}, where each post has the same fields as a
+      form POSTed to /api/content. Images and videos can't be posted this way.
+    - A multipart form where the fields of each post are prefixed by its index,
+      e.g. `0.type`, `0.content_stream`, `1.type`, `1.image_data`.
+
+    If any post is invalid, none of them are created and 400 is returned.
+    """
+    if not current_user.is_authenticated:
+        return current_app.login_manager.unauthorized()
+
+    forms = batch_forms()
+    if len(forms) > CONTENT_BATCH_LIMIT:
+        return flask.abort(
+            400, description=f"At most {CONTENT_BATCH_LIMIT} posts can be made at once"
+        )
+
+    posts = []
+    for index, (form, files) in enumerate(forms):
+        try:
+            posts.append(free_form_content.from_form(form, files))
+        except Exception:
+            return flask.abort(400, description=f"Post {index} is invalid")
+
+    posted = DatabaseController.get().post_contents(posts)
+    add_image_variants(
+        [
+            (content_id, post)
+            for post, (content_id, _) in zip(posts, posted)
+            if isinstance(post, LocalImage)
+        ]
+    )
+
+    return {
+        "posts": [
+            {"id": content_id, "posted": post_time} for content_id, post_time in posted
+        ]
+    }
+
+
+def batch_forms() -> list[tuple[MultiDict, dict]]:
+    """
+    This is not an API call but a function which splits the body of a
+    /api/content/batch request into the form and files of each post
+    """
+    if flask.request.is_json:
+        posts = flask.request.get_json().get("posts")
+        if not isinstance(posts, list) or not all(isinstance(p, dict) for p in posts):
+            return flask.abort(400, description="Expected a list of posts")
+        return [(MultiDict(post), {}) for post in posts]
+
+    forms = defaultdict(MultiDict)
+    files = defaultdict(dict)
+    for key, value in flask.request.form.items(multi=True):
+        index, _, field = key.partition(".")
+        forms[index].add(field, value)
+    for key, file in flask.request.files.items(multi=True):
+        index, _, field = key.partition(".")
+        files[index][field] = file
+
+    indices = forms.keys() | files.keys()
+    if not all(index.isdigit() for index in indices):
+        return flask.abort(400, description="Fields must be prefixed by a post index")
+
+    return [(forms[index], files[index]) for index in sorted(indices, key=int)]
+
+
+def add_image_variants(images: list[tuple[int, LocalImage]]):
+    """
+    This is not an API call but a function which generates and stores the resized
+    variants of the given newly posted images, as (content id, image) pairs
+    """
+    # Start on every image before waiting on any of them
+    pending = [
+        (content_id, make_variants(image.image_data, image.mime_type))
+        for content_id, image in images
+    ]
+
+    for content_id, variants in pending:
+        try:
+            DatabaseController.get().add_content_variants(content_id, variants.result())
+        except (OSError, PIL.Image.DecompressionBombError, BrokenProcessPool):
+            # Pillow could verify the image but not decode it, or the worker died
+            # decoding it, so the original will have to do
+            pass
+
+
+def content_delta(streams: list[int], since: int) -> dict:
+    """
+    This is not an API call but a function which returns the changes to the content
+    in the given streams since the given cursor, for GET /api/content?since=<cursor>
+    """
+    db = DatabaseController.get()
+    if db.is_change_log_truncated(since):
+        # The changes since the cursor have been truncated, so what changed can't be
+        # known and the content has to be fetched again
+        return {
+            "added": [],
+            "deleted": [],
+            "cursor": since,
+            "more": False,
+            "reset": True,
+        }
+
+    events = db.fetch_content_events(streams, after=since, limit=CONTENT_DELTA_LIMIT)
+
+    posted_ids = {content_id for _, _, content_id, event in events if event == "posted"}
+    changed_ids = {content_id for _, _, content_id, _ in events}
+
+    # Content removed from one stream may still be in another one, so look up what
+    # is actually still there rather than trusting the deleted events
+    still_present = db.fetch_content_in_streams(streams, content_ids=list(changed_ids))
+    present_ids = {post.id for post in still_present}
+
+    return {
+        "added": [
+            post.to_http_json() for post in still_present if post.id in posted_ids
+        ],
+        "deleted": sorted(changed_ids - present_ids),
+        "cursor": events[-1][0] if events else since,
+        "more": len(events) == CONTENT_DELTA_LIMIT,
+        "reset": False,
+    }
+
+
+def count_open_stream(stream: Iterator[str], labels: dict[str, str]) -> Iterator[str]:
+    """This is not an API call but a function which passes on the given event stream,
+    counting it as open in the metrics from when it starts until it is closed,
+    including when the client disconnects"""
+    metrics.inc("campusign_event_streams_open", labels)
+    try:
+        yield from stream
+    finally:
+        metrics.inc("campusign_event_streams_open", labels, -1)
+
+
+def event_stream_response(stream: Iterator[str], labels: dict[str, str]) -> Response:
+    """This is not an API call but a function which sends the given event stream,
+    or 503 Service Unavailable if this process already holds `EVENTS_MAX_STREAMS`
+    streams open"""
+    if not _event_stream_slots.acquire(blocking=False):
+        return Response(
+            "Too many event streams are open, poll instead",
+            status=HTTPStatus.SERVICE_UNAVAILABLE,
+            headers={"Retry-After": str(EVENTS_RETRY_AFTER)},
+        )
+
+    response = Response(
+        flask.stream_with_context(count_open_stream(stream, labels)),
+        content_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    # The stream's slot is given back when the response is closed, even if the
+    # client went away before the stream started
+    response.call_on_close(_event_stream_slots.release)
+    return response
+
+
+@blueprint.route("/content/events", methods=["GET"])
+def content_events():
+    """The /api/content/events endpoint.
+
+    GETting this endpoint opens a Server-Sent Events stream which sends a `posted`
+    or `deleted` event whenever content is posted to or deleted from one of the
+    given streams. Each event's ID is a cursor: reconnecting with it in the
+    Last-Event-ID header (or the `cursor` query parameter) replays any events that
+    were missed. Without a cursor, only events from now onwards are sent.
+
+    Each stream ties up a worker thread for as long as it is open, so a display
+    should open a single stream for all the content streams it shows. Each process
+    only holds `EVENTS_MAX_STREAMS` streams open at once, and answers any more with
+    503 Service Unavailable, so that clients poll instead of taking every thread.
+
+    Displays can use this endpoint with their display token instead of logging in.
+    """
+    streams = flask.request.args.getlist("stream", type=int)
+    if not can_read_streams(streams):
+        return current_app.login_manager.unauthorized()
+    cursor = flask.request.headers.get("Last-Event-ID", type=int)
+    if cursor is None:
+        cursor = flask.request.args.get("cursor", type=int)
+    token = request_display_token()
+    labels = {"display": str(token[1]) if token is not None else ""}
+
+    def generate(cursor):
+        if cursor is None:
+            cursor = DatabaseController.get().fetch_change_log_head()
+
+        # Let the client know where it is up to even if nothing happens
+        yield f"retry: {EVENTS_POLL_INTERVAL * 1000}\nid: {cursor}\nevent: ready\n\n"
+
+        started = last_sent = time.monotonic()
+        while time.monotonic() - started < EVENTS_MAX_DURATION:
+            events = DatabaseController.get().fetch_content_events(
+                streams, after=cursor
+            )
+            # Only hold a database connection while polling, rather than for as long
+            # as the stream is open
+            DatabaseController.teardown()
+            for event_id, stream, content_id, event in events:
+                data = json.dumps({"id": content_id, "stream": stream})
+                yield f"id: {event_id}\nevent: {event}\ndata: {data}\n\n"
+                cursor = event_id
+
+            if events:
+                last_sent = time.monotonic()
+            elif time.monotonic() - last_sent > EVENTS_KEEPALIVE_INTERVAL:
+                yield ": keepalive\n\n"
+                last_sent = time.monotonic()
+
+            if len(events) == 0:
+                content_changed.wait(EVENTS_POLL_INTERVAL)
+
+    return event_stream_response(generate(cursor), labels)
+
+
+@blueprint.route("/rss", methods=["GET"])
+def rss_feeds():
+    """The /api/rss endpoint.
+
+    GETting this endpoint returns the items of the RSS feeds given by the `url` query
+    parameters, merged and sorted from newest to oldest, as {"items": [...]}. Each
+    item has a `title`, `link`, `body`, `image` and `published` time. The response
+    has an ETag, and a request with a matching If-None-Match gets 304 Not Modified.
+
+    Feeds are polled by the server rather than fetched on request, so a feed has no
+    items until it has first been fetched. The server only starts polling a feed
+    when a logged in user, or a display which shows the feed, asks for it, and never
+    fetches feeds from private or reserved addresses.
+    """
+    urls = list(dict.fromkeys(flask.request.args.getlist("url")))[:RSS_FEED_LIMIT]
+    if not can_read_feeds(urls):
+        return current_app.login_manager.unauthorized()
+    if any(urlparse(url).scheme not in ("http", "https") for url in urls):
+        return flask.abort(400, description="Invalid feed URL")
+
+    db = DatabaseController.get()
+    feeds = db.fetch_rss_feeds(urls)
+    requested_before = time.time() - RSS_REQUEST_RESOLUTION
+    # Everyone who may read a feed may have it polled, see can_read_feeds
+    to_register = [
+        url for url in urls if url not in feeds or feeds[url][0] < requested_before
+    ]
+    if to_register:
+        db.register_rss_feeds(to_register)
+
+    hashes = [feeds[url][2] if url in feeds else None for url in urls]
+    etag = hashlib.sha256(json.dumps([urls, hashes]).encode("utf-8")).hexdigest()
+    if flask.request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        items = [
+            item
+            for url in urls
+            if url in feeds and feeds[url][1] is not None
+            for item in json.loads(feeds[url][1])
+        ]
+        items.sort(key=lambda item: item["published"] or 0, reverse=True)
+        response = flask.make_response({"items": items[:RSS_RESPONSE_LIMIT]})
+
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+
 @blueprint.route("/departments/<int:department_id>/people", methods=["POST", "GET"])
 def people_route(department_id: int):
     """The /api/departments/<id>/people end point
     GETing this endpoint fetches all the departments people from the database
 
     POSTing to this end point inserts a new person into the database
+
+    Displays in the department can GET this endpoint with their display token
+    instead of logging in. The response has an ETag, and a request with a matching
+    If-None-Match gets 304 Not Modified. Each person has the `image_hash` of their
+    image, which changes whenever their image does.
     """
 
-    if not current_user.is_authenticated:
+    if not can_read(department_id):
         return current_app.login_manager.unauthorized()
 
-    dept = DatabaseController.get().fetch_department_by_id(
-        department_id, fetch_people=True
-    )
-
-    if not dept:
-        return flask.abort(404)
-
     if flask.request.method == "GET":
-        return {"people": [person.to_http_json() for person in dept.people]}
+        people = DatabaseController.get().fetch_department_people_json(department_id)
+        if people is None:
+            return flask.abort(404)
+
+        people_json, etag = people
+        response = Response(people_json, content_type="application/json")
+        response.set_etag(etag)
+        response.cache_control.no_cache = True
+        return response.make_conditional(flask.request)
     else:
         if not current_user.is_authenticated:
             return current_app.login_manager.unauthorized()
+        if not DatabaseController.get().fetch_department_by_id(department_id):
+            return flask.abort(404)
 
         person_id = DatabaseController.get().upsert_person(
             Person.from_form(flask.request.form, flask.request.files), department_id
@@ -197,14 +816,13 @@ def person(department_id: int, person_id: int):
     "/departments/<int:department_id>/people/<int:person_id>/image", methods=["GET"]
 )
 def person_image(department_id: int, person_id: int):
-    """Fetch the image of a person"""
-    if not current_user.is_authenticated:
+    """Fetch the image of a person. Displays in the department can use their
+    display token instead of logging in."""
+    if not can_read(department_id):
         return current_app.login_manager.unauthorized()
-    image_data = DatabaseController.get().fetch_person_image_by_id(person_id)
-    if image_data:
-        mime_type = image_data[0]
-        blob = image_data[1]
-        return Response(response=blob, mimetype=mime_type, status=HTTPStatus.OK)
+    image = DatabaseController.get().open_person_image(person_id, department_id)
+    if image:
+        return blob_response(*image)
     else:
         return flask.abort(404)
 
@@ -218,81 +836,54 @@ def open_empty_zip_file():
     return zipfile.ZipFile(io.BytesIO(zip_contents), "r")
 
 
-def create_person(row, zip_file):
-    """
-    This is not an API call but a function which takes the row of a form
-    and a zipfile and returns a person object
-    """
-    # makes the attributes of the person from the row.
-    # As the user may be able to not enter certain attributes
-    # of the person this accounts for that
-    title = row["title"] if not pd.isna(row["title"]) else ""
-    full_name = row["full_name"] if not pd.isna(row["full_name"]) else ""
-    position = row["position"] if not pd.isna(row["position"]) else ""
-    office_hours = row["office_hours"] if not pd.isna(row["office_hours"]) else ""
-    office_location = (
-        row["office_location"] if not pd.isna(row["office_location"]) else ""
-    )
-    email = row["email"] if not pd.isna(row["email"]) else ""
-    phone = row["phone"] if not pd.isna(row["phone"]) else ""
-    try:
-        # this tries to find the image of the person
-        # from the uploaded ZIP file if there is one
-        with zip_file.open(row["image_name"]) as image_file:
-            image_data = image_file.read()
-            image = PIL.Image.open(io.BytesIO(image_data))
-            image.verify()
-            mime_type = image.get_format_mimetype()
-    except Exception:
-        image_data = ""
-        mime_type = ""
-    person = Person(
-        title,
-        full_name,
-        mime_type,
-        image_data,
-        position,
-        office_hours,
-        office_location,
-        email,
-        phone,
-    )
-    return person
-
-
 @blueprint.route("/departments/<int:department_id>/uploadtable", methods=["POST"])
 def upload_table(department_id: int):
     """
     The /api/departments/<dept_id>/upload_table endpoint.
     POSTing this endpoint uploads the posted table to its database
+
+    The table is an Excel or CSV file, and may come with a ZIP file of images. The
+    response lists any `errors` in individual rows as {"row": number, "error": str},
+    and the IDs which were `skipped` since they belong to people in other
+    departments. See `people_import.import_people`.
     """
     if not current_user.is_authenticated:
         return current_app.login_manager.unauthorized()
     if current_user.permissions == "posting_user":
         flask.abort(401)
     try:
-        try:
-            zip_file = zipfile.ZipFile(flask.request.files["images_folder"], "r")
-        except Exception:
-            # If it fails, load an empty zip file from the server
-            zip_file = open_empty_zip_file()
+        zip_file = zipfile.ZipFile(
+            people_import.open_upload(flask.request.files["images_folder"]), "r"
+        )
+    except Exception:
+        # If it fails, load an empty zip file from the server
+        zip_file = open_empty_zip_file()
 
-        excel_file = flask.request.files["add_table"]
-        df = pd.read_excel(excel_file, engine="openpyxl")
-        people = [create_person(row, zip_file) for index, row in df.iterrows()]
+    errors = []
+    try:
+        # Every row is read before any person is added, so that an unreadable
+        # table doesn't leave behind half of its people
+        imported, skipped = DatabaseController.get().upsert_people(
+            people_import.import_people(
+                people_import.read_table(flask.request.files["add_table"]),
+                zip_file,
+                errors,
+            ),
+            department_id,
+        )
+    except people_import.InvalidTableError as e:
+        return flask.abort(400, description=str(e))
 
-        # Separate loops so that any error in the whole table
-        # is caught before any entry is added
-        # loop through people to add each to the table
-        db = DatabaseController.get()
-        for person in people:
-            db.upsert_person(person, department_id)
-        return {
-            "id": "response needed",
-            "response": "Excel file is a valid file. Upload successful",
-        }
-    except Exception:
-        return flask.abort(400)
+    response = f"Imported {imported} people with {len(errors)} errors"
+    if skipped:
+        response += f", skipping the IDs of people in other departments {skipped}"
+    return {
+        "id": "response needed",
+        "response": response,
+        "imported": imported,
+        "errors": errors,
+        "skipped": skipped,
+    }
 
 
 @blueprint.route("/register", methods=["POST"])
@@ -439,15 +1030,27 @@ def delete_user(user_id: str):
 @blueprint.route("/content/<int:content_id>/blob", methods=["GET"])
 def content_blob(content_id: int):
     """Fetch the blob (Binary Large OBject) associated with the given content.
+    The blob is streamed from the database and Range requests are supported.
+    Since content can't be edited, the blob may be cached indefinitely.
+
+    Images are resized when they are posted. Passing `?w=<width>` fetches the
+    smallest variant at least that wide, and clients which accept WebP are sent
+    WebP variants.
 
     Returns 404 if the content is not BinaryContent.
     """
-    post = DatabaseController.get().fetch_content_by_id(content_id, fetch_blob=True)
+    # Only explicitly accepting WebP counts, rather than e.g. */*
+    accepts_webp = WEBP_MIME_TYPE in flask.request.accept_mimetypes.values()
+    blob = DatabaseController.get().open_content_blob(
+        content_id,
+        width=flask.request.args.get("w", type=int),
+        mime_types=[WEBP_MIME_TYPE] if accepts_webp else None,
+    )
 
-    if isinstance(post, BinaryContent):
-        return Response(
-            response=post.blob, mimetype=post.mime_type, status=HTTPStatus.OK
-        )
+    if blob:
+        response = blob_response(*blob, immutable=True)
+        response.vary.add("Accept")
+        return response
     else:
         flask.abort(404)
 
@@ -487,6 +1090,27 @@ def delete_display(department_id: int, display_id: int):
         return flask.abort(500)
 
 
+@blueprint.route(
+    "/departments/<int:department_id>/displays/<int:display_id>/token",
+    methods=["DELETE"],
+)
+def display_token(department_id: int, display_id: int):
+    """The /api/departments/<dept_id>/displays/<id>/token endpoint.
+
+    DELETEing this endpoint revokes every token of the given display. The display
+    is given a new token the next time it loads its page.
+    """
+    if not current_user.is_authenticated:
+        return current_app.login_manager.unauthorized()
+    if current_user.permissions == "posting_user":
+        return flask.abort(401)
+
+    if DatabaseController.get().reset_display_token_secret(department_id, display_id):
+        return {"revoked": True}
+    else:
+        return flask.abort(404)
+
+
 @blueprint.route("/departments/<int:department_id>/preview_display", methods=["POST"])
 def preview_display(department_id: int):
     """Preview the given display without actually creating it"""
@@ -539,17 +1163,17 @@ def get_department_files(filename: str, department_id: int):
 
     POSTing to this endpoint well fetch files from the server
     dependant on the file name and department
-    """
-    department_file = DatabaseController.get().fetch_file_by_id(filename, department_id)
 
-    if not current_user.is_authenticated:
+    Displays in the department can use their display token instead of logging in.
+    """
+    if not can_read(department_id):
         return current_app.login_manager.unauthorized()
+
+    department_file = DatabaseController.get().open_department_file(
+        filename, department_id
+    )
     if department_file:
-        return Response(
-            response=department_file.file_data,
-            mimetype=department_file.mime_type,
-            status=HTTPStatus.OK,
-        )
+        return blob_response(*department_file)
     else:
         flask.abort(404)
 
@@ -565,8 +1189,14 @@ def file(department_id: int, file_name: str):
     dependant on the file name and department
     DELETEing this endpoint will delete a file from the server
     dependant on the file name and department
+
+    Displays in the department can GET files with their display token instead of
+    logging in, which is how they show the files in their layouts.
     """
-    if not current_user.is_authenticated:
+    if flask.request.method == "GET":
+        if not can_read(department_id):
+            return current_app.login_manager.unauthorized()
+    elif not current_user.is_authenticated:
         return current_app.login_manager.unauthorized()
 
     if not DatabaseController.get().fetch_department_by_id(department_id):
@@ -580,11 +1210,9 @@ def file(department_id: int, file_name: str):
         else:
             flask.abort(404)
     else:
-        file = DatabaseController.get().fetch_file_by_id(file_name, department_id)
+        file = DatabaseController.get().open_department_file(file_name, department_id)
 
-        if isinstance(file, File):
-            return Response(
-                response=file.file_data, mimetype=file.mime_type, status=HTTPStatus.OK
-            )
+        if file:
+            return blob_response(*file)
         else:
             flask.abort(404)
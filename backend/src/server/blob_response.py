@@ -0,0 +1,86 @@
+import hashlib
+import io
+import os
+from typing import BinaryIO
+
+import flask
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+from werkzeug.wsgi import wrap_file
+
+from server.database import DatabaseController, OpenBlob
+
+# How much of a blob is read from the database at once when streaming it
+CHUNK_SIZE = 64 * 1024
+
+# How long immutable blobs may be cached for, which is a year as per RFC 9111
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+
+def blob_response(
+    mime_type: str, blob: OpenBlob, immutable: bool = False
+) -> flask.Response:
+    """Stream the given blob to the client in chunks, without loading it into
+    memory. Range requests are supported, so video elements can seek, and are
+    answered with 206 Partial Content. The blob is either open in the database, read
+    from it whole, or the path of a file in the blob store.
+
+    The ETag is always the SHA-256 hash of the blob, so conditional requests are
+    answered with 304 Not Modified. Only blobs stored inline for lack of a blob
+    store, or empty ones, are hashed here. Blobs which can never change under the
+    same URL should be marked `immutable` so that browsers don't even revalidate
+    them; otherwise, browsers must revalidate the blob every time."""
+    if isinstance(blob, str):
+        # Files in the blob store are named by the hash of their contents, which
+        # makes for an ideal ETag
+        response = flask.send_file(
+            blob, mimetype=mime_type, etag=os.path.basename(blob), conditional=True
+        )
+        return _set_cache_control(response, immutable)
+
+    length = len(blob)
+    if isinstance(blob, bytes):
+        blob = io.BytesIO(blob)
+
+    response = flask.Response(
+        wrap_file(flask.request.environ, blob, CHUNK_SIZE),
+        mimetype=mime_type,
+        direct_passthrough=True,
+    )
+    response.content_length = length
+    response.set_etag(_hash_blob(blob))
+    _set_cache_control(response, immutable)
+
+    # The blob is read from the request's connection while the response is sent
+    DatabaseController.keep_until_closed(response)
+
+    try:
+        return response.make_conditional(
+            flask.request, accept_ranges=True, complete_length=length
+        )
+    except RequestedRangeNotSatisfiable:
+        # Closes the blob and checks the connection back in
+        response.close()
+        raise
+
+
+def _hash_blob(blob: BinaryIO) -> str:
+    """Hash a blob stored inline in the database the same way the blob store does,
+    leaving it ready to be read from the start"""
+    blob_hash = hashlib.sha256()
+    while chunk := blob.read(CHUNK_SIZE):
+        blob_hash.update(chunk)
+    blob.seek(0)
+    return blob_hash.hexdigest()
+
+
+def _set_cache_control(response: flask.Response, immutable: bool) -> flask.Response:
+    if immutable:
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        # Only the user who fetched it may cache it, since it needs a login
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    return response
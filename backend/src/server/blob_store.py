@@ -0,0 +1,84 @@
+import hashlib
+import os
+import shutil
+import tempfile
+from typing import Iterator
+
+import flask
+
+BLOB_STORE = "blobs"
+BLOB_STORE_TEST = "blobs.test"
+
+
+class BlobStore:
+    """A content-addressed store for binary data (images, videos and files) on disk.
+
+    Each blob is stored under the hex SHA-256 hash of its contents, so the database
+    only needs to keep the hash, and identical uploads are only stored once.
+    """
+
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+
+    @staticmethod
+    def get():
+        """Gets the blob store the server uses"""
+        return BlobStore(
+            BLOB_STORE if not flask.current_app.config["TESTING"] else BLOB_STORE_TEST
+        )
+
+    def path(self, blob_hash: str) -> str:
+        """The path of the file holding the blob with the given hash. Blobs are
+        split into subdirectories by the first two characters of their hash so that
+        no single directory gets too large."""
+        return os.path.join(self.root, blob_hash[:2], blob_hash)
+
+    def put(self, data: bytes) -> str:
+        """Store the given data and return its hash. If the same data is already
+        stored, it is not written again."""
+        blob_hash = hashlib.sha256(data).hexdigest()
+        path = self.path(blob_hash)
+
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            # Write to a temporary file first so that a half-written blob is never
+            # visible under its hash
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+
+        return blob_hash
+
+    def read(self, blob_hash: str) -> bytes:
+        """Read the blob with the given hash into memory"""
+        with open(self.path(blob_hash), "rb") as f:
+            return f.read()
+
+    def delete(self, blob_hash: str):
+        """Delete the blob with the given hash, if it is stored"""
+        try:
+            os.unlink(self.path(blob_hash))
+        except FileNotFoundError:
+            pass
+
+    def hashes(self) -> Iterator[str]:
+        """Iterate over the hashes of all stored blobs"""
+        if not os.path.isdir(self.root):
+            return
+
+        for prefix in os.scandir(self.root):
+            if prefix.is_dir():
+                for entry in os.scandir(prefix.path):
+                    # Skip any temporary files left behind by a crash
+                    if len(entry.name) == 64 and entry.name.startswith(prefix.name):
+                        yield entry.name
+
+    def clear(self):
+        """Delete every blob in the store"""
+        shutil.rmtree(self.root, ignore_errors=True)
@@ -0,0 +1,88 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+# Every cache which has a name, so that their hit ratios can be reported
+_named_caches: list["Cache"] = []
+
+
+class Cache:
+    """A simple thread-safe in-process key-value cache.
+
+    Entries live until they are explicitly invalidated, so whoever writes the
+    underlying data is responsible for invalidating the affected keys. Optionally,
+    the cache can be bounded to `max_size` entries, evicting the least recently used
+    first, and entries can expire `ttl` seconds after they were cached.
+
+    Caches with a `name` are listed by `named_caches`, along with how many times
+    they were hit and missed.
+    """
+
+    def __init__(
+        self,
+        max_size: Optional[int] = None,
+        ttl: Optional[float] = None,
+        name: Optional[str] = None,
+    ):
+        # Ordered from least to most recently used
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.max_size = max_size
+        self.ttl = ttl
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        if name is not None:
+            _named_caches.append(self)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Get the cached value for the given key, or `default` if not cached"""
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+
+            value, expires = self._entries[key]
+            if expires is not None and expires <= time.monotonic():
+                del self._entries[key]
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any):
+        """Cache the given value under the given key"""
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            if self.max_size is not None:
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable):
+        """Remove the given key from the cache, if it is present"""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def invalidate_where(self, predicate: Callable[[Hashable, Any], bool]):
+        """Remove all entries for which `predicate(key, value)` is true"""
+        with self._lock:
+            for key in [k for k, (v, _) in self._entries.items() if predicate(k, v)]:
+                del self._entries[key]
+
+    def clear(self):
+        """Remove all entries from the cache"""
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def named_caches() -> list[Cache]:
+    """List every cache which has a name"""
+    return list(_named_caches)
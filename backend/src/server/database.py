@@ -1,13 +1,18 @@
+import hashlib
 import json
 import os
+import queue
+import secrets
 import sqlite3
+import threading
 import time
-from typing import Optional, Tuple
+from typing import Iterable, Optional, Tuple, Union
 import flask
 from flask_login import (
     current_user,
 )
-from server import free_form_content
+from server import free_form_content, invalidation
+from server.blob_store import BlobStore
 from server.department.department import Department
 from server.department.file import File
 from server.department.person import Person
@@ -15,6 +20,8 @@ from server.display import Display, PageTemplate
 from server.free_form_content import FreeFormContent, BinaryContent
 from server.free_form_content.content_stream import ContentStream
 from server.grouped_content_streams import GroupedContentStreams
+from server.image_variants import choose_variant
+from server.notifier import content_changed
 
 from werkzeug.security import generate_password_hash, check_password_hash
 
@@ -29,33 +36,265 @@ class Permission(Enum):
 
 
 ADMIN_DEPARTMENT = 1
+# The columns holding references into the blob store, as (table, column, inline
+# data column). These were added after the tables, so may need to be added to older
+# databases.
+BLOB_HASH_COLUMNS = [
+    ("content", "blob_hash", "content_blob"),
+    ("people", "image_hash", "image_data"),
+    ("files", "file_hash", "file_content"),
+    # Variants are only ever kept in the blob store
+    ("content_variants", "blob_hash", None),
+]
+# Inserts a person, or updates them if their ID is already taken. People without an
+# image keep their old one. People are never moved to another department.
+UPSERT_PERSON = (
+    "INSERT INTO people"
+    " (id, department, title, full_name, mime_type, image_data, image_hash,"
+    " position, office_hours, office_location, email, phone)"
+    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+    " ON CONFLICT (id) DO UPDATE SET"
+    " title = excluded.title, full_name = excluded.full_name,"
+    " position = excluded.position, office_hours = excluded.office_hours,"
+    " office_location = excluded.office_location, email = excluded.email,"
+    " phone = excluded.phone,"
+    " mime_type = iif(excluded.mime_type = '', mime_type, excluded.mime_type),"
+    " image_data = iif(excluded.mime_type = '', image_data, excluded.image_data),"
+    " image_hash = iif(excluded.mime_type = '', image_hash, excluded.image_hash)"
+    " WHERE department = excluded.department"
+)
+# An open blob: the path of its file in the blob store, or a handle for reading a
+# blob stored inline incrementally. Before Python 3.11, sqlite3 can't open blobs, so
+# inline blobs are read whole instead.
+OpenBlob = Union[str, "sqlite3.Blob", bytes]
 DATABASE = "campusign.db"
+# Relative to the server package
+MIGRATIONS = "sql/migrations"
+# How many posts the sweeper deletes in each transaction
+SWEEP_BATCH_SIZE = 64
+AUTO_VACUUM_INCREMENTAL = 2
+# How many free pages the sweeper returns to the file system each time it runs
+VACUUM_PAGES = 1000
+# How often, in seconds, requesting an RSS feed updates when it was last requested,
+# so that displays don't write to the database every time they ask for it
+RSS_REQUEST_RESOLUTION = 60 * 60
 DATABASE_TEST = "campusign.test.db"
+# The maximum number of changes fetch_change_log returns at once
+CHANGE_LOG_LIMIT = 1000
+
+# Applied once to every pooled connection when it is opened
+CONNECTION_PRAGMAS = [
+    "PRAGMA foreign_keys = ON",
+    "PRAGMA journal_mode = WAL",
+    # NORMAL is durable in WAL mode except for the last few commits on power loss
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -8000",  # in KiB, so ~8MB of page cache per connection
+    "PRAGMA mmap_size = 268435456",  # 256MB
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA busy_timeout = 5000",
+]
+
+
+class MeteredCursor(sqlite3.Cursor):
+    """A cursor which counts the queries it runs towards its connection's metrics,
+    see MeteredConnection"""
+
+    def execute(self, *args):
+        start = time.perf_counter()
+        try:
+            return super().execute(*args)
+        finally:
+            self.connection.record_query(start)
+
+    def executemany(self, *args):
+        start = time.perf_counter()
+        try:
+            return super().executemany(*args)
+        finally:
+            self.connection.record_query(start)
+
+
+class MeteredConnection(sqlite3.Connection):
+    """A connection which counts the queries run on it and the time spent running
+    them, for the metrics. Only the time spent executing a query is counted, which
+    includes running it up to its first row but not fetching the rest."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.queries = 0
+        self.query_time = 0.0
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or MeteredCursor)
+
+    def execute(self, *args):
+        # This doesn't go through MeteredCursor.execute, so isn't counted twice
+        start = time.perf_counter()
+        try:
+            return super().execute(*args)
+        finally:
+            self.record_query(start)
+
+    def executemany(self, *args):
+        start = time.perf_counter()
+        try:
+            return super().executemany(*args)
+        finally:
+            self.record_query(start)
+
+    def record_query(self, start: float):
+        """Count a query which started at the given `time.perf_counter()`"""
+        self.queries += 1
+        self.query_time += time.perf_counter() - start
+
+    def reset_metrics(self):
+        """Start counting queries from zero again"""
+        self.queries = 0
+        self.query_time = 0.0
+
+
+class ConnectionPool:
+    """A pool of long-lived SQLite connections to a single database file.
+
+    Connections are configured once when they are opened and then reused across
+    requests, so that they keep a warm page cache. The pool is per-process: if the
+    process forks (e.g. a pre-forking WSGI server) the child starts with an empty
+    pool rather than sharing the parent's connections.
+    """
+
+    def __init__(self, path: str, max_idle: int = 8):
+        self.path = path
+        self.max_idle = max_idle
+        self._pid = os.getpid()
+        # LIFO so that the most recently used (warmest) connection is reused first
+        self._idle = queue.LifoQueue()
+
+    def checkout(self) -> sqlite3.Connection:
+        """Take an idle connection from the pool, opening a new one if none are
+        available"""
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._idle = queue.LifoQueue()
+
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+
+        # Queries are counted for whoever has the connection checked out
+        conn.reset_metrics()
+        return conn
+
+    def checkin(self, conn: sqlite3.Connection):
+        """Return a connection to the pool. Any transaction left open by the
+        request is rolled back first."""
+        if conn.in_transaction:
+            conn.rollback()
+
+        if self._pid == os.getpid() and self._idle.qsize() < self.max_idle:
+            self._idle.put_nowait(conn)
+        else:
+            conn.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path, check_same_thread=False, factory=MeteredConnection
+        )
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+
+_pools: dict[str, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def connection_pool(path: str) -> ConnectionPool:
+    """Get the connection pool for the given database file"""
+    with _pools_lock:
+        pool = _pools.get(path)
+        if pool is None:
+            pool = _pools[path] = ConnectionPool(path)
+        return pool
+
+
+def migrations(path: str) -> list[Tuple[int, str]]:
+    """List the migrations in the given directory as (version, file name), in the
+    order they should be applied"""
+    return sorted(
+        (int(name.split("_", 1)[0]), name)
+        for name in os.listdir(path)
+        if name.endswith(".sql") and name.split("_", 1)[0].isdigit()
+    )
+
+
+def split_sql(script: str) -> list[str]:
+    """Split the given SQL script into its statements, so that they can be run in
+    a transaction, unlike with `executescript`"""
+    statements = []
+    statement = ""
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            statements.append(statement)
+            statement = ""
+    return statements
 
 
 class DatabaseController:
-    def __init__(self, db: sqlite3.Connection):
+    def __init__(
+        self,
+        db: sqlite3.Connection,
+        pool: Optional[ConnectionPool] = None,
+        blobs: Optional[BlobStore] = None,
+    ):
+        """
+        :param blobs: where binary data is stored. If None, binary data is stored
+         inline in the database instead.
+        """
         self.db = db
+        self.pool = pool
+        self.blobs = blobs
+        # The blobs released by the current or last write transaction, which are
+        # deleted once it has committed if nothing references them anymore
+        self.released_blobs: set[str] = set()
 
     @staticmethod
     def get():
-        """Gets the database instance the server uses"""
+        """Gets the database instance the server uses. The connection is checked out
+        of the pool for the lifetime of the app context."""
         db = flask.g.get("_database", None)
         if db is None:
             db_path = (
                 DATABASE if not flask.current_app.config["TESTING"] else DATABASE_TEST
             )
-            conn = sqlite3.connect(db_path)
-            conn.execute("PRAGMA foreign_keys = ON")
-            db = flask.g._database = DatabaseController(conn)
+            pool = connection_pool(db_path)
+            db = flask.g._database = DatabaseController(
+                pool.checkout(), pool, BlobStore.get()
+            )
         return db
 
+    @staticmethod
+    def keep_until_closed(response: flask.Response):
+        """Keep this request's database connection checked out until the given
+        response has been sent, rather than just until the app context ends. This
+        is needed when the response streams data straight out of the database."""
+        db = flask.g.pop("_database", None)
+        if db is not None:
+            response.call_on_close(
+                lambda: db.pool.checkin(db.db) if db.pool else db.db.close()
+            )
+
     @staticmethod
     def teardown():
-        """Close the database connection and remove it from the global cache"""
+        """Check the database connection back into its pool and remove it
+        from the global cache"""
         db = flask.g.pop("_database", None)
         if db is not None:
-            db.db.close()
+            if db.pool is not None:
+                db.pool.checkin(db.db)
+            else:
+                db.db.close()
 
     def create_db(self):
         """Create the database and run setup SQL"""
@@ -65,10 +304,19 @@ class DatabaseController:
         if app.config["TESTING"]:
             with app.open_resource("sql/drop_tables.sql", mode="r") as f:
                 self.db.cursor().executescript(f.read())
+            if self.blobs:
+                self.blobs.clear()
+
+        # New databases keep track of their free pages, so that the sweeper can
+        # return them to the file system. This has no effect on databases which
+        # already have tables; see `enable_incremental_vacuum`.
+        self.db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self._add_blob_hash_columns()
 
         # Create necessary tables
         with app.open_resource("sql/schema.sql", mode="r") as f:
             self.db.cursor().executescript(f.read())
+        self._migrate()
 
         if len(self.fetch_all_departments()) == 0:
             with app.open_resource("sql/add_default_data.sql", mode="r") as f:
@@ -78,6 +326,11 @@ class DatabaseController:
         self.db.cursor().executescript(
             "DELETE FROM templates WHERE id LIKE 'builtin%';"
         )
+        PageTemplate.invalidate_all()
+        Display.invalidate_all_rendered()
+        User.invalidate_all_cached()
+        Person.invalidate_all_cached_department_people()
+        invalidation.reset()
 
         path_prefix = "" if os.getcwd().endswith("frontend") else "frontend/"
         for path in os.scandir(f"{path_prefix}templates/layouts"):
@@ -87,76 +340,331 @@ class DatabaseController:
             with open(path) as f:
                 self.add_page_template(f"builtin/{path.name}", f.read())
 
-    def post_content(self, content: FreeFormContent) -> (int, int):
-        """Insert the given FreeFormContent and returns the inserted row id"""
-        assert content.posted is None, (
-            "FreeFormContent.posted should only be set in"
-            "DatabaseController.post_content"
+    def enable_incremental_vacuum(self) -> bool:
+        """Rebuild the database so that it keeps track of its free pages, returning
+        whether it had to be. This takes a while for a large database, and blocks
+        every other connection while it runs, so it is only done on request rather
+        than whenever the server starts."""
+        if (
+            self.db.execute("PRAGMA auto_vacuum").fetchone()[0]
+            == AUTO_VACUUM_INCREMENTAL
+        ):
+            return False
+
+        self.db.commit()
+        self.db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self.db.execute("VACUUM")
+        return True
+
+    def _migrate(self):
+        """Apply the migrations in sql/migrations which haven't been applied to the
+        database yet. Migrations are named `<version>_<description>.sql` and are
+        applied in order of version, each in its own transaction. The latest version
+        applied is kept in the schema_version table."""
+        app = flask.current_app
+        cursor = self.db.cursor()
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)"
+        )
+        cursor.execute(
+            "INSERT INTO schema_version (version)"
+            " SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM schema_version)"
         )
+        self.db.commit()
+
+        for version, name in migrations(os.path.join(app.root_path, MIGRATIONS)):
+            with self.db:
+                cursor.execute("BEGIN IMMEDIATE")
+
+                # Another process may have applied it while this one was waiting
+                (current_version,) = cursor.execute(
+                    "SELECT version FROM schema_version"
+                ).fetchone()
+                if version <= current_version:
+                    continue
+
+                with app.open_resource(f"{MIGRATIONS}/{name}", mode="r") as f:
+                    for statement in split_sql(f.read()):
+                        cursor.execute(statement)
+                cursor.execute("UPDATE schema_version SET version = ?", (version,))
+
+    def _add_blob_hash_columns(self):
+        """Add the blob hash columns to tables created before the blob store
+        existed. Tables which do not exist yet are left to schema.sql."""
+        cursor = self.db.cursor()
+        for table, column, _ in BLOB_HASH_COLUMNS:
+            # SAFETY: this string substitution is okay since we don't use user data
+            # here thus preventin SQL injections
+            columns = [row[1] for row in cursor.execute(f"PRAGMA table_info({table})")]
+            if columns and column not in columns:
+                cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} TEXT")
+
+    def _begin_write(self):
+        """Begin a write transaction straight away rather than at the first write.
+        Blobs are written to and deleted from the blob store while holding the
+        write lock, so that a blob can't be deleted as unreferenced while another
+        transaction is about to reference it."""
+        if not self.db.in_transaction:
+            self.db.execute("BEGIN IMMEDIATE")
+            # Whichever way the last transaction ended, whatever it released can be
+            # checked now
+            self._delete_unreferenced_blobs()
+
+    def _store_blob(self, data: bytes) -> Tuple[bytes, Optional[str]]:
+        """Put the given data in the blob store if there is one. Returns the data to
+        store inline in the database and the blob hash. Must be called within
+        a transaction started by `_begin_write`."""
+        if self.blobs is None or not data:
+            return data, None
+        return b"", self.blobs.put(data)
+
+    def _release_blobs(self, blob_hashes):
+        """Note that the given blobs may no longer be referenced. They are deleted
+        from the blob store by `_delete_released_blobs` once the transaction has
+        committed, if nothing references them anymore, so that they aren't lost if
+        it rolls back instead. Must be called within a transaction started by
+        `_begin_write`."""
+        if self.blobs is not None:
+            self.released_blobs.update(
+                blob_hash for blob_hash in blob_hashes if blob_hash
+            )
 
-        post_timestamp = int(time.time())
+    def _delete_released_blobs(self):
+        """Delete the blobs released by the last write transaction which nothing
+        references anymore. This takes the write lock again, so that no other
+        transaction can reference them in the meantime. Must be called after the
+        transaction has ended."""
+        if self.released_blobs:
+            with self.db:
+                self._begin_write()
+
+    def _delete_unreferenced_blobs(self):
+        cursor = self.db.cursor()
+        for blob_hash in self.released_blobs:
+            if not self._blob_is_referenced(cursor, blob_hash):
+                self.blobs.delete(blob_hash)
+        self.released_blobs.clear()
 
-        (mime, blob) = (
-            (content.mime_type, content.blob)
-            if isinstance(content, BinaryContent)
-            else (None, None)
+    @staticmethod
+    def _blob_is_referenced(cursor: sqlite3.Cursor, blob_hash: str) -> bool:
+        # SAFETY: this string substitution is okay since we don't use user data here
+        # thus preventin SQL injections
+        return any(
+            cursor.execute(
+                f"SELECT 1 FROM {table} WHERE {column} = ? LIMIT 1", (blob_hash,)
+            ).fetchone()
+            for table, column, _ in BLOB_HASH_COLUMNS
+        )
+
+    def _load_blob(self, data: bytes, blob_hash: Optional[str]) -> bytes:
+        """Get the actual data of a blob which may be in the blob store"""
+        return self.blobs.read(blob_hash) if blob_hash else data
+
+    def migrate_blobs_to_store(self, batch_size=16) -> int:
+        """Move all binary data stored inline in the database into the blob store,
+        returning how many blobs were moved. Rows are moved in batches of
+        `batch_size`, each in its own transaction, so that the write lock is never
+        held for long."""
+        assert self.blobs is not None, "there must be a blob store to migrate to"
+        moved = 0
+
+        for table, hash_column, data_column in BLOB_HASH_COLUMNS:
+            while data_column:
+                with self.db:
+                    self._begin_write()
+                    cursor = self.db.cursor()
+
+                    # SAFETY: this string substitution is okay since we don't use
+                    # user data here thus preventin SQL injections
+                    rows = cursor.execute(
+                        f"SELECT rowid, {data_column} FROM {table}"
+                        f" WHERE {hash_column} IS NULL AND length({data_column}) > 0"
+                        " LIMIT ?",
+                        (batch_size,),
+                    ).fetchall()
+
+                    for rowid, data in rows:
+                        self._move_blob_to_store(
+                            cursor, table, hash_column, data_column, rowid, data
+                        )
+
+                moved += len(rows)
+                if len(rows) < batch_size:
+                    break
+
+        return moved
+
+    def _move_blob_to_store(
+        self,
+        cursor: sqlite3.Cursor,
+        table: str,
+        hash_column: str,
+        data_column: str,
+        rowid: int,
+        data: Union[bytes, str],
+    ) -> str:
+        """Move the given blob stored inline in the given row into the blob store,
+        returning its hash. Must be called within a transaction started by
+        `_begin_write`."""
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        (data, blob_hash) = self._store_blob(data)
+
+        # SAFETY: this string substitution is okay since we don't use user data here
+        # thus preventin SQL injections
+        cursor.execute(
+            f"UPDATE {table} SET {data_column} = ?, {hash_column} = ? WHERE rowid = ?",
+            (data, blob_hash, rowid),
         )
+        return blob_hash
+
+    def post_content(self, content: FreeFormContent) -> (int, int):
+        """Insert the given FreeFormContent and returns the inserted row id"""
+        return self.post_contents([content])[0]
+
+    def post_contents(self, contents: list[FreeFormContent]) -> list[Tuple[int, int]]:
+        """Insert all the given FreeFormContent in a single transaction, returning
+        the row id and post time of each"""
+        for content in contents:
+            assert content.posted is None, (
+                "FreeFormContent.posted should only be set in"
+                "DatabaseController.post_contents"
+            )
+
+        post_timestamp = int(time.time())
+        posted = []
 
         with self.db:
+            self._begin_write()
             cursor = self.db.cursor()
-            cursor.execute(
-                "INSERT INTO content "
-                "(posted, content_type, content_json,"
-                " blob_mime_type, content_blob)"
-                " VALUES (?, ?, ?, ?, ?)",
-                (
-                    post_timestamp,
-                    content.type(),
-                    json.dumps(content.to_db_json()),
-                    mime,
-                    blob,
-                ),
-            )
 
-            content_id = cursor.lastrowid
+            for content in contents:
+                (mime, blob) = (
+                    (content.mime_type, content.blob)
+                    if isinstance(content, BinaryContent)
+                    else (None, None)
+                )
+                (blob, blob_hash) = self._store_blob(blob)
 
-            for stream in content.streams:
                 cursor.execute(
-                    "INSERT INTO content_stream_membership (stream, content)"
-                    " VALUES (?, ?)",
-                    (stream, content_id),
+                    "INSERT INTO content "
+                    "(posted, content_type, content_json,"
+                    " blob_mime_type, content_blob, blob_hash, expires_at)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        post_timestamp,
+                        content.type(),
+                        json.dumps(content.to_db_json()),
+                        mime,
+                        blob,
+                        blob_hash,
+                        (
+                            int(content.expires_at.timestamp())
+                            if content.expires_at
+                            else None
+                        ),
+                    ),
                 )
+                posted.append((cursor.lastrowid, post_timestamp))
+
+            cursor.executemany(
+                "INSERT INTO content_stream_membership (stream, content, posted)"
+                " VALUES (?, ?, ?)",
+                (
+                    (stream, content_id, post_timestamp)
+                    for content, (content_id, _) in zip(contents, posted)
+                    for stream in content.streams
+                ),
+            )
 
-        return content_id, post_timestamp
+        content_changed.notify()
+        return posted
 
     def fetch_content_in_streams(
-        self, streams: list[int], limit=None, fetch_blob=False
+        self,
+        streams: list[int],
+        limit=None,
+        fetch_blob=False,
+        content_ids: Optional[list[int]] = None,
+        before: Optional[Tuple[int, int]] = None,
+        after: Optional[Tuple[int, int]] = None,
     ) -> list[FreeFormContent]:
-        """Fetch all content in the given streams. By default, the blobs
-        will not be fetched from the database."""
+        """Fetch all content in the given streams which hasn't expired, newest
+        first. By default, the blobs will not be fetched from the database. If
+        `content_ids` is given, only content with those IDs is fetched.
+
+        Content can be fetched a page at a time by passing the (posted, id) of the
+        oldest post on the last page as `before`, or of the newest post as `after`.
+        With `after`, the `limit` posts immediately after it are fetched."""
         cursor = self.db.cursor()
         cursor.row_factory = free_form_content.from_sql
-        with_blob = ", content_blob" if fetch_blob else ""
-        with_limit = f"LIMIT {limit}" if limit else ""
+        with_blob = ", content_blob, blob_hash" if fetch_blob else ""
+        with_limit = "LIMIT ?" if limit else ""
+        with_ids = (
+            f"AND content.id IN ({ ','.join(['?'] * len(content_ids)) }) "
+            if content_ids is not None
+            else ""
+        )
+        with_before = (
+            "AND (membership.posted, membership.content) < (?, ?) " if before else ""
+        )
+        with_after = (
+            "AND (membership.posted, membership.content) > (?, ?) " if after else ""
+        )
+        # The posts right after `after` are the oldest ones newer than it
+        order = "ASC" if after else "DESC"
 
+        # Each stream's newest posts are found by walking its end of
+        # content_stream_membership_by_posted, so only as many posts as are returned
+        # from each stream need to be looked at, however sparse the stream is. The
+        # posts from all the streams are then merged and sorted.
         # SAFETY: this string substitution is okay since we don't use user data here
         # thus preventin SQL injections
-        return list(
+        probe = (
+            "SELECT * FROM (SELECT membership.content"
+            " FROM content_stream_membership AS membership"
+            " INNER JOIN content ON content.id = membership.content"
+            " WHERE membership.stream = ?"
+            " AND (expires_at IS NULL OR expires_at > ?) "
+            f"{with_ids}{with_before}{with_after}"
+            f"ORDER BY membership.posted {order}, membership.content {order} "
+            f"{with_limit})"
+        )
+        probe_params = [
+            int(time.time()),
+            *(content_ids or []),
+            *(before or []),
+            *(after or []),
+            *([limit] if limit else []),
+        ]
+        posts = list(
             cursor.execute(
                 "SELECT "
-                f"id, stream, posted, content_type, content_json,"
+                f"id, posted, expires_at, content_type, content_json,"
                 f" blob_mime_type {with_blob} "
                 "FROM content "
-                "INNER JOIN content_stream_membership"
-                " ON content_stream_membership.content = content.id "
-                f"WHERE content_stream_membership.stream "
-                f"IN ({ ','.join(['?'] * len(streams)) }) "
-                "GROUP BY id "
-                "ORDER BY posted DESC "
+                f"WHERE id IN ({' UNION ALL '.join([probe] * len(streams))}) "
+                f"ORDER BY posted {order}, id {order} "
                 f"{with_limit}",
-                streams,
+                [
+                    *(param for stream in streams for param in (stream, *probe_params)),
+                    *([limit] if limit else []),
+                ],
             )
         )
+        if after:
+            posts.reverse()
+
+        if fetch_blob:
+            for post in posts:
+                self._load_content_blob(post)
+
+        return posts
+
+    def _load_content_blob(self, post: Optional[FreeFormContent]):
+        """Load the blob of the given content from the blob store, if it is there"""
+        if isinstance(post, BinaryContent) and post.blob_hash:
+            post.blob = self._load_blob(post.blob, post.blob_hash)
 
     def fetch_content_by_id(
         self, content_id: int, fetch_blob=False
@@ -165,11 +673,11 @@ class DatabaseController:
         will not be fetched from the database."""
         cursor = self.db.cursor()
         cursor.row_factory = free_form_content.from_sql
-        with_blob = ", content_blob" if fetch_blob else ""
+        with_blob = ", content_blob, blob_hash" if fetch_blob else ""
 
         # SAFETY: this string substitution is okay since we don't use user data here
         # thus preventin SQL injections
-        return next(
+        post = next(
             cursor.execute(
                 "SELECT "
                 f"id, posted, content_type, content_json,"
@@ -181,12 +689,361 @@ class DatabaseController:
             None,
         )
 
+        if fetch_blob:
+            self._load_content_blob(post)
+
+        return post
+
+    def open_content_blob(
+        self,
+        content_id: int,
+        width: Optional[int] = None,
+        mime_types: Optional[list[str]] = None,
+    ) -> Optional[Tuple[str, OpenBlob]]:
+        """Open the blob of the given content for reading, returning it along with
+        its MIME type. The blob is either the path of the blob in the blob store or,
+        if it is stored inline, a handle for incremental reading. Returns None if
+        the content has no blob.
+
+        If a width or any MIME types the client prefers are given, the best
+        variant of the blob for them is opened instead, if it has any. See
+        `image_variants.choose_variant`."""
+        row = (
+            self.db.cursor()
+            .execute(
+                "SELECT blob_mime_type, blob_hash FROM content"
+                " WHERE id = ? AND content_blob IS NOT NULL",
+                (content_id,),
+            )
+            .fetchone()
+        )
+        if not row:
+            return None
+
+        if width is not None or mime_types:
+            variant = choose_variant(
+                self.fetch_content_variants(content_id),
+                width,
+                [*(mime_types or []), row[0]],
+            )
+            if variant:
+                (_, mime_type, blob_hash) = variant
+                return mime_type, self.blobs.path(blob_hash)
+
+        return row[0], self._open_blob("content", "content_blob", content_id, row[1])
+
+    def add_content_variants(
+        self, content_id: int, variants: list[Tuple[int, str, bytes]]
+    ):
+        """Store the given (width, MIME type, data) variants of the blob of the
+        given content. Variants are only kept if there is a blob store."""
+        if self.blobs is None:
+            return
+
+        with self.db:
+            self._begin_write()
+            cursor = self.db.cursor()
+            old_hashes = cursor.execute(
+                "SELECT blob_hash FROM content_variants WHERE content = ?",
+                (content_id,),
+            ).fetchall()
+            cursor.execute(
+                "DELETE FROM content_variants WHERE content = ?", (content_id,)
+            )
+            cursor.executemany(
+                "INSERT INTO content_variants (content, width, mime_type, blob_hash)"
+                " VALUES (?, ?, ?, ?)",
+                (
+                    (content_id, width, mime_type, self.blobs.put(data))
+                    for (width, mime_type, data) in variants
+                ),
+            )
+            self._release_blobs(blob_hash for (blob_hash,) in old_hashes)
+        self._delete_released_blobs()
+
+    def fetch_content_variants(self, content_id: int) -> list[Tuple[int, str, str]]:
+        """Fetch the (width, MIME type, hash) of each variant of the blob of the
+        given content"""
+        return (
+            self.db.cursor()
+            .execute(
+                "SELECT width, mime_type, blob_hash FROM content_variants"
+                " WHERE content = ?",
+                (content_id,),
+            )
+            .fetchall()
+        )
+
+    def fetch_local_images_without_variants(self) -> list[int]:
+        """Fetch the IDs of all local images which have no variants yet"""
+        return [
+            content_id
+            for (content_id,) in self.db.cursor().execute(
+                "SELECT id FROM content WHERE content_type = 'local_image'"
+                " AND NOT EXISTS"
+                " (SELECT 1 FROM content_variants WHERE content = content.id)"
+            )
+        ]
+
+    def _open_blob(
+        self, table: str, column: str, rowid: int, blob_hash: Optional[str]
+    ) -> OpenBlob:
+        if not blob_hash and self.blobs is not None:
+            blob_hash = self._move_inline_blob_to_store(table, column, rowid)
+        if blob_hash:
+            return self.blobs.path(blob_hash)
+        if hasattr(self.db, "blobopen"):
+            return self.db.blobopen(table, column, rowid, readonly=True)
+
+        # SAFETY: this string substitution is okay since the table and column are
+        # never given by users
+        return (
+            self.db.cursor()
+            .execute(f"SELECT {column} FROM {table} WHERE rowid = ?", (rowid,))
+            .fetchone()[0]
+        )
+
+    def _move_inline_blob_to_store(
+        self, table: str, column: str, rowid: int
+    ) -> Optional[str]:
+        """Move the blob in the given row into the blob store the first time it is
+        opened, if it is still stored inline and isn't empty, returning its hash.
+        This way it is only ever hashed once, rather than on every request for it."""
+        with self.db:
+            self._begin_write()
+            cursor = self.db.cursor()
+            hash_column = next(
+                hash_column
+                for blob_table, hash_column, data_column in BLOB_HASH_COLUMNS
+                if blob_table == table and data_column == column
+            )
+
+            # SAFETY: this string substitution is okay since the table and column are
+            # never given by users
+            row = cursor.execute(
+                f"SELECT {column}, {hash_column} FROM {table} WHERE rowid = ?",
+                (rowid,),
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1]:
+                # Another request moved it in the meantime
+                return row[1]
+            if not row[0]:
+                return None
+            return self._move_blob_to_store(
+                cursor, table, hash_column, column, rowid, row[0]
+            )
+
     def delete_content_by_id(self, content_id: int, fetch_blob=False) -> bool:
         """Delete a given piece of content from the database."""
         with self.db:
-            cursor = self.db.cursor()
-            cursor.execute("DELETE FROM content WHERE id = ?", (content_id,))
-            return cursor.rowcount == 1
+            self._begin_write()
+            deleted = self._delete_contents([content_id])
+        self._delete_released_blobs()
+
+        content_changed.notify()
+        return deleted == 1
+
+    def _delete_contents(self, content_ids: list[int]) -> int:
+        """Delete the given content and release its blobs, returning how many
+        pieces of content were deleted. Must be called within a transaction started
+        by `_begin_write`."""
+        if not content_ids:
+            return 0
+
+        cursor = self.db.cursor()
+        # SAFETY: this string substitution is okay since it only adds placeholders
+        # thus preventin SQL injections
+        placeholders = ", ".join("?" * len(content_ids))
+
+        # Variants are removed by the cascade, so note which blobs they used
+        variant_hashes = cursor.execute(
+            f"SELECT blob_hash FROM content_variants WHERE content IN ({placeholders})",
+            content_ids,
+        ).fetchall()
+        cursor.execute(
+            f"DELETE FROM content WHERE id IN ({placeholders}) RETURNING blob_hash",
+            content_ids,
+        )
+        deleted = cursor.fetchall()
+        self._release_blobs(blob_hash for (blob_hash,) in [*deleted, *variant_hashes])
+        return len(deleted)
+
+    def sweep_content(self, batch_size=SWEEP_BATCH_SIZE) -> int:
+        """Delete expired content, and remove content from streams which it is
+        beyond the retention policy of, returning how many posts were affected.
+        Content which is no longer in any stream because of this is deleted.
+
+        Work is done `batch_size` posts at a time, each batch in its own
+        transaction, so that the write lock is never held for long. Afterwards, the
+        freed pages are returned to the file system."""
+        now = int(time.time())
+        swept = 0
+
+        while True:
+            with self.db:
+                self._begin_write()
+                expired = [
+                    content_id
+                    for (content_id,) in self.db.execute(
+                        "SELECT id FROM content WHERE expires_at <= ? LIMIT ?",
+                        (now, batch_size),
+                    )
+                ]
+                swept += self._delete_contents(expired)
+            self._delete_released_blobs()
+            if len(expired) < batch_size:
+                break
+
+        retained_streams = self.db.execute(
+            "SELECT id, retain_count, retain_seconds FROM content_streams"
+            " WHERE retain_count IS NOT NULL OR retain_seconds IS NOT NULL"
+        ).fetchall()
+        for stream_id, retain_count, retain_seconds in retained_streams:
+            if retain_count is not None:
+                # Everything but the newest `retain_count` posts
+                swept += self._remove_from_stream_while(
+                    stream_id,
+                    "ORDER BY content.posted DESC, content.id DESC LIMIT ? OFFSET ?",
+                    (batch_size, retain_count),
+                    batch_size,
+                )
+            if retain_seconds is not None:
+                swept += self._remove_from_stream_while(
+                    stream_id,
+                    "AND content.posted < ? LIMIT ?",
+                    (now - retain_seconds, batch_size),
+                    batch_size,
+                )
+
+        if swept:
+            content_changed.notify()
+
+        self.db.execute(f"PRAGMA incremental_vacuum({VACUUM_PAGES})").fetchall()
+        return swept
+
+    def _remove_from_stream_while(
+        self, stream_id: int, condition: str, params: tuple, batch_size: int
+    ) -> int:
+        """Remove the content in the given stream selected by the given SQL
+        condition from it, a batch at a time, until no more is selected. Content
+        which is left in no stream is deleted."""
+        removed = 0
+        while True:
+            with self.db:
+                self._begin_write()
+                cursor = self.db.cursor()
+
+                # SAFETY: this string substitution is okay since we don't use user
+                # data here thus preventin SQL injections
+                content_ids = [
+                    content_id
+                    for (content_id,) in cursor.execute(
+                        "SELECT content FROM content_stream_membership"
+                        " INNER JOIN content"
+                        " ON content.id = content_stream_membership.content"
+                        f" WHERE stream = ? {condition}",
+                        (stream_id, *params),
+                    )
+                ]
+                placeholders = ", ".join("?" * len(content_ids))
+                cursor.execute(
+                    "DELETE FROM content_stream_membership"
+                    f" WHERE stream = ? AND content IN ({placeholders})",
+                    (stream_id, *content_ids),
+                )
+                orphans = [
+                    content_id
+                    for (content_id,) in cursor.execute(
+                        f"SELECT id FROM content WHERE id IN ({placeholders})"
+                        " AND NOT EXISTS (SELECT 1 FROM content_stream_membership"
+                        " WHERE content = content.id)",
+                        content_ids,
+                    )
+                ]
+                self._delete_contents(orphans)
+            self._delete_released_blobs()
+
+            removed += len(content_ids)
+            if len(content_ids) < batch_size:
+                return removed
+
+    def fetch_content_events(
+        self, streams: list[int], after: int = 0, limit: int = 100
+    ) -> list[Tuple[int, int, int, str]]:
+        """Fetch the content events in the given streams which happened after the
+        given sequence number of the change log, oldest first. Each event is a tuple
+        of (sequence number, stream id, content id, event) where event is either
+        'posted' or 'deleted'. These are the change log's changes to
+        content_stream_membership, found by stream with change_log_by_stream."""
+        streams = [int(stream) for stream in streams]
+        cursor = self.db.cursor()
+
+        # SAFETY: this string substitution is okay since it only adds placeholders
+        # thus preventin SQL injections
+        return list(
+            cursor.execute(
+                "SELECT seq, CAST(row_key AS INTEGER),"
+                " CAST(substr(row_key, instr(row_key, ':') + 1) AS INTEGER),"
+                " iif(operation = 'insert', 'posted', 'deleted')"
+                " FROM change_log"
+                " WHERE table_name = 'content_stream_membership'"
+                f" AND CAST(row_key AS INTEGER) IN ({ ','.join(['?'] * len(streams)) })"
+                " AND operation IN ('insert', 'delete')"
+                " AND seq > ?"
+                " ORDER BY seq"
+                " LIMIT ?",
+                [*streams, after, limit],
+            )
+        )
+
+    def fetch_content_version(self, streams: list[int]) -> int:
+        """Fetch a version number for the content in the given streams. This is the
+        sequence number of the latest change to any of the streams in the change
+        log, so it changes whenever content is posted to or deleted from them. It
+        only touches change_log_by_stream, not the content table.
+
+        Once a stream's changes have been trimmed from the log, its version is the
+        latest sequence number trimmed instead, so that versions never go back to
+        one an earlier state of the streams had."""
+        cursor = self.db.cursor()
+        (trimmed,) = cursor.execute(
+            "SELECT IFNULL(MIN(seq), 1) - 1 FROM change_log"
+        ).fetchone()
+        versions = [trimmed]
+        for stream in {int(stream) for stream in streams}:
+            versions.append(
+                cursor.execute(
+                    "SELECT IFNULL(MAX(seq), 0) FROM change_log"
+                    " WHERE table_name = 'content_stream_membership'"
+                    " AND CAST(row_key AS INTEGER) = ?",
+                    (stream,),
+                ).fetchone()[0]
+            )
+        return max(versions)
+
+    def fetch_content_last_expiry(self, streams: list[int]) -> int:
+        """Fetch when the most recently expired content in the given streams which
+        hasn't been swept yet expired, as a Unix timestamp, or 0 if there is none.
+        Content stops being fetched as soon as it expires, but only counts as
+        deleted once it is swept, so this changes in between. Only content which
+        has expired since the last sweep is looked at, using content_by_expiry."""
+        # SAFETY: this string substitution is okay since it only adds placeholders
+        # thus preventin SQL injections
+        placeholders = ", ".join("?" * len(streams))
+        return (
+            self.db.cursor()
+            .execute(
+                "SELECT IFNULL(MAX(expires_at), 0) FROM content"
+                " WHERE expires_at <= ?"
+                " AND EXISTS (SELECT 1 FROM content_stream_membership"
+                " WHERE content = content.id"
+                f" AND stream IN ({placeholders}))",
+                (int(time.time()), *streams),
+            )
+            .fetchone()[0]
+        )
 
     def create_department(self, department: Department, insert_people=False) -> int:
         """Create a department and return its row id. If `insert_people` is `True`,
@@ -273,7 +1130,7 @@ class DatabaseController:
                 cursor.execute(
                     "SELECT id, department, title, "
                     "full_name, position, office_hours,"
-                    "office_location, email, phone, mime_type FROM people "
+                    "office_location, email, phone, mime_type, image_hash FROM people "
                     " WHERE department = ?"
                     " ORDER BY id",
                     (department_id,),
@@ -302,9 +1159,9 @@ class DatabaseController:
         with self.db:
             cursor = self.db.cursor()
             cursor.execute(
-                "INSERT INTO displays (name, department, pages_json)"
-                " VALUES ('', ?, '')",
-                (department_id,),
+                "INSERT INTO displays (name, department, pages_json, token_secret)"
+                " VALUES ('', ?, '', ?)",
+                (department_id, secrets.token_hex(16)),
             )
         return cursor.lastrowid
 
@@ -317,10 +1174,19 @@ class DatabaseController:
 
         with self.db:
             cursor = self.db.cursor()
+            # Editing a display keeps its token secret, so its tokens stay valid
             cursor.execute(
-                "REPLACE INTO displays (id, name, department, pages_json)"
-                " VALUES (?, ?, ?, ?)",
-                (display.id, display.name, department_id, json.dumps(display.pages)),
+                "REPLACE INTO displays (id, name, department, pages_json, token_secret)"
+                " VALUES (?, ?, ?, ?,"
+                " COALESCE((SELECT token_secret FROM displays WHERE id = ?), ?))",
+                (
+                    display.id,
+                    display.name,
+                    department_id,
+                    json.dumps(display.pages),
+                    display.id,
+                    secrets.token_hex(16),
+                ),
             )
 
             # This is a new display, so create its content stream
@@ -334,6 +1200,7 @@ class DatabaseController:
                     )
                 )
 
+        Display.invalidate_rendered(cursor.lastrowid)
         return cursor.lastrowid
 
     def delete_display(self, department_id: int, display_id: int) -> bool:
@@ -342,10 +1209,12 @@ class DatabaseController:
             cursor = self.db.cursor()
             cursor.execute("DELETE FROM displays WHERE id = ?", (display_id,))
             self.delete_files_for_display(department_id, display_id)
+        Display.invalidate_rendered(display_id)
         return cursor.rowcount == 1
 
     def delete_files_for_display(self, department_id: int, display_id: int):
         with self.db:
+            self._begin_write()
             cursor = self.db.cursor()
 
             # SAFETY: this string substitution is ok since display_id is an int
@@ -353,9 +1222,13 @@ class DatabaseController:
             assert isinstance(display_id, int)
             cursor.execute(
                 f"DELETE FROM files WHERE department_id = ?"
-                f" AND filename LIKE '_group-{ display_id }-%'",
+                f" AND filename LIKE '_group-{ display_id }-%'"
+                f" RETURNING file_hash",
                 (department_id,),
             )
+            self._release_blobs(file_hash for (file_hash,) in cursor.fetchall())
+        self._delete_released_blobs()
+        Display.invalidate_rendered_in_department(department_id)
 
     def fetch_all_displays_in_dept(self, department_id: int) -> list[Display]:
         """Fetch all display groups from the database"""
@@ -384,6 +1257,54 @@ class DatabaseController:
 
         return display
 
+    def fetch_display_token_secret(self, display_id: int) -> Optional[tuple[int, str]]:
+        """Fetch the department of the given display along with the secret its
+        tokens are signed with, or None if there is no such display. Secrets are
+        made along with their displays, so this only ever reads."""
+        return self.db.execute(
+            "SELECT department, token_secret FROM displays"
+            " WHERE id = ? AND token_secret IS NOT NULL",
+            (display_id,),
+        ).fetchone()
+
+    def reset_display_token_secret(self, department_id: int, display_id: int) -> bool:
+        """Give the given display a new token secret, revoking all of its tokens.
+        Returns whether the display exists in the given department."""
+        with self.db:
+            return (
+                self.db.execute(
+                    "UPDATE displays SET token_secret = ?"
+                    " WHERE id = ? AND department = ?",
+                    (secrets.token_hex(16), display_id, department_id),
+                ).rowcount
+                == 1
+            )
+
+    def can_display_read_streams(
+        self, department_id: int, display_id: int, streams: list[int | str]
+    ) -> bool:
+        """Whether the given display of the given department may read all of the
+        given content streams. Displays may read streams which aren't private, their
+        department's private streams and their own stream, but not the streams of
+        other displays."""
+        try:
+            stream_ids = {int(stream) for stream in streams}
+        except ValueError:
+            return False
+        if not stream_ids:
+            return True
+
+        # SAFETY: this string substitution is okay since it only adds placeholders
+        # thus preventin SQL injections
+        placeholders = ", ".join("?" * len(stream_ids))
+        (readable,) = self.db.execute(
+            "SELECT COUNT(*) FROM content_streams"
+            f" WHERE id IN ({placeholders}) AND (permissions != 'private'"
+            " OR (department = ? AND (display IS NULL OR display = ?)))",
+            (*stream_ids, department_id, display_id),
+        ).fetchone()
+        return readable == len(stream_ids)
+
     def fetch_content_stream_for_display(
         self, display_id: int
     ) -> Optional[ContentStream]:
@@ -400,66 +1321,148 @@ class DatabaseController:
             None,
         )
 
-    def upsert_person(self, person: Person, department_id: int) -> int:
+    def fetch_department_people_json(
+        self, department_id: int
+    ) -> Optional[tuple[bytes, str]]:
+        """Fetch the people in the given department serialized for the HTTP API,
+        along with an ETag for them, or None if there is no such department.
+
+        The serialized people are cached until anyone in the department is added,
+        changed or removed by any process, see `server.invalidation`."""
+        cached = Person.fetch_cached_department_people(department_id)
+        if cached is not None:
+            return cached
+
+        department = self.fetch_department_by_id(department_id, fetch_people=True)
+        if not department:
+            return None
+        return Person.cache_department_people(department_id, department.people)
+
+    def upsert_person(self, person: Person, department_id: int) -> Optional[int]:
         """Insert (or update) the given person into the database
         in the given department and returns the inserted row id"""
 
         with self.db:
+            self._begin_write()
             cursor = self.db.cursor()
-            cursor.execute("SELECT COUNT(*) FROM people WHERE id = ?", (person.id,))
-            count = cursor.fetchone()[0]  # Fetch the count result
-            existing_data = count > 0
-            print("test 1")
-            if existing_data and person.mime_type == "":
-                print("test 2")
-                cursor.execute(
-                    "UPDATE people SET "
-                    "title=?, full_name=?, position=?, "
-                    "office_hours=?, office_location=?, email=?, phone=? "
-                    "WHERE id = ?",
-                    (
-                        person.title,
-                        person.name,
-                        person.position,
-                        person.office_hours,
-                        person.office_location,
-                        person.email,
-                        person.phone,
-                        person.id,
-                    ),
-                )
-                return person.id
-            else:
-                print("test 3")
+            old_image_hashes = self._fetch_replaced_image_hashes(cursor, [person])
+            row = cursor.execute(
+                UPSERT_PERSON + " RETURNING id",
+                self._person_to_sql(person, department_id),
+            ).fetchone()
+            self._release_blobs(old_image_hashes)
+        self._delete_released_blobs()
+
+        return row[0] if row else None
+
+    def upsert_people(
+        self, people: Iterable[Person], department_id: int
+    ) -> Tuple[int, list[int]]:
+        """Insert (or update) all the given people into the database in the given
+        department at once. Returns how many were, along with the IDs of any which
+        were skipped since those IDs belong to people in other departments.
+
+        The people are all read before the write lock is taken, so that reading
+        them (such as from an uploaded table) doesn't hold it. Their images are
+        then written to the blob store along with the people, in a single
+        transaction."""
+        people = list(people)
+        with self.db:
+            self._begin_write()
+            cursor = self.db.cursor()
+            skipped = self._fetch_ids_in_other_departments(
+                cursor, people, department_id
+            )
+            people = [person for person in people if person.id not in skipped]
+            old_image_hashes = self._fetch_replaced_image_hashes(cursor, people)
+            for person in people:
                 cursor.execute(
-                    "REPLACE INTO people "
-                    "(id, department, title, full_name, mime_type, image_data,"
-                    " position, office_hours, office_location, email, phone)"
-                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                    (
-                        person.id,
-                        department_id,
-                        person.title,
-                        person.name,
-                        person.mime_type,
-                        person.image_data,
-                        person.position,
-                        person.office_hours,
-                        person.office_location,
-                        person.email,
-                        person.phone,
-                    ),
+                    UPSERT_PERSON, self._person_to_sql(person, department_id)
                 )
+                # Keep each image in memory only as long as it is needed
+                person.image_data = ""
+            self._release_blobs(old_image_hashes)
+        self._delete_released_blobs()
+
+        return len(people), sorted(skipped)
+
+    def _person_to_sql(self, person: Person, department_id: int) -> tuple:
+        """The parameters of `UPSERT_PERSON` for the given person, storing their
+        image in the blob store"""
+        (image_data, image_hash) = self._store_blob(person.image_data)
+        return (
+            person.id,
+            department_id,
+            person.title,
+            person.name,
+            person.mime_type,
+            image_data,
+            image_hash,
+            person.position,
+            person.office_hours,
+            person.office_location,
+            person.email,
+            person.phone,
+        )
 
-        return cursor.lastrowid
+    @staticmethod
+    def _fetch_ids_in_other_departments(
+        cursor: sqlite3.Cursor, people: list[Person], department_id: int
+    ) -> set[int]:
+        """Fetch the IDs of the given people which belong to people in departments
+        other than the given one"""
+        person_ids = [person.id for person in people if person.id is not None]
+        if not person_ids:
+            return set()
+
+        # SAFETY: this string substitution is okay since it only adds placeholders
+        # thus preventin SQL injections
+        placeholders = ", ".join("?" * len(person_ids))
+        return {
+            person_id
+            for (person_id,) in cursor.execute(
+                f"SELECT id FROM people WHERE id IN ({placeholders})"
+                " AND department != ?",
+                (*person_ids, department_id),
+            )
+        }
+
+    @staticmethod
+    def _fetch_replaced_image_hashes(
+        cursor: sqlite3.Cursor, people: list[Person]
+    ) -> list[str]:
+        """Fetch the hashes of the images which upserting the given people will
+        replace"""
+        person_ids = [
+            person.id for person in people if person.id is not None and person.mime_type
+        ]
+        if not person_ids:
+            return []
+
+        # SAFETY: this string substitution is okay since it only adds placeholders
+        # thus preventin SQL injections
+        placeholders = ", ".join("?" * len(person_ids))
+        return [
+            image_hash
+            for (image_hash,) in cursor.execute(
+                f"SELECT image_hash FROM people WHERE id IN ({placeholders})",
+                person_ids,
+            )
+        ]
 
     def delete_person(self, person_id: int) -> bool:
         """Delete the given person, returning whether it was in the
         database before deletion."""
         with self.db:
+            self._begin_write()
             cursor = self.db.cursor()
-            cursor.execute("DELETE FROM people WHERE id = ?", (person_id,))
-        return cursor.rowcount == 1
+            cursor.execute(
+                "DELETE FROM people WHERE id = ? RETURNING image_hash", (person_id,)
+            )
+            deleted = cursor.fetchall()
+            self._release_blobs(image_hash for (image_hash,) in deleted)
+        self._delete_released_blobs()
+        return len(deleted) == 1
 
     def fetch_person_by_id(self, person_id: int) -> Optional[Person]:
         """Fetch a specific person from the database based on their ID"""
@@ -480,10 +1483,34 @@ class DatabaseController:
         """Fetch a specific person's image data and MIME type
         from the database based on their ID"""
         cursor = self.db.cursor()
-        return cursor.execute(
-            "SELECT mime_type, image_data FROM people WHERE id = ?",
+        row = cursor.execute(
+            "SELECT mime_type, image_data, image_hash FROM people WHERE id = ?",
             (person_id,),
         ).fetchone()
+        if not row:
+            return None
+
+        return row[0], self._load_blob(row[1], row[2])
+
+    def open_person_image(
+        self, person_id: int, department_id: int
+    ) -> Optional[Tuple[str, OpenBlob]]:
+        """Open the image of a specific person in the given department for reading,
+        returning it along with its MIME type. Returns None if there is no such
+        person in the department. See `open_content_blob`."""
+        row = (
+            self.db.cursor()
+            .execute(
+                "SELECT mime_type, image_hash FROM people"
+                " WHERE id = ? AND department = ?",
+                (person_id, department_id),
+            )
+            .fetchone()
+        )
+        if not row:
+            return None
+
+        return row[0], self._open_blob("people", "image_data", person_id, row[1])
 
     # returns user from db based on email
     def get_user(self, email: str):
@@ -506,6 +1533,30 @@ class DatabaseController:
 
         return user_fields
 
+    def fetch_user(self, email: str) -> Optional[User]:
+        """Fetch the user with the given email, or None if there isn't one"""
+        with self.db:
+            cursor = self.db.cursor()
+            cursor.row_factory = User.from_sql
+            return cursor.execute(
+                "SELECT email, screen_name, department, permissions "
+                "FROM users WHERE email = ?",
+                (email,),
+            ).fetchone()
+
+    def load_user(self, email: str) -> Optional[User]:
+        """Get the user with the given email, or None if there isn't one, from the
+        user cache if possible. This is called on every authenticated request.
+
+        Users are dropped from the cache when they are changed by this process,
+        and by any process once its changes are synced, see `sync_caches`."""
+        user = User.fetch_cached(email)
+        if user is None:
+            user = self.fetch_user(email)
+            if user is not None:
+                User.cache(user)
+        return user
+
     def fetch_all_users(self) -> dict[int, User]:
         with self.db:
             cursor = self.db.cursor()
@@ -575,6 +1626,7 @@ class DatabaseController:
                     permissions,
                 ),
             )
+        User.invalidate_cached(email)
         return cursor.lastrowid
 
     def delete_user(self, id: str) -> bool:
@@ -585,26 +1637,49 @@ class DatabaseController:
                 "DELETE FROM USERS WHERE email = ?",
                 (id,),
             )
-            return cursor.rowcount == 1
+        User.invalidate_cached(id)
+        return cursor.rowcount == 1
 
     def delete_department(self, id: int) -> bool:
         """Deletes the given department from the database"""
         with self.db:
+            self._begin_write()
             cursor = self.db.cursor()
+
+            # People and files are removed by the cascade, so note which blobs they
+            # referenced first
+            blob_hashes = cursor.execute(
+                "SELECT image_hash FROM people WHERE department = ?"
+                " UNION ALL SELECT file_hash FROM files WHERE department_id = ?",
+                (id, id),
+            ).fetchall()
             cursor.execute(
                 "DELETE FROM departments WHERE id = ?",
                 (id,),
             )
-            return cursor.rowcount == 1
+            deleted = cursor.rowcount == 1
+            self._release_blobs(blob_hash for (blob_hash,) in blob_hashes)
+        self._delete_released_blobs()
+        Display.invalidate_rendered_in_department(id)
+        return deleted
 
     def create_content_stream(self, stream: ContentStream) -> int:
         """Insert the given content stream into the database and return its ID"""
         with self.db:
             cursor = self.db.cursor()
             cursor.execute(
-                "INSERT INTO content_streams (name, department, display, permissions)"
-                " VALUES (?, ?, ?, ?)",
-                (stream.name, stream.department, stream.display, stream.permissions),
+                "INSERT INTO content_streams"
+                " (name, department, display, permissions, retain_count,"
+                " retain_seconds)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    stream.name,
+                    stream.department,
+                    stream.display,
+                    stream.permissions,
+                    stream.retain_count,
+                    stream.retain_seconds,
+                ),
             )
         return cursor.lastrowid
 
@@ -620,8 +1695,8 @@ class DatabaseController:
             return GroupedContentStreams(
                 list(
                     cursor.execute(
-                        "SELECT id, name, department, display, "
-                        "permissions FROM content_streams"
+                        "SELECT id, name, department, display, permissions,"
+                        " retain_count, retain_seconds FROM content_streams"
                     )
                 )
             )
@@ -643,17 +1718,179 @@ class DatabaseController:
                 )
             )
 
-    def update_loadshedding_schedule(self, region, schedule):
-        """Updates the loadshedding schedule for the given region"""
+    def update_loadshedding_schedule(
+        self, region, schedule, summary: Optional[bytes] = None
+    ) -> bool:
+        """Updates the loadshedding schedule for the given region, along with the
+        summary of it which displays are sent, returning whether either changed.
+        Unchanged schedules aren't written."""
+        summary_hash = hashlib.sha256(summary).hexdigest() if summary else None
         with self.db:
             cursor = self.db.cursor()
             cursor.execute(
-                "REPLACE INTO loadshedding_schedules (id, schedule_json) VALUES (?, ?)",
+                "INSERT INTO loadshedding_schedules"
+                " (id, schedule_json, summary_json, summary_hash) VALUES (?, ?, ?, ?)"
+                " ON CONFLICT(id) DO UPDATE SET schedule_json = excluded.schedule_json,"
+                " summary_json = excluded.summary_json,"
+                " summary_hash = excluded.summary_hash"
+                " WHERE schedule_json IS NOT excluded.schedule_json"
+                " OR summary_hash IS NOT excluded.summary_hash",
                 (
                     region,
                     schedule,
+                    summary,
+                    summary_hash,
                 ),
             )
+            return cursor.rowcount == 1
+
+    def acquire_lease(self, name: str, holder: str, duration: float) -> bool:
+        """Take or renew the lease with the given name for the given holder, for
+        `duration` seconds from now. Returns whether the holder now has the lease,
+        which it doesn't if another holder's lease hasn't expired yet."""
+        now = time.time()
+        with self.db:
+            cursor = self.db.cursor()
+            cursor.execute(
+                "INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?)"
+                " ON CONFLICT(name) DO UPDATE"
+                " SET holder = excluded.holder, expires_at = excluded.expires_at"
+                " WHERE holder = excluded.holder OR expires_at <= ?",
+                (name, holder, int(now + duration), int(now)),
+            )
+            return cursor.rowcount == 1
+
+    def sync_caches(self):
+        """Drop whatever this process has cached of data which has changed since it
+        last checked, whichever process changed it. This only reads the latest
+        change unless something has changed, so it is cheap enough to do on every
+        request. See `server.invalidation`."""
+        invalidation.sync(self.fetch_latest_change, self.fetch_changes_since)
+
+    def fetch_latest_change(self) -> int:
+        """Fetch the ID of the latest change to cached data, or 0 if there are none"""
+        return self.db.execute("SELECT COALESCE(MAX(id), 0) FROM changes").fetchone()[0]
+
+    def fetch_changes_since(
+        self, change_id: int, limit: int
+    ) -> tuple[Optional[int], list[tuple[int, str, Optional[str]]]]:
+        """Fetch the ID of the oldest change still kept, along with up to `limit`
+        changes after the given one in order, as (id, kind, key)"""
+        (oldest,) = self.db.execute("SELECT MIN(id) FROM changes").fetchone()
+        changes = self.db.execute(
+            "SELECT id, kind, key FROM changes WHERE id > ? ORDER BY id LIMIT ?",
+            (change_id, limit),
+        ).fetchall()
+        return oldest, changes
+
+    def trim_changes(self, before: float) -> int:
+        """Delete the changes made before the given Unix timestamp, returning how
+        many were deleted. The latest change is always kept so that processes can
+        still tell whether anything has changed since they last checked."""
+        with self.db:
+            cursor = self.db.execute(
+                "DELETE FROM changes"
+                " WHERE changed < ? AND id < (SELECT MAX(id) FROM changes)",
+                (before,),
+            )
+            return cursor.rowcount
+
+    def fetch_change_log(
+        self,
+        after: int,
+        tables: Optional[list[str]] = None,
+        limit: int = CHANGE_LOG_LIMIT,
+    ) -> Optional[list[tuple[int, str, str, str]]]:
+        """Fetch up to `limit` changes logged after the given sequence number,
+        oldest first, optionally only those to the given tables. Each change is a
+        tuple of (sequence number, table, row key, operation) where operation is
+        'insert', 'update' or 'delete'. A row key is the row's primary key, with the
+        columns joined by ':' if there are several.
+
+        Returns None if changes after the given sequence number have already been
+        truncated, or it is from before the database was recreated, in which case
+        the caller has to read everything again and carry on from
+        `fetch_change_log_head`."""
+        if self.is_change_log_truncated(after):
+            return None
+
+        table_filter = ""
+        if tables is not None:
+            # SAFETY: this string substitution is okay since it only adds placeholders
+            # thus preventin SQL injections
+            table_filter = f" AND table_name IN ({','.join(['?'] * len(tables))})"
+        return self.db.execute(
+            "SELECT seq, table_name, row_key, operation FROM change_log"
+            f" WHERE seq > ?{table_filter} ORDER BY seq LIMIT ?",
+            [after, *(tables or []), limit],
+        ).fetchall()
+
+    def is_change_log_truncated(self, after: int) -> bool:
+        """Check whether changes logged after the given sequence number have already
+        been truncated, or it is from before the database was recreated, in which
+        case a client which has read everything up to it has to read everything
+        again"""
+        oldest, latest = self.db.execute(
+            "SELECT (SELECT MIN(seq) FROM change_log),"
+            " (SELECT MAX(seq) FROM change_log)"
+        ).fetchone()
+        return after > (latest or 0) or (oldest is not None and oldest > after + 1)
+
+    def fetch_change_log_head(self) -> int:
+        """Fetch the sequence number of the latest change logged, or 0 if there are
+        none. A client which reads everything after fetching this can carry on from
+        it with `fetch_change_log`."""
+        return self.db.execute(
+            "SELECT COALESCE(MAX(seq), 0) FROM change_log"
+        ).fetchone()[0]
+
+    def trim_change_log(self, before: float) -> int:
+        """Delete the changes logged before the given Unix timestamp, returning how
+        many were deleted. The latest change is always kept so that the sequence
+        carries on from it."""
+        with self.db:
+            cursor = self.db.execute(
+                "DELETE FROM change_log"
+                " WHERE changed_at < ? AND seq < (SELECT MAX(seq) FROM change_log)",
+                (before,),
+            )
+            return cursor.rowcount
+
+    def store_metrics(
+        self, process: str, flushed_at: float, series: list[tuple[str, str, float]]
+    ):
+        """Store the given series of the given process's metrics, as (name, labels
+        as JSON, value), and record that the process was alive at `flushed_at`.
+        Series which aren't given keep their stored value."""
+        with self.db:
+            cursor = self.db.cursor()
+            cursor.execute(
+                "INSERT INTO metrics_processes (process, flushed_at) VALUES (?, ?)"
+                " ON CONFLICT (process) DO UPDATE SET flushed_at = excluded.flushed_at",
+                (process, flushed_at),
+            )
+            cursor.executemany(
+                "INSERT INTO metrics (process, name, labels, value) VALUES (?, ?, ?, ?)"
+                " ON CONFLICT (process, name, labels)"
+                " DO UPDATE SET value = excluded.value",
+                [(process, name, labels, value) for name, labels, value in series],
+            )
+
+    def fetch_metrics(self) -> list[tuple[str, float, str, str, float]]:
+        """Fetch the stored metrics of every process, as (process, when the process
+        last stored them, name, labels as JSON, value)"""
+        return self.db.execute(
+            "SELECT metrics.process, flushed_at, name, labels, value"
+            " FROM metrics JOIN metrics_processes USING (process)"
+        ).fetchall()
+
+    def delete_stale_metrics(self, before: float) -> int:
+        """Delete the metrics of processes which last stored them before the given
+        Unix timestamp, returning how many processes they were from"""
+        with self.db:
+            return self.db.execute(
+                "DELETE FROM metrics_processes WHERE flushed_at < ?", (before,)
+            ).rowcount
 
     def fetch_loadshedding_schedule(self, region):
         """fetches the loadshedding schedule for the given region"""
@@ -667,6 +1904,95 @@ class DatabaseController:
             db_user_data = cursor.fetchone()
             return db_user_data
 
+    def fetch_loadshedding_summary(self, region: int) -> Optional[tuple[bytes, str]]:
+        """Fetch the summary of the loadshedding schedule for the given region as
+        JSON, along with its hash, or None if there isn't one yet"""
+        with self.db:
+            return self.db.execute(
+                "SELECT summary_json, summary_hash FROM loadshedding_schedules"
+                " WHERE id = ? AND summary_json IS NOT NULL",
+                (region,),
+            ).fetchone()
+
+    def fetch_rss_feeds(self, urls: list[str]) -> dict[str, tuple]:
+        """Fetch the given RSS feeds which are being polled, by URL, as a tuple of
+        when each was last requested, its items as JSON and their hash. The items are
+        None if the feed hasn't been fetched yet."""
+        # SAFETY: this string substitution is okay since it only adds placeholders
+        # thus preventin SQL injections
+        placeholders = ", ".join("?" * len(urls))
+        with self.db:
+            return {
+                url: (requested_at, items_json, items_hash)
+                for url, requested_at, items_json, items_hash in self.db.execute(
+                    "SELECT url, requested_at, items_json, items_hash FROM rss_feeds"
+                    f" WHERE url IN ({placeholders})",
+                    urls,
+                )
+            }
+
+    def register_rss_feeds(self, urls: list[str]):
+        """Start polling the given RSS feeds, or note that they have been requested
+        again if they are already being polled"""
+        now = int(time.time())
+        with self.db:
+            self.db.executemany(
+                "INSERT INTO rss_feeds (url, requested_at) VALUES (?, ?)"
+                " ON CONFLICT(url) DO UPDATE SET requested_at = excluded.requested_at"
+                " WHERE requested_at < excluded.requested_at - ?",
+                [(url, now, RSS_REQUEST_RESOLUTION) for url in urls],
+            )
+
+    def fetch_due_rss_feeds(self, fetched_before: float) -> list[tuple]:
+        """Fetch the URL, ETag and Last-Modified of every RSS feed which hasn't been
+        fetched since the given time"""
+        with self.db:
+            return self.db.execute(
+                "SELECT url, etag, last_modified FROM rss_feeds"
+                " WHERE fetched_at IS NULL OR fetched_at <= ?",
+                (int(fetched_before),),
+            ).fetchall()
+
+    def update_rss_feed(
+        self,
+        url: str,
+        fetched_at: float,
+        etag: Optional[str],
+        last_modified: Optional[str],
+        items_json: Optional[bytes],
+    ):
+        """Record that the given RSS feed was fetched, along with its new validators
+        and its items as JSON, if they were fetched rather than unchanged"""
+        with self.db:
+            if items_json is None:
+                self.db.execute(
+                    "UPDATE rss_feeds SET fetched_at = ?, etag = ?, last_modified = ?"
+                    " WHERE url = ?",
+                    (int(fetched_at), etag, last_modified, url),
+                )
+            else:
+                self.db.execute(
+                    "UPDATE rss_feeds SET fetched_at = ?, etag = ?, last_modified = ?,"
+                    " items_json = ?, items_hash = ? WHERE url = ?",
+                    (
+                        int(fetched_at),
+                        etag,
+                        last_modified,
+                        items_json,
+                        hashlib.sha256(items_json).hexdigest(),
+                        url,
+                    ),
+                )
+
+    def delete_stale_rss_feeds(self, requested_before: float) -> int:
+        """Stop polling the RSS feeds which haven't been requested since the given
+        time, returning how many there were"""
+        with self.db:
+            return self.db.execute(
+                "DELETE FROM rss_feeds WHERE requested_at < ?",
+                (int(requested_before),),
+            ).rowcount
+
     # uploading of arbitrary files by department:
     def upload_department_file(self, dep_file: File) -> int:
         """
@@ -674,19 +2000,29 @@ class DatabaseController:
         """
 
         with self.db:
+            self._begin_write()
             cursor = self.db.cursor()
+            old_file_hashes = cursor.execute(
+                "SELECT file_hash FROM files WHERE department_id = ? AND filename = ?",
+                (dep_file.department_id, dep_file.name),
+            ).fetchall()
+            (file_data, file_hash) = self._store_blob(dep_file.file_data)
             cursor.execute(
                 "REPLACE INTO files "
-                "(filename, mime_type, file_content, department_id)"
-                " VALUES (?, ?, ?, ?)",
+                "(filename, mime_type, file_content, file_hash, department_id)"
+                " VALUES (?, ?, ?, ?, ?)",
                 (
                     dep_file.name,
                     dep_file.mime_type,
-                    dep_file.file_data,
+                    file_data,
+                    file_hash,
                     dep_file.department_id,
                 ),
             )
+            self._release_blobs(old for (old,) in old_file_hashes)
+        self._delete_released_blobs()
 
+        Display.invalidate_rendered_in_department(dep_file.department_id)
         return cursor.lastrowid
 
     def fetch_file_by_id(self, filename: str, department_id: int) -> Optional[File]:
@@ -695,10 +2031,10 @@ class DatabaseController:
         cursor = self.db.cursor()
         cursor.row_factory = File.from_sql
 
-        return next(
+        file = next(
             cursor.execute(
                 "SELECT "
-                "department_id, filename, file_content, mime_type "
+                "department_id, filename, file_content, file_hash, mime_type "
                 "FROM files"
                 " WHERE department_id = ? AND filename = ?",
                 (
@@ -709,20 +2045,50 @@ class DatabaseController:
             None,
         )
 
+        if file and file.file_hash:
+            file.file_data = self._load_blob(file.file_data, file.file_hash)
+
+        return file
+
+    def open_department_file(
+        self, filename: str, department_id: int
+    ) -> Optional[Tuple[str, OpenBlob]]:
+        """Open the given department file for reading, returning it along with its
+        MIME type. See `open_content_blob`."""
+        row = (
+            self.db.cursor()
+            .execute(
+                "SELECT rowid, mime_type, file_hash FROM files"
+                " WHERE department_id = ? AND filename = ?",
+                (department_id, filename),
+            )
+            .fetchone()
+        )
+        if not row:
+            return None
+
+        return row[1], self._open_blob("files", "file_content", row[0], row[2])
+
     def delete_file_by_name_and_department(
         self, filename: str, department_id: int
     ) -> bool:
         """Deletes the given file from the database"""
         with self.db:
+            self._begin_write()
             cursor = self.db.cursor()
             cursor.execute(
-                "DELETE FROM files WHERE department_id = ? AND filename = ?",
+                "DELETE FROM files WHERE department_id = ? AND filename = ?"
+                " RETURNING file_hash",
                 (
                     department_id,
                     filename,
                 ),
             )
-        return cursor.rowcount == 1
+            deleted = cursor.fetchall()
+            self._release_blobs(file_hash for (file_hash,) in deleted)
+        self._delete_released_blobs()
+        Display.invalidate_rendered_in_department(department_id)
+        return len(deleted) == 1
 
     def fetch_all_page_templates(self) -> list[PageTemplate]:
         """Return all page templates in the database"""
@@ -741,8 +2107,30 @@ class DatabaseController:
             None,
         )
 
+    def fetch_page_templates_by_ids(
+        self, template_ids: list[str]
+    ) -> dict[str, PageTemplate]:
+        """Fetch all the given page templates in one query, returning them by ID.
+        IDs which do not exist are not present in the result."""
+        template_ids = list(set(template_ids))
+        cursor = self.db.cursor()
+        cursor.row_factory = PageTemplate.from_sql
+
+        # SAFETY: this string substitution is okay since we don't use user data here
+        # thus preventin SQL injections
+        return {
+            template.id: template
+            for template in cursor.execute(
+                "SELECT id, xml FROM templates"
+                f" WHERE id IN ({ ','.join(['?'] * len(template_ids)) })",
+                template_ids,
+            )
+        }
+
     def add_page_template(self, template_id: str, template_xml: str):
         """Adds the given page template"""
+        PageTemplate.invalidate(template_id)
+        Display.invalidate_all_rendered()
         with self.db:
             cursor = self.db.cursor()
             cursor.execute(
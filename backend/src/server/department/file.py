@@ -1,5 +1,6 @@
 import flask
 import sqlite3
+from typing import Optional
 
 
 class File:
@@ -11,11 +12,14 @@ class File:
         department_id: int,
         mime_type: str,
         file_data: bytes,
+        file_hash: Optional[str] = None,
     ):
         self.name = name
         self.department_id = department_id
         self.mime_type = mime_type
         self.file_data = file_data
+        # The hash of the file if it is kept in the blob store, rather than inline
+        self.file_hash = file_hash
 
     @staticmethod
     def from_form(form: dict, files: dict, department_id: int):
@@ -36,4 +40,5 @@ class File:
             department_id=row["department_id"],
             mime_type=row["mime_type"],
             file_data=row["file_content"],
+            file_hash=row["file_hash"] if "file_hash" in row.keys() else None,
         )
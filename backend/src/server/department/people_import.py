@@ -0,0 +1,174 @@
+import csv
+import io
+import shutil
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import BinaryIO, Iterable, Iterator, Optional
+
+import openpyxl
+import PIL.Image
+from werkzeug.datastructures import FileStorage
+
+from server.department.person import Person
+
+# The columns a table of people must have. It may also have an `image_name` column
+# naming each person's image in the uploaded ZIP file, and an `id` column to update
+# existing people rather than adding new ones.
+REQUIRED_COLUMNS = [
+    "title",
+    "full_name",
+    "position",
+    "office_hours",
+    "office_location",
+    "email",
+    "phone",
+]
+
+# How many rows have their images verified at once. This bounds how many images
+# are held in memory.
+IMAGE_BATCH_SIZE = 64
+
+
+class InvalidTableError(ValueError):
+    """Raised when an uploaded table of people can't be read at all"""
+
+
+def read_table(table: FileStorage) -> Iterator[tuple[int, dict]]:
+    """Read the given Excel or CSV file of people one row at a time, yielding each
+    row's number (counting the header as row 1) along with the row as a dict from
+    column name to value. Blank rows are skipped."""
+    if table.filename and table.filename.lower().endswith(".csv"):
+        rows = csv.reader(io.TextIOWrapper(open_upload(table), encoding="utf-8-sig"))
+        yield from _rows_to_dicts(rows)
+        return
+
+    try:
+        # Read-only mode streams the sheet rather than loading it all into memory
+        workbook = openpyxl.load_workbook(
+            open_upload(table), read_only=True, data_only=True
+        )
+    except Exception as e:
+        raise InvalidTableError("Not a valid Excel or CSV file") from e
+
+    try:
+        yield from _rows_to_dicts(workbook.active.iter_rows(values_only=True))
+    finally:
+        workbook.close()
+
+
+def open_upload(upload: FileStorage) -> BinaryIO:
+    """Get the given uploaded file as a file which can be read by zipfile and
+    io.TextIOWrapper. Before Python 3.11, the spooled temporary files uploads are
+    kept in can't be, so they are copied to a real temporary file instead."""
+    if hasattr(upload.stream, "seekable"):
+        return upload.stream
+
+    copy = tempfile.TemporaryFile()
+    shutil.copyfileobj(upload.stream, copy)
+    copy.seek(0)
+    return copy
+
+
+def _rows_to_dicts(rows: Iterable[tuple]) -> Iterator[tuple[int, dict]]:
+    rows = iter(rows)
+    header = [_cell_to_str(cell) for cell in next(rows, [])]
+    missing = [column for column in REQUIRED_COLUMNS if column not in header]
+    if missing:
+        raise InvalidTableError(f"The table is missing the columns {missing}")
+
+    for row_number, row in enumerate(rows, start=2):
+        values = [_cell_to_str(cell) for cell in row]
+        if any(values):
+            yield row_number, dict(zip(header, values))
+
+
+def _cell_to_str(cell) -> str:
+    if cell is None:
+        return ""
+    elif isinstance(cell, float) and cell.is_integer():
+        # Excel stores numbers such as phone numbers as floats
+        return str(int(cell))
+    else:
+        return str(cell).strip()
+
+
+def import_people(
+    rows: Iterable[tuple[int, dict]],
+    zip_file: zipfile.ZipFile,
+    errors: list[dict],
+) -> Iterator[Person]:
+    """Turn the given rows of a table into people, with their images from the given
+    ZIP file. Images are verified in a pool of threads, a batch of rows at a time.
+
+    Problems with a row are appended to `errors` as {"row": number, "error": str}
+    as the people are iterated over. A row whose image is missing or invalid is
+    still imported, just without an image, while a row which can't be imported at
+    all is skipped."""
+    rows = iter(rows)
+    with ThreadPoolExecutor() as pool:
+        while batch := list(islice(rows, IMAGE_BATCH_SIZE)):
+            images = [_read_image(zip_file, row) for _, row in batch]
+            mime_types = pool.map(_verify_image, images)
+
+            for (row_number, row), image_data, mime_type in zip(
+                batch, images, mime_types
+            ):
+                person_id = row.get("id")
+                if person_id and not person_id.isdigit():
+                    errors.append({"row": row_number, "error": "Invalid ID"})
+                    continue
+
+                if image_data and not mime_type:
+                    errors.append({"row": row_number, "error": "Invalid image"})
+                    image_data = None
+                elif row.get("image_name") and image_data is None:
+                    errors.append(
+                        {"row": row_number, "error": "Image not in the ZIP file"}
+                    )
+
+                yield Person(
+                    row["title"],
+                    row["full_name"],
+                    mime_type or "",
+                    image_data or "",
+                    row["position"],
+                    row["office_hours"],
+                    row["office_location"],
+                    row["email"],
+                    row["phone"],
+                    lecturer_id=int(person_id) if person_id else None,
+                )
+
+
+def _read_image(zip_file: zipfile.ZipFile, row: dict) -> Optional[bytes]:
+    image_name = row.get("image_name")
+    if not image_name:
+        return None
+
+    try:
+        return zip_file.read(image_name)
+    except KeyError:
+        return None
+
+
+def _verify_image(image_data: Optional[bytes]) -> Optional[str]:
+    """Check that the given image is valid, returning its MIME type, or None if it
+    isn't valid"""
+    if not image_data:
+        return None
+
+    try:
+        with PIL.Image.open(io.BytesIO(image_data)) as image:
+            image.verify()
+            mime_type = image.get_format_mimetype()
+
+        # verify() only checks the structure of the file, so decode it too in order
+        # to catch truncated images
+        with PIL.Image.open(io.BytesIO(image_data)) as image:
+            image.load()
+
+        return mime_type
+    except Exception:
+        return None
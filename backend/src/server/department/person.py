@@ -1,9 +1,18 @@
+import hashlib
+import json
 import sqlite3
 from typing import Optional
 import PIL.Image
 import io
 import pandas as pd
 
+from server import invalidation
+from server.cache import Cache
+
+# The people of each department serialized for the HTTP API, by department ID. See
+# Person.cache_department_people.
+_department_people = Cache(name="department_people")
+
 
 class Person:
     """A person is a member in a department.
@@ -23,6 +32,7 @@ class Person:
         email: str,
         phone: str,
         lecturer_id: Optional[int] = None,
+        image_hash: Optional[str] = None,
     ):
         self.title = title
         self.name = name
@@ -34,6 +44,9 @@ class Person:
         self.email = email
         self.phone = phone
         self.id = lecturer_id
+        # The hash of the image if it's in the blob store, which changes whenever the
+        # image does
+        self.image_hash = image_hash
 
     def to_http_json(self) -> dict:
         """Sends data in json format to be posted through http"""
@@ -53,6 +66,7 @@ class Person:
             "phone": self.phone,
             "id": self.id,
             "image": image,
+            "image_hash": self.image_hash,
         }
 
     @staticmethod
@@ -122,4 +136,49 @@ class Person:
             phone=row["phone"],
             image_data="",
             mime_type=row["mime_type"],
+            image_hash=row["image_hash"] if "image_hash" in row.keys() else None,
         )
+
+    @staticmethod
+    def cache_department_people(
+        department_id: int, people: list["Person"]
+    ) -> tuple[bytes, str]:
+        """Serialize the given people of the given department for the HTTP API,
+        returning the JSON along with its hash to use as an ETag. These are cached
+        until anyone in the department changes."""
+        people_json = json.dumps(
+            {"people": [person.to_http_json() for person in people]}
+        ).encode("utf-8")
+        serialized = (people_json, hashlib.sha256(people_json).hexdigest())
+        _department_people.put(department_id, serialized)
+        return serialized
+
+    @staticmethod
+    def fetch_cached_department_people(
+        department_id: int,
+    ) -> Optional[tuple[bytes, str]]:
+        """Get the cached people of the given department, as serialized by
+        `cache_department_people`, if they are cached"""
+        return _department_people.get(department_id)
+
+    @staticmethod
+    def invalidate_cached_department_people(department_id: int):
+        """Drop the cached people of the given department"""
+        _department_people.invalidate(department_id)
+
+    @staticmethod
+    def invalidate_all_cached_department_people():
+        """Drop the cached people of all departments"""
+        _department_people.clear()
+
+
+def _department_people_changed(department_id: Optional[str]):
+    if department_id is None:
+        Person.invalidate_all_cached_department_people()
+    else:
+        Person.invalidate_cached_department_people(int(department_id))
+
+
+# People are cached by department, which drops them when the department is deleted
+invalidation.on_change("people", _department_people_changed)
+invalidation.on_change("department", _department_people_changed)
@@ -1,16 +1,119 @@
 import base64
+import hashlib
 import json
 import os
+import re
 import sqlite3
 from json import JSONDecodeError
 from typing import Optional
 
 from flask import render_template
+from lxml import etree
 from markupsafe import Markup
 from werkzeug.datastructures import ImmutableMultiDict
 
+from server import invalidation
+from server.cache import Cache
 from server.department.file import File
 
+# Rendered layouts by (department ID, display ID), see Display.render_cached
+_rendered_layouts = Cache(name="rendered_layouts")
+
+# Layouts are made from page templates, so entities must not be expanded and a
+# malformed page shouldn't stop the rest of the layout from being read
+_layout_parser = etree.XMLParser(recover=True, resolve_entities=False, no_network=True)
+# The contents of these tags are HTML or CSS rather than widgets
+_RAW_TAGS = ("html", "style", "script")
+# Links to department files, as put in the properties of pages
+_FILE_URL = re.compile(r"/api/departments/\d+/files/[^?#]+")
+
+
+class LayoutBindings:
+    """The data which the widgets of a rendered layout fetch from the API when they
+    start: the `content` of each content stream, as its stream IDs and fetch
+    amount, whether the department's `people` are shown, and which loadshedding
+    `regions` are shown.
+
+    These are read the way the frontend widgets read their tags, so that what is
+    found here can be matched up with what the widgets ask for."""
+
+    def __init__(
+        self,
+        content: list[tuple[tuple[int, ...], str]],
+        people: bool,
+        regions: list[str],
+    ):
+        self.content = content
+        self.people = people
+        self.regions = regions
+
+    @staticmethod
+    def from_layout(layout: str, content_stream: Optional[int]) -> "LayoutBindings":
+        """Find the data bound widgets in the given layout of a display with the
+        given intrinsic content stream"""
+        bindings = LayoutBindings([], False, [])
+        try:
+            root = etree.fromstring(layout.encode("utf-8"), _layout_parser)
+        except etree.XMLSyntaxError:
+            root = None
+        if root is None:
+            return bindings
+
+        for element in root.iter(etree.Element):
+            if any(ancestor.tag in _RAW_TAGS for ancestor in element.iterancestors()):
+                continue
+
+            if element.tag == "content-stream":
+                streams = {
+                    stream_id
+                    for stream in element.iterchildren(etree.Element)
+                    if (stream_id := _parse_int(stream.get("id")))
+                }
+                skip_intrinsic = element.get("skip-intrinsic-stream") == "true"
+                if content_stream is not None and not skip_intrinsic:
+                    streams.add(content_stream)
+                bindings.content.append(
+                    (tuple(sorted(streams)), element.get("fetch-amount") or "5")
+                )
+            elif element.tag == "department":
+                bindings.people = True
+            elif element.tag == "loadshedding":
+                bindings.regions.append(element.get("region") or "1")
+
+        return bindings
+
+
+def _parse_int(value: Optional[str]) -> Optional[int]:
+    """Parse the integer at the start of the given value, like JavaScript's
+    parseInt"""
+    match = re.match(r"\s*([+-]?\d+)", value or "")
+    return int(match.group(1)) if match else None
+
+
+class RenderedLayout:
+    """The rendered layout of a display and the display token it is sent with,
+    along with the validators used to answer conditional requests for them"""
+
+    def __init__(
+        self, department_id: int, layout: str, content_stream: int, token: str
+    ):
+        self.department_id = department_id
+        self.layout = layout
+        self.content_stream = content_stream
+        self.token = token
+        self.etag = hashlib.sha256(
+            f"{department_id}:{content_stream}:{token}:{layout}".encode("utf-8")
+        ).hexdigest()
+        self.bindings = LayoutBindings.from_layout(layout, content_stream)
+
+
+def _with_token(value, token: Optional[str]):
+    """Add the given display token to the given property value if it links to a
+    department file"""
+    if token and isinstance(value, str) and _FILE_URL.fullmatch(value):
+        return f"{value}?token={token}"
+    return value
+
 
 class Display:
     """A Display is a display on which things are displayed.
@@ -101,6 +204,17 @@ class Display:
             else None,
         )
 
+    def references(self, value: str) -> bool:
+        """Whether any of this display's pages has the given value as a property, or
+        in a list property"""
+        for _, _, properties in self.pages:
+            for property_value in properties.values():
+                if property_value == value or (
+                    isinstance(property_value, list) and value in property_value
+                ):
+                    return True
+        return False
+
     @staticmethod
     def _wipe_old_files(filenames_in_use, department_id, db, display_id):
         dept = db.fetch_department_by_id(department_id, fetch_files=True)
@@ -153,16 +267,24 @@ class Display:
 
         return filenames
 
-    def render(self, db):
-        """renders the display template"""
+    def render(self, db, token: Optional[str] = None):
+        """renders the display template. Links to department files are given the
+        display token, if there is one, since the display loads them without
+        logging in."""
+        templates = db.fetch_page_templates_by_ids(
+            [template for (template, _duration, _properties) in self.pages]
+        )
         return render_template(
             "display_layout.j2.xml",
             pages=[
                 (
                     duration,
                     Markup(
-                        db.fetch_page_template_by_id(template).render_template(
-                            properties
+                        templates[template].render_template(
+                            {
+                                name: _with_token(value, token)
+                                for name, value in properties.items()
+                            }
                         )
                     ),
                 )
@@ -170,6 +292,36 @@ class Display:
             ],
         )
 
+    def render_cached(self, db, department_id: int, token: str) -> RenderedLayout:
+        """Render this display's layout to be sent with the given display token,
+        caching it until it is invalidated"""
+        rendered = RenderedLayout(
+            department_id, self.render(db, token), self.content_stream, token
+        )
+        _rendered_layouts.put((department_id, self.id), rendered)
+        return rendered
+
+    @staticmethod
+    def fetch_rendered(department_id: int, display_id: int) -> Optional[RenderedLayout]:
+        """Get the cached rendered layout of the given display, if there is one"""
+        return _rendered_layouts.get((department_id, display_id))
+
+    @staticmethod
+    def invalidate_rendered(display_id: int):
+        """Drop the cached rendered layout of the given display"""
+        _rendered_layouts.invalidate_where(lambda key, _: key[1] == display_id)
+
+    @staticmethod
+    def invalidate_rendered_in_department(department_id: int):
+        """Drop the cached rendered layouts of all displays in the given
+        department"""
+        _rendered_layouts.invalidate_where(lambda key, _: key[0] == department_id)
+
+    @staticmethod
+    def invalidate_all_rendered():
+        """Drop all cached rendered layouts"""
+        _rendered_layouts.clear()
+
     @staticmethod
     def from_sql(cursor: sqlite3.Cursor, row: tuple):
         """Parse the given SQL row into a Display object"""
@@ -186,3 +338,23 @@ class Display:
             name=row["name"],
             pages=pages,
         )
+
+
+def _display_changed(display_id: Optional[str]):
+    if display_id is None:
+        Display.invalidate_all_rendered()
+    else:
+        Display.invalidate_rendered(int(display_id))
+
+
+def _department_changed(department_id: Optional[str]):
+    if department_id is None:
+        Display.invalidate_all_rendered()
+    else:
+        Display.invalidate_rendered_in_department(int(department_id))
+
+
+# Rendered layouts are made from displays, their department's files and templates
+invalidation.on_change("display", _display_changed)
+invalidation.on_change("department", _department_changed)
+invalidation.on_change("template", lambda _: Display.invalidate_all_rendered())
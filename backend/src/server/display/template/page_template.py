@@ -1,14 +1,22 @@
+import hashlib
 import sqlite3
-from typing import Any
+from typing import Any, Optional
 from urllib.parse import urlparse
 
 from bs4 import BeautifulSoup
-from flask import render_template_string
+from flask import current_app
+from jinja2 import Template
 from markupsafe import Markup, escape
 
+from server import invalidation
+from server.cache import Cache
 from server.display.template import TemplateProperties
 from server.display.template import TemplateProperty
 
+# Parsed templates by template id. Each entry is a tuple of (XML hash, PageTemplate)
+# so that a template whose XML has changed is never served stale.
+_parsed_templates = Cache(name="page_templates")
+
 
 class PageTemplate:
     """A PageTemplate is a template for a page within Display that has
@@ -31,6 +39,7 @@ class PageTemplate:
         self.properties = properties
         self.id = None
         self.intrinsic_duration = intrinsic_duration
+        self._compiled = None
 
     @staticmethod
     def register_filters(app):
@@ -41,11 +50,31 @@ class PageTemplate:
 
     @staticmethod
     def from_sql(cursor: sqlite3.Cursor, row: tuple):
+        """Parse the given SQL row into a PageTemplate, reusing the already parsed
+        template if its XML has not changed"""
         row = sqlite3.Row(cursor, row)
+        template_id = row["id"]
+        xml_hash = hashlib.sha256(row["xml"].encode("utf-8")).digest()
+
+        cached = _parsed_templates.get(template_id)
+        if cached and cached[0] == xml_hash:
+            return cached[1]
+
         template = PageTemplate.from_xml_string(row["xml"])
-        template.id = row["id"]
+        template.id = template_id
+        _parsed_templates.put(template_id, (xml_hash, template))
         return template
 
+    @staticmethod
+    def invalidate(template_id: str):
+        """Drop the given template from the parsed template cache"""
+        _parsed_templates.invalidate(template_id)
+
+    @staticmethod
+    def invalidate_all():
+        """Drop all templates from the parsed template cache"""
+        _parsed_templates.clear()
+
     @staticmethod
     def from_xml_string(xml: str):
         """Deserialize the given XML string into a Template"""
@@ -80,7 +109,28 @@ class PageTemplate:
             elif typ == "xml-attribute":
                 properties[prop] = escape(properties[prop])
 
-        return render_template_string(self.layout_template, **properties)
+        # Equivalent to flask.render_template_string, but without recompiling
+        context = dict(properties)
+        current_app.update_template_context(context)
+        return self.compiled().render(context)
+
+    def compiled(self) -> Template:
+        """Get the compiled Jinja2 template for this template's layout. It is
+        compiled on first use and then kept for the lifetime of this object."""
+        env = current_app.jinja_env
+        if self._compiled is None or self._compiled.environment is not env:
+            self._compiled = env.from_string(self.layout_template)
+        return self._compiled
+
+
+def _template_changed(template_id: Optional[str]):
+    if template_id is None:
+        PageTemplate.invalidate_all()
+    else:
+        PageTemplate.invalidate(template_id)
+
+
+invalidation.on_change("template", _template_changed)
 
 
 def youtube_code(link: str) -> str:
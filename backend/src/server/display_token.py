@@ -0,0 +1,94 @@
+from typing import Optional
+
+import flask
+from itsdangerous import BadSignature, URLSafeSerializer
+
+from server import invalidation
+from server.cache import Cache
+from server.database import DatabaseController
+
+# Keeps display tokens from being valid as anything else signed with the app's
+# secret key, such as sessions
+DISPLAY_TOKEN_SALT = "display-token"
+
+# The largest display ID SQLite can store, so that IDs from unverified tokens can be
+# looked up without overflowing
+MAX_DISPLAY_ID = 2**63 - 1
+
+# The department and token secret of each display by ID, so that checking a token
+# usually doesn't touch the database
+_token_secrets = Cache(name="display_token_secrets")
+
+
+def _serializer(token_secret: str) -> URLSafeSerializer:
+    return URLSafeSerializer(
+        f"{flask.current_app.secret_key}:{token_secret}", salt=DISPLAY_TOKEN_SALT
+    )
+
+
+def _fetch_token_secret(display_id: int) -> Optional[tuple[int, str]]:
+    secret = _token_secrets.get(display_id)
+    if secret is None:
+        secret = DatabaseController.get().fetch_display_token_secret(display_id)
+        if secret is not None:
+            _token_secrets.put(display_id, secret)
+    return secret
+
+
+def make_display_token(department_id: int, display_id: int) -> Optional[str]:
+    """Make a token which lets the given display read the data it shows without
+    logging in, or None if there is no such display in the given department.
+
+    Tokens are signed with the display's own secret as well as the app's secret
+    key rather than stored, so they can't be forged from the app's secret key
+    alone, and resetting the display's secret revokes all of its tokens."""
+    secret = _fetch_token_secret(display_id)
+    if secret is None or secret[0] != department_id:
+        return None
+    return _serializer(secret[1]).dumps([department_id, display_id])
+
+
+def verify_display_token(token: Optional[str]) -> Optional[tuple[int, int]]:
+    """Check the signature of the given display token, returning the department and
+    display it was made for, or None if it isn't valid"""
+    if not token:
+        return None
+
+    # The display the token claims to be for says which secret it must be signed
+    # with, but nothing else is trusted until the signature is checked
+    try:
+        _, (_, display_id) = URLSafeSerializer("").loads_unsafe(token)
+        display_id = int(display_id)
+        if not 0 < display_id <= MAX_DISPLAY_ID:
+            return None
+        secret = _fetch_token_secret(display_id)
+        if secret is None:
+            return None
+        department_id, display_id = _serializer(secret[1]).loads(token)
+    except (BadSignature, TypeError, ValueError):
+        return None
+
+    if department_id != secret[0]:
+        # The display has moved to another department since
+        return None
+    return department_id, display_id
+
+
+def request_display_token() -> Optional[tuple[int, int]]:
+    """Get the department and display of the valid display token the current request
+    was made with, as a Bearer token or the `token` query parameter, if any"""
+    authorization = flask.request.authorization
+    if authorization and authorization.type == "bearer":
+        return verify_display_token(authorization.token)
+    return verify_display_token(flask.request.args.get("token"))
+
+
+def _display_changed(display_id: Optional[str]):
+    if display_id is None:
+        _token_secrets.clear()
+    else:
+        _token_secrets.invalidate(int(display_id))
+
+
+# Resetting a display's token secret, or deleting the display, is a change to it
+invalidation.on_change("display", _display_changed)
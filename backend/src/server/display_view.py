@@ -1,27 +1,64 @@
+import hashlib
+
 import flask
 from flask import Blueprint, render_template
 
+from server.api import display_bootstrap, display_bootstrap_version
 from server.database import DatabaseController
+from server.display import Display
+from server.display_token import make_display_token
 
 blueprint = Blueprint("display_view", __name__, url_prefix="/display")
 
 
 @blueprint.route("/<int:department_id>/<int:display_id>/")
 def display(department_id: int, display_id: int):
-    """Return the display view page for a given group"""
-    db = DatabaseController.get()
-    if not db.fetch_department_by_id(department_id):
-        flask.abort(404)
-
-    display = db.fetch_display_by_id(display_id)
-
-    if not display:
-        flask.abort(404)
-    return render_template(
-        "display.j2",
-        display_config={
-            "department": department_id,
-            "layout": display.render(db),
-            "displayContentStream": display.content_stream,
-        },
-    )
+    """Return the display view page for a given group.
+
+    The rendered layout is cached, so a display whose layout and starting data
+    have not changed since the client last fetched it is answered with 304 Not
+    Modified.
+
+    The page carries a display token, which the display uses to read its content,
+    people and files from the API without logging in. It also carries the data its
+    widgets start with, so that the display can show everything without waiting
+    on a request per widget. The page's ETag covers the version of that data as
+    well as the layout, and it has no Last-Modified date since the data has none.
+    """
+    rendered = Display.fetch_rendered(department_id, display_id)
+
+    if rendered is None:
+        db = DatabaseController.get()
+        if not db.fetch_department_by_id(department_id):
+            flask.abort(404)
+
+        token = make_display_token(department_id, display_id)
+        if token is None:
+            # There is no such display in the department
+            flask.abort(404)
+
+        display = db.fetch_display_by_id(display_id)
+        rendered = display.render_cached(db, department_id, token)
+
+    version = display_bootstrap_version(department_id, rendered)
+    etag = hashlib.sha256(f"{rendered.etag}:{version}".encode()).hexdigest()
+
+    if flask.request.if_none_match.contains(etag):
+        response = flask.Response(status=304)
+    else:
+        response = flask.make_response(
+            render_template(
+                "display.j2",
+                display_config={
+                    "department": department_id,
+                    "layout": rendered.layout,
+                    "displayContentStream": rendered.content_stream,
+                    "token": rendered.token,
+                    "bootstrap": display_bootstrap(department_id, rendered),
+                },
+            )
+        )
+
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response.make_conditional(flask.request)
@@ -22,3 +22,5 @@ class BinaryContent(CaptionedContent, ABC):
         super().__init__(caption, streams, content_id, posted)
         self.mime_type = mime_type
         self.blob = blob
+        # The hash of the blob if it is kept in the blob store, rather than inline
+        self.blob_hash: Optional[str] = None
@@ -2,6 +2,7 @@ import io
 import json
 import sqlite3
 from datetime import datetime
+from typing import Optional
 
 import PIL.Image
 from werkzeug.datastructures import ImmutableMultiDict, MultiDict
@@ -17,6 +18,7 @@ from server.free_form_content import (
     LocalVideo,
 )
 from server.free_form_content.free_form_content import FreeFormContent
+from server.image_variants import strip_metadata
 
 
 def form_has_field(form: dict, field: str) -> bool:
@@ -24,6 +26,22 @@ def form_has_field(form: dict, field: str) -> bool:
     return field in form and form[field]
 
 
+def parse_expiry(value) -> Optional[datetime]:
+    """Parse when content expires from a form, which may be a Unix timestamp or an
+    ISO 8601 date and time (as sent by a datetime-local input), or empty if the
+    content never expires. Throws ValueError if it is none of these."""
+    if value is None or value == "":
+        return None
+
+    try:
+        if isinstance(value, (int, float)) or str(value).isdigit():
+            return datetime.fromtimestamp(int(value))
+        else:
+            return datetime.fromisoformat(value)
+    except (OverflowError, OSError, TypeError) as e:
+        raise ValueError(f"Invalid expiry {value!r}") from e
+
+
 def from_form(form: ImmutableMultiDict, files: dict) -> FreeFormContent:
     """Deserialize the appropriate content object from the given form dictionary
     and files. Throws UnknownContentError if the content type is not 'text',
@@ -33,7 +51,12 @@ def from_form(form: ImmutableMultiDict, files: dict) -> FreeFormContent:
     """
 
     form = MultiDict(form)  # Make form mutable
+    content = _content_from_form(form, files)
+    content.expires_at = parse_expiry(form.get("expires_at"))
+    return content
+
 
+def _content_from_form(form: MultiDict, files: dict) -> FreeFormContent:
     content_type = form["type"]
     streams = form.getlist("content_stream", type=int)
 
@@ -55,7 +78,7 @@ def from_form(form: ImmutableMultiDict, files: dict) -> FreeFormContent:
         image.verify()
 
         mime = image.get_format_mimetype()
-        return LocalImage(mime, image_data, caption, streams)
+        return LocalImage(mime, strip_metadata(image_data), caption, streams)
     elif content_type == "local_video":
         # Load and verify the file, throwing an error if it isn't a valid image
         video_data = files["video_data"].read()
@@ -79,11 +102,19 @@ def from_sql(cursor: sqlite3.Cursor, row: tuple) -> FreeFormContent:
     """
 
     row = sqlite3.Row(cursor, row)
+    content = _content_from_row(row)
+    if "expires_at" in row.keys() and row["expires_at"] is not None:
+        content.expires_at = datetime.fromtimestamp(row["expires_at"])
+    return content
+
+
+def _content_from_row(row: sqlite3.Row) -> FreeFormContent:
     content_type = row["content_type"]
     content_id = row["id"]
     posted = datetime.fromtimestamp(row["posted"])
     data = json.loads(row["content_json"])
     blob_data = row["content_blob"] if "content_blob" in row.keys() else None
+    blob_hash = row["blob_hash"] if "blob_hash" in row.keys() else None
     mime = row["blob_mime_type"]
     streams = []  # We don't load it from the DB here since it isn't needed
 
@@ -98,13 +129,17 @@ def from_sql(cursor: sqlite3.Cursor, row: tuple) -> FreeFormContent:
             data["title"], data["body"], streams, content_id=content_id, posted=posted
         )
     elif content_type == "local_image":
-        return LocalImage(
+        content = LocalImage(
             mime, blob_data, caption, streams, content_id=content_id, posted=posted
         )
+        content.blob_hash = blob_hash
+        return content
     elif content_type == "local_video":
-        return LocalVideo(
+        content = LocalVideo(
             mime, blob_data, caption, streams, content_id=content_id, posted=posted
         )
+        content.blob_hash = blob_hash
+        return content
     elif content_type == "remote_image":
         return RemoteImage(
             data["src"], caption, streams, content_id=content_id, posted=posted
@@ -21,12 +21,18 @@ class ContentStream:
         department: Optional[int] = None,
         display_id: Optional[int] = None,
         stream_id: Optional[int] = None,
+        retain_count: Optional[int] = None,
+        retain_seconds: Optional[int] = None,
     ):
         self.name = name
         self.department = department
         self.display = display_id
         self.id = stream_id
         self.permissions = permissions
+        # How many of the newest posts the stream keeps, and for how long, if
+        # limited. Older posts are removed from the stream by the sweeper.
+        self.retain_count = retain_count
+        self.retain_seconds = retain_seconds
 
     def __repr__(self):
         return json.dumps(self.to_http_json())
@@ -50,6 +56,10 @@ class ContentStream:
             "name": self.name,
         }
         props = {"id": self.id, "name": self.name, "permissions": self.permissions}
+        if self.retain_count is not None:
+            props["retain_count"] = self.retain_count
+        if self.retain_seconds is not None:
+            props["retain_seconds"] = self.retain_seconds
 
         return combine(props, grouping)
 
@@ -64,6 +74,10 @@ class ContentStream:
             stream_id=row["id"],
             display_id=row["display"],
             permissions=row["permissions"],
+            retain_count=row["retain_count"] if "retain_count" in row.keys() else None,
+            retain_seconds=(
+                row["retain_seconds"] if "retain_seconds" in row.keys() else None
+            ),
         )
 
     @staticmethod
@@ -73,4 +87,10 @@ class ContentStream:
             name=form["name"],
             department=int(dept) if (dept := form.get("department")) else None,
             permissions=form["permissions"],
+            retain_count=int(count) if (count := form.get("retain_count")) else None,
+            retain_seconds=(
+                int(float(days) * 24 * 60 * 60)
+                if (days := form.get("retain_days"))
+                else None
+            ),
         )
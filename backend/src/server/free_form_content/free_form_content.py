@@ -18,6 +18,8 @@ class FreeFormContent(ABC):
         self.streams = streams
         self.id = content_id
         self.posted = posted
+        # When the content stops being shown and is deleted, if ever
+        self.expires_at: Optional[datetime] = None
 
     @abstractmethod
     def to_db_json(self) -> dict:
@@ -39,11 +41,12 @@ class FreeFormContent(ABC):
             self.posted is not None
         ), "Post timestamp must be present when serializing to HTTP json"
 
-        return combine(
-            self.to_db_json(),
-            {
-                "type": self.type(),
-                "id": self.id,
-                "posted": int(self.posted.timestamp()),
-            },
-        )
+        props = {
+            "type": self.type(),
+            "id": self.id,
+            "posted": int(self.posted.timestamp()),
+        }
+        if self.expires_at is not None:
+            props["expires_at"] = int(self.expires_at.timestamp())
+
+        return combine(self.to_db_json(), props)
@@ -18,9 +18,12 @@ class LocalImage(BinaryContent):
         posted: Optional[datetime] = None,
     ):
         super().__init__(mime_type, image_data, caption, streams, content_id, posted)
-        self.image_data = image_data
         self.mime_type = mime_type
         self.caption = caption
 
+    @property
+    def image_data(self) -> bytes:
+        return self.blob
+
     def type(self) -> str:
         return "local_image"
@@ -18,9 +18,12 @@ class LocalVideo(BinaryContent):
         posted: Optional[datetime] = None,
     ):
         super().__init__(mime_type, video_data, caption, streams, content_id, posted)
-        self.video_data = video_data
         self.mime_type = mime_type
         self.caption = caption
 
+    @property
+    def video_data(self) -> bytes:
+        return self.blob
+
     def type(self) -> str:
         return "local_video"
@@ -0,0 +1,160 @@
+import io
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from threading import Lock
+from typing import Optional
+
+import PIL.Image
+import PIL.ImageOps
+import PIL.JpegImagePlugin
+
+# The widths images are resized to. The smallest is for thumbnails in the
+# configuration UI, and the rest are common display sizes.
+VARIANT_WIDTHS = [320, 1280, 1920]
+
+WEBP_MIME_TYPE = "image/webp"
+WEBP_QUALITY = 80
+
+# The formats the variants of an image in each format are encoded in, besides WebP.
+# Formats which aren't listed only get WebP variants.
+FALLBACK_FORMATS = {
+    "image/jpeg": "JPEG",
+    "image/png": "PNG",
+}
+
+# The metadata which is stripped from uploaded images, as found in `Image.info`.
+# Colour profiles are kept, since images look wrong without them.
+METADATA_KEYS = ["exif", "xmp", "XML:com.adobe.xmp", "comment"]
+
+_executor: Optional[ProcessPoolExecutor] = None
+_executor_lock = Lock()
+
+
+def make_variants(data: bytes, mime_type: str) -> Future:
+    """Generate the variants of the given image in a worker process, so that
+    encoding them doesn't hold up the server. The future resolves to a list of
+    (width, MIME type, data) tuples, as returned by `encode_variants`."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = _start_executor()
+        try:
+            return _executor.submit(encode_variants, data, mime_type)
+        except BrokenProcessPool:
+            # A worker died, such as by running out of memory, which leaves the pool
+            # unusable, so start another
+            _executor = _start_executor()
+            return _executor.submit(encode_variants, data, mime_type)
+
+
+def _start_executor() -> ProcessPoolExecutor:
+    # Forking a threaded server is unsafe, so start the workers afresh
+    return ProcessPoolExecutor(mp_context=multiprocessing.get_context("spawn"))
+
+
+def strip_metadata(data: bytes) -> bytes:
+    """Strip the metadata from the given uploaded image, so that the original
+    doesn't leak e.g. where a photo was taken any more than its variants do. EXIF
+    orientation is applied to the pixels instead.
+
+    Only the formats variants are made in besides WebP are stripped, since they can
+    be re-encoded without losing quality: PNGs losslessly, and JPEGs with their own
+    quantization tables. Images without metadata are returned as they are."""
+    with PIL.Image.open(io.BytesIO(data)) as image:
+        if (
+            image.get_format_mimetype() not in FALLBACK_FORMATS
+            or getattr(image, "is_animated", False)
+            or not (
+                any(key in image.info for key in METADATA_KEYS)
+                or getattr(image, "text", None)
+            )
+        ):
+            return data
+
+        options = {}
+        if image.info.get("icc_profile"):
+            options["icc_profile"] = image.info["icc_profile"]
+        if image.format == "JPEG":
+            options["qtables"] = image.quantization
+            subsampling = PIL.JpegImagePlugin.get_sampling(image)
+            if subsampling != -1:
+                options["subsampling"] = subsampling
+
+        out = io.BytesIO()
+        # No metadata is passed to save, so none is written
+        PIL.ImageOps.exif_transpose(image).save(out, image.format, **options)
+        return out.getvalue()
+
+
+def encode_variants(data: bytes, mime_type: str) -> list[tuple[int, str, bytes]]:
+    """Resize the given image to each of `VARIANT_WIDTHS` narrower than it, plus its
+    own width, and encode each size as WebP and, if possible, the original format.
+
+    EXIF orientation is applied to the pixels and all metadata is stripped, so
+    variants display the right way up and don't leak e.g. where a photo was taken.
+    """
+    with PIL.Image.open(io.BytesIO(data)) as original:
+        if getattr(original, "is_animated", False):
+            # Resizing would only keep the first frame
+            return []
+
+        image = PIL.ImageOps.exif_transpose(original)
+
+    # Palette and CMYK images can't be resized smoothly or saved as WebP
+    if image.mode not in ("RGB", "RGBA"):
+        has_alpha = "A" in image.getbands() or "transparency" in image.info
+        image = image.convert("RGBA" if has_alpha else "RGB")
+
+    widths = [width for width in VARIANT_WIDTHS if width < image.width]
+    widths.append(image.width)
+
+    fallback_format = FALLBACK_FORMATS.get(mime_type)
+    variants = []
+    for width in widths:
+        height = max(1, round(image.height * width / image.width))
+        resized = image.resize((width, height), PIL.Image.Resampling.LANCZOS)
+
+        variants.append((width, WEBP_MIME_TYPE, _encode(resized, "WEBP")))
+        if fallback_format:
+            variants.append((width, mime_type, _encode(resized, fallback_format)))
+
+    return variants
+
+
+def _encode(image: PIL.Image.Image, image_format: str) -> bytes:
+    out = io.BytesIO()
+    if image_format == "JPEG":
+        image = image.convert("RGB")
+        image.save(out, image_format, quality=85, optimize=True)
+    elif image_format == "WEBP":
+        image.save(out, image_format, quality=WEBP_QUALITY, method=4)
+    else:
+        image.save(out, image_format, optimize=True)
+
+    # No metadata is passed to save, so none is written
+    return out.getvalue()
+
+
+def choose_variant(
+    variants: list[tuple[int, str, str]],
+    width: Optional[int],
+    mime_types: list[str],
+) -> Optional[tuple[int, str, str]]:
+    """Choose the best of the given (width, MIME type, hash) variants for a screen
+    wanting the given width, in the first of the given MIME types it has. The
+    narrowest variant at least that wide is chosen, or else the widest. If no
+    width is given, the widest is chosen."""
+    for mime_type in mime_types:
+        candidates = sorted(variant for variant in variants if variant[1] == mime_type)
+        if not candidates:
+            continue
+
+        if width is None:
+            return candidates[-1]
+        return next(
+            (variant for variant in candidates if variant[0] >= width),
+            candidates[-1],
+        )
+
+    return None
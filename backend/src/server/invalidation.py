@@ -0,0 +1,76 @@
+import threading
+from collections import defaultdict
+from typing import Callable, Optional
+
+# How many changes a process catches up on one at a time. A process which is
+# further behind than this drops everything it has cached instead.
+CHANGES_SYNC_LIMIT = 1000
+
+# Called with the key which changed, or None if every key of that kind may have,
+# by kind of change
+_handlers: dict[str, list[Callable[[Optional[str]], None]]] = defaultdict(list)
+# The ID of the latest change this process has caught up on, or None if it hasn't
+# checked yet
+_seen_change = None
+_lock = threading.Lock()
+
+
+def on_change(kind: str, handler: Callable[[Optional[str]], None]):
+    """Call the given handler whenever data of the given kind changes, with the key
+    which changed, or None if every key may have. Handlers drop whatever they have
+    cached for the key, and are called for changes made by any process, including
+    this one."""
+    _handlers[kind].append(handler)
+
+
+def sync(
+    fetch_latest: Callable[[], int],
+    fetch_since: Callable[[int, int], tuple[Optional[int], list]],
+):
+    """Call the handlers for every change made since this was last called.
+
+    `fetch_latest` returns the ID of the latest change, which is all that is read
+    when nothing has changed. `fetch_since(change_id, limit)` returns the ID of the
+    oldest change still kept, along with up to `limit` changes after the given one,
+    as (id, kind, key). If changes this process hasn't seen have already been
+    deleted, or there are too many to catch up on, or this process hasn't checked
+    before, every handler is called to drop everything instead."""
+    global _seen_change
+    latest = fetch_latest()
+    with _lock:
+        if latest == _seen_change:
+            return
+
+        if _seen_change is None or latest < _seen_change:
+            _drop_all()
+        else:
+            oldest, changes = fetch_since(_seen_change, CHANGES_SYNC_LIMIT)
+            if (
+                oldest is None
+                or oldest > _seen_change + 1
+                or len(changes) == CHANGES_SYNC_LIMIT
+            ):
+                _drop_all()
+            else:
+                for change_id, kind, key in changes:
+                    for handler in _handlers.get(kind, []):
+                        handler(key)
+                    latest = change_id
+
+        _seen_change = latest
+
+
+def reset():
+    """Drop everything cached and forget which changes have been seen, so that it is
+    dropped again the next time changes are synced. This is needed when the changes
+    are wiped."""
+    global _seen_change
+    with _lock:
+        _drop_all()
+        _seen_change = None
+
+
+def _drop_all():
+    for handlers in _handlers.values():
+        for handler in handlers:
+            handler(None)
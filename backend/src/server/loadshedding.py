@@ -1,14 +1,29 @@
-import os
-from server.database import DatabaseController
+import hashlib
 import http.client
+import json
+import os
+import random
+import re
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Optional
+
 import flask
 
+from server import metrics
+from server.database import DatabaseController
+
 
 class Loadshedding:
     """This class handles the backend Loadshedding process which is calling the ESP API
     and getting the information an storing it in the database.
-    Right now the system is configured to only fetch information for the UCT area
-    but this has been built for later alteration of multiple areas"""
+    Each region's schedule is stored under its number, which is its position in
+    `regions` counting from 1. The regions can be overridden with a comma separated
+    list of area IDs in the ESP_AREAS environment variable."""
 
     interval = 1800
     endpoints = [
@@ -16,31 +31,309 @@ class Loadshedding:
         "/business/2.0/area?id={area_id}",
         # Add more endpoints if needed
     ]
+    allowance_endpoint = "/business/2.0/api_allowance"
     regions = [
-        "capetown-15-universityofcapetown",
-        # Add more regions as needed
+        area_id.strip()
+        for area_id in os.environ.get(
+            "ESP_AREAS", "capetown-15-universityofcapetown"
+        ).split(",")
+        if area_id.strip()
     ]
+    host = os.environ.get("ESP_API_HOST", "developer.sepush.co.za")
     key = os.environ.get("ESP_LICENSE_KEY")
     # this is the license key that is stored in the .env file
 
-    @staticmethod
-    def update_loadshedding_schedule(region, app_current):
-        host = "developer.sepush.co.za"
-        areaid = Loadshedding.regions[region - 1]
-        if flask.current_app.config["TESTING"]:
-            path = Loadshedding.endpoints[0].replace("{area_id}", areaid)
-        else:
-            path = Loadshedding.endpoints[1].replace("{area_id}", areaid)
-            # when doing demos or final product switch the above line to "endpoints[1]"
-        token = Loadshedding.key
-        conn = http.client.HTTPSConnection(host)
-        headers = {"token": token}
-        conn.request("GET", path, headers=headers)
-        response = conn.getresponse()
-        if response.status == 200:
-            response_data = response.read().decode("utf-8")
-            DatabaseController.get().update_loadshedding_schedule(region, response_data)
-
-        else:
-            print(f"Request failed with status code {response.status}")
-        conn.close()
+
+# How often the fetcher wakes up to renew its lease and fetch any regions which are
+# due, in seconds
+FETCHER_TICK = 30
+# Only the process holding this lease fetches, so that the API is called once per
+# deployment rather than once per worker. It expires if the holder stops renewing
+# it, so that another process takes over.
+FETCHER_LEASE = "loadshedding_fetcher"
+FETCHER_LEASE_DURATION = FETCHER_TICK * 3
+
+# After the nth failure in a row, a region is retried after about
+# BACKOFF_BASE * 2^(n-1) seconds, but never more than the usual interval
+BACKOFF_BASE = 30
+
+# How long a request to the API may take, in seconds
+REQUEST_TIMEOUT = 30
+
+# The number of seconds the API's allowance is counted over
+ALLOWANCE_PERIOD = 24 * 60 * 60
+
+
+def summarize_schedule(schedule_json: str, now: datetime) -> bytes:
+    """Trim the given area schedule from the ESP API down to what displays show, as
+    JSON: the area's `name` and the `events` which haven't ended by `now`, in order.
+    Each event has a `start`, an `end` and a `stage`. What is going on at any moment
+    is worked out from these when the summary is sent, see `current_summary`."""
+    schedule = json.loads(schedule_json)
+
+    events = []
+    for event in schedule.get("events") or []:
+        start = datetime.fromisoformat(event["start"])
+        end = datetime.fromisoformat(event["end"])
+        if end <= now:
+            continue
+
+        stage = re.search(r"\d+", event.get("note") or "")
+        events.append(
+            (
+                start,
+                {
+                    "start": event["start"],
+                    "end": event["end"],
+                    "stage": int(stage.group()) if stage else None,
+                },
+            )
+        )
+    events.sort(key=lambda event: event[0])
+
+    summary = {
+        "name": (schedule.get("info") or {}).get("name"),
+        "events": [event for _, event in events],
+    }
+    return json.dumps(summary, separators=(",", ":")).encode("utf-8")
+
+
+def current_summary(summary_json: bytes, now: datetime) -> tuple[bytes, str]:
+    """Bring the given summary made by `summarize_schedule` up to `now`, as
+    ready-to-send JSON along with its hash to use as an ETag: the events which have
+    ended since are dropped, and the `stage` of any loadshedding going on (0 if
+    there isn't any) and the `next` outage to start are added. Summaries are made
+    when schedules are fetched, which can be hours apart, so this is done whenever
+    one is sent."""
+    summary = json.loads(summary_json)
+    events = [
+        (datetime.fromisoformat(event["start"]), event)
+        for event in summary.get("events") or []
+        if datetime.fromisoformat(event["end"]) > now
+    ]
+
+    current = [event for start, event in events if start <= now]
+    upcoming = [event for start, event in events if start > now]
+    current_json = json.dumps(
+        {
+            "name": summary.get("name"),
+            "stage": (current[0]["stage"] or 0) if current else 0,
+            "next": upcoming[0] if upcoming else None,
+            "events": [event for _, event in events],
+        },
+        separators=(",", ":"),
+    ).encode("utf-8")
+    return current_json, hashlib.sha256(current_json).hexdigest()
+
+
+class LoadsheddingFetcher:
+    """Fetches the loadshedding schedule of every region from the ESP API on a
+    schedule, in a background thread.
+
+    The regions are fetched concurrently over kept-alive connections. A region which
+    fails is retried with exponential backoff and jitter, and regions are fetched
+    less often if the API's allowance wouldn't otherwise last. A schedule is only
+    written to the database if it has changed."""
+
+    def __init__(
+        self,
+        app: flask.Flask,
+        regions: Optional[list[str]] = None,
+        host: Optional[str] = None,
+        port: Optional[int] = None,
+        https: bool = True,
+        key: Optional[str] = None,
+        interval: Optional[float] = None,
+    ):
+        self.app = app
+        self.regions = regions if regions is not None else Loadshedding.regions
+        self.host = host or Loadshedding.host
+        self.port = port
+        self.https = https
+        self.key = key if key is not None else Loadshedding.key
+        self.interval = interval or Loadshedding.interval
+
+        # Identifies this fetcher as the holder of the lease
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}"
+
+        # When each region is next due to be fetched, and how many times in a row
+        # fetching it has failed, by region number
+        self.next_fetch = {region: 0.0 for region in range(1, len(self.regions) + 1)}
+        self.failures = {region: 0 for region in self.next_fetch}
+
+        self._pool = ThreadPoolExecutor(
+            max_workers=max(1, len(self.regions)),
+            thread_name_prefix="loadshedding",
+        )
+        self._connections = threading.local()
+        self._stopped = threading.Event()
+
+    def start(self) -> threading.Thread:
+        """Start fetching in a daemon thread"""
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        """Stop fetching once the current round of fetches is done"""
+        self._stopped.set()
+
+    def run(self):
+        """Fetch whichever regions are due every FETCHER_TICK seconds until stopped,
+        whenever this process holds the lease"""
+        while not self._stopped.is_set():
+            # A fresh app context each time means the connection goes back to the
+            # pool in between
+            with self.app.app_context():
+                try:
+                    db = DatabaseController.get()
+                    if db.acquire_lease(
+                        FETCHER_LEASE, self.holder, FETCHER_LEASE_DURATION
+                    ):
+                        self.fetch_due(db)
+                except Exception as e:
+                    # Try again next time rather than stopping fetching altogether
+                    print(f"Failed to fetch loadshedding schedules: {e}")
+            self._stopped.wait(FETCHER_TICK)
+
+    def fetch_due(self, db: DatabaseController) -> dict[int, bool]:
+        """Fetch every region which is due now, returning whether each one fetched
+        was fetched successfully by region number"""
+        now = time.time()
+        due = [region for region, at in self.next_fetch.items() if at <= now]
+        if not due:
+            return {}
+
+        allowance = self.fetch_allowance()
+        if allowance is not None:
+            count, limit = allowance
+            if count + len(due) > limit:
+                print("Loadshedding API allowance used up, waiting for it to reset")
+                for region in due:
+                    self.next_fetch[region] = now + self.interval
+                return {}
+
+        results = {}
+        for region, response in zip(due, self._pool.map(self.fetch_region, due)):
+            results[region] = self._handle_response(db, region, response, allowance)
+        return results
+
+    def fetch_region(self, region: int) -> Optional[tuple[int, dict, bytes]]:
+        """Fetch the schedule of the given region, returning the response's status,
+        headers and body, or None if it couldn't be fetched at all"""
+        endpoint = Loadshedding.endpoints[0 if self.app.config["TESTING"] else 1]
+        return self._request(endpoint.replace("{area_id}", self.regions[region - 1]))
+
+    def fetch_allowance(self) -> Optional[tuple[int, int]]:
+        """Fetch how many API calls have been used so far today and how many are
+        allowed, or None if that isn't known. Checking doesn't count as a call."""
+        response = self._request(Loadshedding.allowance_endpoint)
+        if response is None or response[0] != 200:
+            return None
+
+        try:
+            allowance = json.loads(response[2])["allowance"]
+            return int(allowance["count"]), int(allowance["limit"])
+        except (ValueError, KeyError, TypeError):
+            return None
+
+    def _handle_response(
+        self,
+        db: DatabaseController,
+        region: int,
+        response: Optional[tuple[int, dict, bytes]],
+        allowance: Optional[tuple[int, int]],
+    ) -> bool:
+        now = time.time()
+        if response is not None and response[0] == 200:
+            try:
+                schedule = response[2].decode("utf-8")
+                summary = summarize_schedule(schedule, datetime.now(timezone.utc))
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                print(f"Region {region}'s schedule couldn't be read: {e}")
+            else:
+                self._handle_schedule(db, region, schedule, summary, allowance)
+                metrics.inc(
+                    "campusign_loadshedding_fetches_total",
+                    {"region": str(region), "result": "success"},
+                )
+                metrics.set_value(
+                    "campusign_loadshedding_last_success_timestamp_seconds",
+                    {"region": str(region)},
+                    now,
+                )
+                return True
+
+        metrics.inc(
+            "campusign_loadshedding_fetches_total",
+            {"region": str(region), "result": "failure"},
+        )
+        self.failures[region] += 1
+        delay = min(self.interval, BACKOFF_BASE * 2 ** (self.failures[region] - 1))
+        # Jitter keeps regions (and deployments) from retrying in lockstep
+        delay = delay / 2 + random.uniform(0, delay / 2)
+
+        if response is not None and response[0] != 200:
+            print(f"Request for region {region} failed with status {response[0]}")
+            retry_after = response[1].get("retry-after", "")
+            if response[0] == 429 and retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+
+        self.next_fetch[region] = now + delay
+        return False
+
+    def _handle_schedule(
+        self,
+        db: DatabaseController,
+        region: int,
+        schedule: str,
+        summary: bytes,
+        allowance: Optional[tuple[int, int]],
+    ):
+        db.update_loadshedding_schedule(region, schedule, summary)
+        self.failures[region] = 0
+
+        interval = self.interval
+        if allowance is not None and allowance[1] > 0:
+            # Spread the allowance across the day rather than using it up early
+            interval = max(
+                interval, ALLOWANCE_PERIOD * len(self.regions) / allowance[1]
+            )
+        self.next_fetch[region] = time.time() + interval
+
+    def _request(self, path: str) -> Optional[tuple[int, dict, bytes]]:
+        """GET the given path from the API over this thread's kept-alive connection,
+        reconnecting once if the connection had been dropped"""
+        for attempt in range(2):
+            connection = getattr(self._connections, "connection", None)
+            if connection is None:
+                connection_class = (
+                    http.client.HTTPSConnection
+                    if self.https
+                    else http.client.HTTPConnection
+                )
+                connection = connection_class(
+                    self.host, self.port, timeout=REQUEST_TIMEOUT
+                )
+                self._connections.connection = connection
+
+            try:
+                connection.request("GET", path, headers={"token": self.key or ""})
+                response = connection.getresponse()
+                body = response.read()
+                headers = {name.lower(): value for name, value in response.getheaders()}
+                if response.will_close:
+                    self._close_connection()
+                return response.status, headers, body
+            except (OSError, http.client.HTTPException) as e:
+                self._close_connection()
+                if attempt == 1:
+                    print(f"Failed to reach the loadshedding API: {e}")
+
+        return None
+
+    def _close_connection(self):
+        connection = getattr(self._connections, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._connections.connection = None
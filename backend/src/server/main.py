@@ -1,5 +1,9 @@
 import time
 import os
+import socket
+import sqlite3
+import uuid
+import flask
 from flask import Flask
 from server import (
     config_view,
@@ -7,16 +11,30 @@ from server import (
     index,
     api,
     login,
+    metrics,
     registration,
 )
 from server.display import PageTemplate
-from server.loadshedding import Loadshedding
+from server.loadshedding import Loadshedding, LoadsheddingFetcher
+from server.rss import RSSPoller
 from flask_login import LoginManager
 from server.database import DatabaseController
-from server.user import User
 from threading import Thread
 from dotenv import load_dotenv
 
+# How often expired content is swept away, in seconds
+SWEEP_INTERVAL = 60
+# Only the process holding this lease sweeps, so that workers don't fight over the
+# write lock to do the same work
+SWEEPER_LEASE = "content_sweeper"
+SWEEPER_LEASE_DURATION = SWEEP_INTERVAL * 3
+# How long changes to cached data are kept for processes to catch up on, in seconds.
+# A process which hasn't checked for longer than this drops everything it caches.
+CHANGES_EXPIRY = 60 * 60
+# How long the change log is kept for clients to sync incrementally from, in seconds.
+# A client which hasn't synced for longer than this has to read everything again.
+CHANGE_LOG_EXPIRY = 7 * 24 * 60 * 60
+
 
 def create_app(testing=False):
     """Create and configure the flask app"""
@@ -30,13 +48,13 @@ def create_app(testing=False):
     login_manager = LoginManager()
     login_manager.init_app(app)
     login_manager.login_view = "login.login"
-    app.secret_key = "uihfewheiwheiuhwiuehw"
+    # Sessions and display tokens are signed with this, so deployments should set
+    # their own
+    app.secret_key = os.environ.get("CAMPUSIGN_SECRET_KEY") or "uihfewheiwheiuhwiuehw"
 
     @login_manager.user_loader
     def load_user(user_id):
-        attr_list = DatabaseController.get().get_user(user_id)
-        loaded_user = User(attr_list[0], attr_list[1], attr_list[2], attr_list[3])
-        return loaded_user
+        return DatabaseController.get().load_user(user_id)
 
     # Register blueprints for each logical part of the app
     app.register_blueprint(registration.blueprint)
@@ -62,23 +80,109 @@ def create_app(testing=False):
                 "superuser",
             )
 
+    app.before_request(metrics.start_request)
+    app.before_request(sync_caches)
+    app.after_request(metrics.finish_request)
+
     @app.teardown_appcontext
     def teardown_db(exception):
         DatabaseController.teardown()
 
+    register_commands(app)
     PageTemplate.register_filters(app)
-    # this threading is used to have the repeating daily fetches of the ESP API
-    Thread(
-        target=repeat_update_loadshedding,
-        args=(Loadshedding.interval, app.app_context()),
-        daemon=True,
-    ).start()
+    # Fetch loadshedding schedules from the ESP API in the background. Every process
+    # starts a fetcher, but only the one holding the lease actually fetches.
+    if Loadshedding.key:
+        LoadsheddingFetcher(app).start()
+    else:
+        print("ESP_LICENSE_KEY is not set, so loadshedding won't be fetched")
+    # Poll the RSS feeds displays show in the background. As with loadshedding, only
+    # the process holding the lease actually polls.
+    if not testing:
+        RSSPoller(app).start()
+        # Each process writes its metrics to the database regularly, so that any of
+        # them can report the metrics of them all
+        Thread(
+            target=repeat_flush_metrics,
+            args=(metrics.METRICS_FLUSH_INTERVAL, app),
+            daemon=True,
+        ).start()
+        # As with RSS feeds, only the process holding the lease actually sweeps
+        Thread(
+            target=repeat_sweep_content,
+            args=(SWEEP_INTERVAL, app),
+            daemon=True,
+        ).start()
 
     return app
 
 
-def repeat_update_loadshedding(interval, app):
-    with app:
-        while True:
-            Loadshedding.update_loadshedding_schedule(1, app)
-            time.sleep(interval)
+def register_commands(app: Flask):
+    """Register the maintenance commands which can be run with `flask <command>`"""
+
+    @app.cli.command("migrate-blobs")
+    def migrate_blobs():
+        """Move binary data stored inline in the database into the blob store"""
+        moved = DatabaseController.get().migrate_blobs_to_store()
+        print(f"Moved {moved} blobs into the blob store")
+
+    @app.cli.command("enable-incremental-vacuum")
+    def enable_incremental_vacuum():
+        """Rebuild the database so that the sweeper can shrink it"""
+        if DatabaseController.get().enable_incremental_vacuum():
+            print("Rebuilt the database with incremental vacuuming")
+        else:
+            print("Incremental vacuuming is already enabled")
+
+    @app.cli.command("make-image-variants")
+    def make_image_variants():
+        """Generate the resized variants of images posted before they existed"""
+        db = DatabaseController.get()
+        content_ids = db.fetch_local_images_without_variants()
+        for content_id in content_ids:
+            api.add_image_variants(
+                [(content_id, db.fetch_content_by_id(content_id, fetch_blob=True))]
+            )
+        print(f"Made variants of {len(content_ids)} images")
+
+
+def sync_caches():
+    """Drop whatever another process has changed the data of from this process's
+    caches before handling a request. Static files don't touch the database, so
+    aren't held up by this."""
+    if flask.request.endpoint != "static":
+        DatabaseController.get().sync_caches()
+
+
+def repeat_sweep_content(interval, app):
+    """Delete expired content and content beyond its streams' retention policies,
+    along with old changes to cached data and old entries in the change log, every
+    `interval` seconds, whenever this process holds the sweeper's lease"""
+    holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}"
+    while True:
+        time.sleep(interval)
+        # A fresh app context each time means the connection goes back to the pool
+        # in between sweeps
+        with app.app_context():
+            try:
+                db = DatabaseController.get()
+                if not db.acquire_lease(SWEEPER_LEASE, holder, SWEEPER_LEASE_DURATION):
+                    continue
+                db.sweep_content()
+                db.trim_changes(time.time() - CHANGES_EXPIRY)
+                db.trim_change_log(time.time() - CHANGE_LOG_EXPIRY)
+            except sqlite3.Error as e:
+                # Try again next time rather than stopping sweeping altogether
+                print(f"Failed to sweep content: {e}")
+
+
+def repeat_flush_metrics(interval, app):
+    """Write this process's metrics to the database every `interval` seconds"""
+    while True:
+        time.sleep(interval)
+        with app.app_context():
+            try:
+                metrics.flush(DatabaseController.get())
+            except sqlite3.Error as e:
+                # Try again next time rather than stopping flushing altogether
+                print(f"Failed to flush metrics: {e}")
@@ -0,0 +1,328 @@
+import json
+import math
+import os
+import socket
+import threading
+import time
+import uuid
+from typing import Optional
+
+import flask
+
+from server.cache import named_caches
+from server.database import DatabaseController
+from server.display_token import request_display_token
+
+# How often each process writes its metrics to the database, in seconds
+METRICS_FLUSH_INTERVAL = 15
+# A process which hasn't written its metrics for this long is assumed to have
+# stopped, so its gauges of what is going on right now are left out
+METRICS_PROCESS_TIMEOUT = METRICS_FLUSH_INTERVAL * 3
+# The metrics of a process which stopped this long ago are deleted. Counters which
+# only it had counted then look like they were reset, which Prometheus allows for.
+METRICS_EXPIRY = 24 * 60 * 60
+
+# The upper bounds of the request duration histogram's buckets, in seconds
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Every metric by name, as (type, help, how the values of each process are
+# combined). "sum" adds them up, "live_sum" only adds up those of processes which
+# are still running and "max" takes the greatest. Metrics which aren't combined
+# are worked out from the others when they are reported.
+METRICS = {
+    "campusign_http_requests_total": (
+        "counter",
+        "HTTP requests handled, by endpoint, method and status.",
+        "sum",
+    ),
+    "campusign_http_request_duration_seconds": (
+        "histogram",
+        "Time taken to handle HTTP requests, not counting streaming the response"
+        " body, by endpoint.",
+        "sum",
+    ),
+    "campusign_http_response_bytes_total": (
+        "counter",
+        "Bytes of response bodies sent, by kind of response (blob, json, layout,"
+        " static or other).",
+        "sum",
+    ),
+    "campusign_db_queries_total": (
+        "counter",
+        "Database queries run while handling requests, by endpoint.",
+        "sum",
+    ),
+    "campusign_db_query_seconds_total": (
+        "counter",
+        "Time spent running database queries while handling requests, by endpoint.",
+        "sum",
+    ),
+    "campusign_event_streams_open": (
+        "gauge",
+        "Content event streams currently open, by the display they are open for"
+        " (empty for logged in users).",
+        "live_sum",
+    ),
+    "campusign_display_last_request_timestamp_seconds": (
+        "gauge",
+        "When each display last made a request, as a Unix timestamp. Displays which"
+        " poll keep this recent.",
+        "max",
+    ),
+    "campusign_loadshedding_fetches_total": (
+        "counter",
+        "Loadshedding schedule fetches, by region and result (success or failure).",
+        "sum",
+    ),
+    "campusign_loadshedding_last_success_timestamp_seconds": (
+        "gauge",
+        "When each region's loadshedding schedule was last fetched successfully, as"
+        " a Unix timestamp.",
+        "max",
+    ),
+    "campusign_loadshedding_schedule_age_seconds": (
+        "gauge",
+        "How long ago each region's loadshedding schedule was last fetched"
+        " successfully.",
+        None,
+    ),
+    "campusign_cache_requests_total": (
+        "counter",
+        "Cache lookups, by cache and result (hit or miss).",
+        "sum",
+    ),
+}
+HISTOGRAM_SUFFIXES = ("_bucket", "_sum", "_count")
+
+# This process's values of every series, by (name, labels as sorted pairs). There
+# are few enough that they are all written to the database each time.
+_values: dict[tuple[str, tuple], float] = {}
+_lock = threading.Lock()
+# Identifies this process's metrics in the database. A forked process starts afresh
+# rather than reporting its parent's metrics as its own.
+_pid = None
+_process = None
+
+
+def inc(name: str, labels: dict[str, str], amount: float = 1):
+    """Add the given amount to the series of the given metric with the given
+    labels"""
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _check_process()
+        _values[key] = _values.get(key, 0) + amount
+
+
+def set_value(name: str, labels: dict[str, str], value: float):
+    """Set the series of the given metric with the given labels to the given value,
+    such as a gauge, or a counter which is counted elsewhere"""
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _check_process()
+        _values[key] = value
+
+
+def observe(name: str, labels: dict[str, str], value: float, buckets=DURATION_BUCKETS):
+    """Count the given value in the histogram of the given metric with the given
+    labels"""
+    with _lock:
+        _check_process()
+        for bound in (*buckets, math.inf):
+            if value <= bound:
+                _add(f"{name}_bucket", {**labels, "le": _format_value(bound)}, 1)
+        _add(f"{name}_sum", labels, value)
+        _add(f"{name}_count", labels, 1)
+
+
+def _add(name: str, labels: dict[str, str], amount: float):
+    key = (name, tuple(sorted(labels.items())))
+    _values[key] = _values.get(key, 0) + amount
+
+
+def _check_process():
+    global _pid, _process
+    if _pid != os.getpid():
+        _pid = os.getpid()
+        _process = f"{socket.gethostname()}:{_pid}:{uuid.uuid4().hex}"
+        _values.clear()
+
+
+def start_request():
+    """Start timing the current request"""
+    flask.g._metrics_started = time.perf_counter()
+
+
+def finish_request(response: flask.Response) -> flask.Response:
+    """Count the current request, which is about to get the given response"""
+    started = flask.g.pop("_metrics_started", None)
+    if started is None:
+        return response
+
+    endpoint = flask.request.endpoint or ""
+    inc(
+        "campusign_http_requests_total",
+        {
+            "endpoint": endpoint,
+            "method": flask.request.method,
+            "status": str(response.status_code),
+        },
+    )
+    observe(
+        "campusign_http_request_duration_seconds",
+        {"endpoint": endpoint},
+        time.perf_counter() - started,
+    )
+    if response.content_length:
+        inc(
+            "campusign_http_response_bytes_total",
+            {"kind": _response_kind(endpoint, response)},
+            response.content_length,
+        )
+
+    # Responses which stream from the database have already taken the connection
+    db = flask.g.get("_database")
+    if db is not None and hasattr(db.db, "queries"):
+        inc("campusign_db_queries_total", {"endpoint": endpoint}, db.db.queries)
+        inc(
+            "campusign_db_query_seconds_total", {"endpoint": endpoint}, db.db.query_time
+        )
+
+    display = _requesting_display(endpoint)
+    if display is not None:
+        set_value(
+            "campusign_display_last_request_timestamp_seconds",
+            {"display": str(display)},
+            time.time(),
+        )
+
+    return response
+
+
+def _response_kind(endpoint: str, response: flask.Response) -> str:
+    if endpoint == "display_view.display":
+        return "layout"
+    elif endpoint == "static":
+        return "static"
+    elif response.is_json:
+        return "json"
+    elif response.mimetype.startswith("text/"):
+        return "other"
+    else:
+        return "blob"
+
+
+def _requesting_display(endpoint: str) -> Optional[int]:
+    """The display the current request comes from, if any"""
+    if endpoint == "display_view.display":
+        return flask.request.view_args["display_id"]
+
+    token = request_display_token()
+    return token[1] if token is not None else None
+
+
+def flush(db: DatabaseController):
+    """Write this process's metrics to the database, so that any process can report
+    them"""
+    for cache in named_caches():
+        for result, count in (("hit", cache.hits), ("miss", cache.misses)):
+            set_value(
+                "campusign_cache_requests_total",
+                {"cache": cache.name, "result": result},
+                count,
+            )
+
+    with _lock:
+        _check_process()
+        process = _process
+        series = [
+            (name, json.dumps(dict(labels)), value)
+            for (name, labels), value in _values.items()
+        ]
+
+    db.store_metrics(process, time.time(), series)
+    db.delete_stale_metrics(time.time() - METRICS_EXPIRY)
+
+
+def render(db: DatabaseController) -> str:
+    """Report the metrics of every process in the Prometheus text format"""
+    flush(db)
+
+    now = time.time()
+    combined = {}
+    for _, flushed_at, name, labels, value in db.fetch_metrics():
+        metric = _metric_of(name)
+        if metric is None:
+            # Left by an older version of the server
+            continue
+
+        key = (name, labels)
+        aggregation = METRICS[metric][2]
+        if aggregation == "max":
+            combined[key] = max(combined.get(key, value), value)
+        elif aggregation == "sum" or flushed_at >= now - METRICS_PROCESS_TIMEOUT:
+            combined[key] = combined.get(key, 0) + value
+
+    for (name, labels), value in list(combined.items()):
+        if name == "campusign_loadshedding_last_success_timestamp_seconds":
+            combined[("campusign_loadshedding_schedule_age_seconds", labels)] = (
+                now - value
+            )
+
+    lines = []
+    for metric, (kind, help_text, _) in METRICS.items():
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} {kind}")
+        series = sorted(
+            (
+                (name, json.loads(labels), value)
+                for (name, labels), value in combined.items()
+                if _metric_of(name) == metric
+            ),
+            key=_series_order,
+        )
+        for name, labels, value in series:
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def _metric_of(name: str) -> Optional[str]:
+    """The metric the series with the given name belongs to, if it is known"""
+    if name in METRICS:
+        return name
+
+    for suffix in HISTOGRAM_SUFFIXES:
+        metric = name.removesuffix(suffix)
+        if metric != name and METRICS.get(metric, ("",))[0] == "histogram":
+            return metric
+    return None
+
+
+def _series_order(series: tuple[str, dict, float]):
+    # Histograms list their buckets in order, followed by their sum and count
+    name, labels, _ = series
+    suffix = next((s for s in HISTOGRAM_SUFFIXES if name.endswith(s)), "")
+    return (
+        sorted((k, v) for k, v in labels.items() if k != "le"),
+        HISTOGRAM_SUFFIXES.index(suffix) if suffix else 0,
+        float(labels.get("le", 0)),
+    )
+
+
+def _format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+
+    def escape(value: str) -> str:
+        return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    pairs = ",".join(f'{name}="{escape(str(value))}"' for name, value in labels.items())
+    return f"{{{pairs}}}"
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    elif value == int(value):
+        return str(int(value))
+    else:
+        return repr(float(value))
@@ -0,0 +1,32 @@
+import threading
+
+
+class Notifier:
+    """Wakes up threads waiting for something to change within this process.
+
+    Waiters should still re-check the database after a timeout, since changes
+    made by other processes are not notified.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._generation = 0
+
+    def notify(self):
+        """Wake up all threads currently waiting"""
+        with self._condition:
+            self._generation += 1
+            self._condition.notify_all()
+
+    def wait(self, timeout: float) -> bool:
+        """Wait until notified or the timeout elapses, returning whether
+        this was notified"""
+        with self._condition:
+            generation = self._generation
+            return self._condition.wait_for(
+                lambda: self._generation != generation, timeout
+            )
+
+
+# Notified whenever content is posted or deleted
+content_changed = Notifier()
@@ -0,0 +1,282 @@
+import ipaddress
+import json
+import os
+import socket
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional
+from urllib.parse import urlparse
+
+import flask
+from lxml import etree
+
+from server.database import DatabaseController
+
+# How often each feed is fetched, in seconds
+RSS_POLL_INTERVAL = 15 * 60
+# How often the poller wakes up to renew its lease and fetch any feeds which are
+# due, in seconds. New feeds are fetched on the next tick.
+RSS_POLLER_TICK = 30
+# Only the process holding this lease polls, so that each feed is fetched once per
+# deployment rather than once per worker
+RSS_POLLER_LEASE = "rss_poller"
+RSS_POLLER_LEASE_DURATION = RSS_POLLER_TICK * 3
+# Feeds which no display has asked for in this many seconds stop being polled
+RSS_FEED_EXPIRY = 7 * 24 * 60 * 60
+
+# How many items are kept from each feed
+RSS_ITEM_LIMIT = 50
+# Feeds bigger than this many bytes are ignored
+RSS_MAX_SIZE = 5 * 1024 * 1024
+# How long fetching a feed may take, in seconds
+RSS_FETCH_TIMEOUT = 20
+# Whether feeds may be fetched from loopback, private and other addresses which
+# aren't on the public internet. Any user may ask for any feed, so this keeps them
+# from using the server to reach its own network.
+RSS_ALLOW_PRIVATE_ADDRESSES = False
+
+MEDIA_NAMESPACE = "http://search.yahoo.com/mrss/"
+
+# Feeds come from anywhere, so entities must not be expanded (e.g. billion laughs)
+# and nothing may be fetched while parsing
+_parser = etree.XMLParser(
+    resolve_entities=False, no_network=True, recover=True, remove_comments=True
+)
+
+
+def parse_feed(data: bytes) -> list[dict]:
+    """Parse the given RSS or Atom feed into a list of items, newest first. Each
+    item has a `title`, `link`, `body`, `image` and `published` (a Unix timestamp),
+    any of which may be None if the feed doesn't have it."""
+    root = etree.fromstring(data, _parser)
+    if root is None:
+        raise ValueError("Not an XML document")
+
+    items = []
+    for element in root.iter(etree.Element):
+        if etree.QName(element).localname in ("item", "entry"):
+            items.append(_parse_item(element))
+
+    items.sort(key=lambda item: item["published"] or 0, reverse=True)
+    return items[:RSS_ITEM_LIMIT]
+
+
+def _parse_item(item: etree.Element) -> dict:
+    link = _child(item, "link")
+    if link is not None and link.get("href"):
+        # Atom links are attributes
+        link = link.get("href")
+    else:
+        link = _text(link)
+
+    body = _child(item, "description", "summary", "content")
+    published = _child(item, "pubDate", "published", "updated", "date")
+    return {
+        "title": _text(_child(item, "title")),
+        "link": link,
+        "body": _text(body),
+        "image": _image(item),
+        "published": _parse_date(_text(published)),
+    }
+
+
+def _child(element: etree.Element, *names: str) -> Optional[etree.Element]:
+    """Find the first child with any of the given names, in order of preference,
+    ignoring namespaces"""
+    children = {}
+    for child in element.iterchildren(etree.Element):
+        children.setdefault(etree.QName(child).localname, child)
+    return next((children[name] for name in names if name in children), None)
+
+
+def _text(element: Optional[etree.Element]) -> Optional[str]:
+    if element is None:
+        return None
+    # Unlike itertext, this skips the entities which weren't expanded
+    return element.xpath("string()").strip() or None
+
+
+def _image(item: etree.Element) -> Optional[str]:
+    for media in item.iter(f"{{{MEDIA_NAMESPACE}}}content"):
+        if media.get("medium") == "image" or media.get("type", "").startswith("image/"):
+            return media.get("url")
+
+    thumbnail = next(item.iter(f"{{{MEDIA_NAMESPACE}}}thumbnail"), None)
+    if thumbnail is not None:
+        return thumbnail.get("url")
+
+    enclosure = _child(item, "enclosure")
+    if enclosure is not None and enclosure.get("type", "").startswith("image/"):
+        return enclosure.get("url")
+
+    image = _child(item, "image")
+    if image is not None:
+        return _text(_child(image, "url", "link")) or _text(image)
+
+    return None
+
+
+def _parse_date(date: Optional[str]) -> Optional[int]:
+    """Parse an RFC 822 (RSS) or ISO 8601 (Atom) date into a Unix timestamp"""
+    if not date:
+        return None
+
+    try:
+        parsed = parsedate_to_datetime(date)
+    except (TypeError, ValueError):
+        if date.endswith("Z"):
+            # Before Python 3.11, fromisoformat doesn't understand Z for UTC
+            date = date[:-1] + "+00:00"
+        try:
+            parsed = datetime.fromisoformat(date)
+        except ValueError:
+            return None
+
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp())
+
+
+def check_public_url(url: str):
+    """Raise a ValueError unless the given URL is http(s) and its host only
+    resolves to public addresses"""
+    parsed = urlparse(url)
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        raise ValueError(f"The feed URL {url} is not an http(s) URL")
+    if RSS_ALLOW_PRIVATE_ADDRESSES:
+        return
+
+    for *_, sockaddr in socket.getaddrinfo(parsed.hostname, None):
+        if not ipaddress.ip_address(sockaddr[0]).is_global:
+            raise ValueError(f"The feed's host {parsed.hostname} is not public")
+
+
+class _PublicRedirectHandler(urllib.request.HTTPRedirectHandler):
+    """Only follows redirects to URLs which feeds may be fetched from"""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        check_public_url(newurl)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+_opener = urllib.request.build_opener(_PublicRedirectHandler)
+
+
+def fetch_feed(
+    url: str, etag: Optional[str], last_modified: Optional[str]
+) -> Optional[tuple[bytes, Optional[str], Optional[str]]]:
+    """Fetch the given feed, unless it hasn't changed since it was fetched with the
+    given validators, in which case None is returned. Otherwise, the feed's data is
+    returned along with its new ETag and Last-Modified.
+
+    Feeds are only fetched from public addresses, see `check_public_url`."""
+    check_public_url(url)
+    request = urllib.request.Request(url, headers={"User-Agent": "CampuSign"})
+    if etag:
+        request.add_header("If-None-Match", etag)
+    if last_modified:
+        request.add_header("If-Modified-Since", last_modified)
+
+    try:
+        with _opener.open(request, timeout=RSS_FETCH_TIMEOUT) as response:
+            data = response.read(RSS_MAX_SIZE + 1)
+            if len(data) > RSS_MAX_SIZE:
+                raise ValueError("The feed is too big")
+            return (
+                data,
+                response.headers.get("ETag"),
+                response.headers.get("Last-Modified"),
+            )
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return None
+        raise
+
+
+class RSSPoller:
+    """Fetches every RSS feed which displays show on a schedule, in a background
+    thread, so that each feed is fetched once for all displays rather than by each
+    of them. Feeds are fetched concurrently with conditional requests, and parsed
+    into items which are stored ready to send."""
+
+    def __init__(self, app: flask.Flask, interval: float = RSS_POLL_INTERVAL):
+        self.app = app
+        self.interval = interval
+
+        # Identifies this poller as the holder of the lease
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}"
+
+        self._pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="rss")
+        self._stopped = threading.Event()
+
+    def start(self) -> threading.Thread:
+        """Start polling in a daemon thread"""
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        """Stop polling once the current round of fetches is done"""
+        self._stopped.set()
+
+    def run(self):
+        """Fetch whichever feeds are due every RSS_POLLER_TICK seconds until stopped,
+        whenever this process holds the lease"""
+        while not self._stopped.is_set():
+            # A fresh app context each time means the connection goes back to the
+            # pool in between
+            with self.app.app_context():
+                try:
+                    db = DatabaseController.get()
+                    if db.acquire_lease(
+                        RSS_POLLER_LEASE, self.holder, RSS_POLLER_LEASE_DURATION
+                    ):
+                        self.poll_due(db)
+                except Exception as e:
+                    # Try again next time rather than stopping polling altogether
+                    print(f"Failed to poll RSS feeds: {e}")
+            self._stopped.wait(RSS_POLLER_TICK)
+
+    def poll_due(self, db: DatabaseController) -> int:
+        """Fetch every feed which is due now, returning how many were fetched
+        successfully, whether or not they had changed"""
+        now = time.time()
+        db.delete_stale_rss_feeds(now - RSS_FEED_EXPIRY)
+        feeds = db.fetch_due_rss_feeds(now - self.interval)
+
+        polled = 0
+        for (url, _, _), result in zip(
+            feeds, self._pool.map(lambda feed: self._fetch(*feed), feeds)
+        ):
+            if result is None:
+                continue
+
+            polled += 1
+            items, etag, last_modified = result
+            db.update_rss_feed(url, now, etag, last_modified, items)
+        return polled
+
+    @staticmethod
+    def _fetch(
+        url: str, etag: Optional[str], last_modified: Optional[str]
+    ) -> Optional[tuple[Optional[bytes], Optional[str], Optional[str]]]:
+        """Fetch and parse the given feed, returning its items as JSON (or None if
+        it hasn't changed) along with its new validators, or None if it couldn't be
+        fetched"""
+        try:
+            fetched = fetch_feed(url, etag, last_modified)
+            if fetched is None:
+                return None, etag, last_modified
+
+            data, etag, last_modified = fetched
+            items = json.dumps(parse_feed(data), separators=(",", ":"))
+            return items.encode("utf-8"), etag, last_modified
+        except Exception as e:
+            print(f"Failed to fetch the RSS feed {url}: {e}")
+            return None
@@ -1,3 +1,11 @@
+DROP TABLE IF EXISTS schema_version;
+DROP TABLE IF EXISTS leases;
+DROP TABLE IF EXISTS changes;
+DROP TABLE IF EXISTS change_log;
+DROP TABLE IF EXISTS metrics;
+DROP TABLE IF EXISTS metrics_processes;
+DROP TABLE IF EXISTS rss_feeds;
+DROP TABLE IF EXISTS content_variants;
 DROP TABLE IF EXISTS content_stream_membership;
 DROP TABLE IF EXISTS content;
 DROP TABLE IF EXISTS people;
@@ -0,0 +1,6 @@
+-- Lets the newest content be found by walking this index backwards, rather than
+-- sorting all content on every feed query
+CREATE INDEX IF NOT EXISTS content_by_posted ON content(posted);
+-- Covers checking which streams a piece of content is in, and finding memberships
+-- to cascade to when content is deleted
+CREATE INDEX IF NOT EXISTS content_stream_membership_by_content ON content_stream_membership(content, stream);
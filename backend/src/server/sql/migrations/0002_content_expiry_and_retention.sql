@@ -0,0 +1,10 @@
+-- When the content expires as a Unix timestamp, or NULL if it never does
+ALTER TABLE content ADD COLUMN expires_at INTEGER;
+-- The feed skips expired content using this index alone, without looking it up
+DROP INDEX IF EXISTS content_by_posted;
+CREATE INDEX content_by_posted ON content(posted, id, expires_at);
+CREATE INDEX content_by_expiry ON content(expires_at) WHERE expires_at IS NOT NULL;
+-- How many of the newest posts a stream keeps, and for how many seconds, or NULL if
+-- it keeps them all
+ALTER TABLE content_streams ADD COLUMN retain_count INTEGER;
+ALTER TABLE content_streams ADD COLUMN retain_seconds INTEGER;
@@ -0,0 +1,8 @@
+-- A lease lets one process at a time do something on behalf of the whole
+-- deployment, such as fetching from an external API. It is held until it expires
+-- (as a Unix timestamp) unless its holder renews it.
+CREATE TABLE leases (
+  name TEXT PRIMARY KEY,
+  holder TEXT NOT NULL,
+  expires_at INTEGER NOT NULL
+);
@@ -0,0 +1,4 @@
+-- The trimmed schedule displays are sent, as ready-to-send JSON, and its SHA-256
+-- hash, which is its ETag. NULL until the schedule is next fetched.
+ALTER TABLE loadshedding_schedules ADD COLUMN summary_json BLOB;
+ALTER TABLE loadshedding_schedules ADD COLUMN summary_hash TEXT;
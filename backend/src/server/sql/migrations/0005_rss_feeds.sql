@@ -0,0 +1,14 @@
+-- The RSS feeds displays show, which are polled by the server rather than by every
+-- display. A feed's items are kept as ready-to-send JSON along with its SHA-256
+-- hash, and its validators are kept for conditional requests. Times are Unix
+-- timestamps, and fetched_at is NULL until the feed is first fetched.
+CREATE TABLE rss_feeds (
+  url TEXT PRIMARY KEY,
+  requested_at INTEGER NOT NULL,
+  fetched_at INTEGER,
+  etag TEXT,
+  last_modified TEXT,
+  items_json BLOB,
+  items_hash TEXT
+);
+CREATE INDEX rss_feeds_by_fetched_at ON rss_feeds(fetched_at);
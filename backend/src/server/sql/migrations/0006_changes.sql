@@ -0,0 +1,166 @@
+-- Records what other processes need to drop from their caches when data changes,
+-- so that in-process caches are safe with many workers. Each change names the kind
+-- of data and the key which changed, or no key if every key of that kind may have.
+-- Changes are kept for a while so that every process can catch up on them, see
+-- DatabaseController.sync_caches.
+CREATE TABLE changes (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  kind TEXT NOT NULL,
+  key TEXT,
+  changed INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER))
+);
+CREATE TRIGGER displays_changes_after_insert
+AFTER
+INSERT
+  ON displays BEGIN
+INSERT INTO
+  changes (kind, key)
+VALUES
+  ('display', NEW.id);
+END;
+CREATE TRIGGER displays_changes_after_update
+AFTER
+UPDATE
+  ON displays BEGIN
+INSERT INTO
+  changes (kind, key)
+VALUES
+  ('display', NEW.id);
+END;
+CREATE TRIGGER displays_changes_after_delete
+AFTER
+  DELETE ON displays BEGIN
+INSERT INTO
+  changes (kind, key)
+VALUES
+  ('display', OLD.id);
+END;
+CREATE TRIGGER templates_changes_after_insert
+AFTER
+INSERT
+  ON templates BEGIN
+INSERT INTO
+  changes (kind, key)
+VALUES
+  ('template', NEW.id);
+END;
+CREATE TRIGGER templates_changes_after_update
+AFTER
+UPDATE
+  ON templates BEGIN
+INSERT INTO
+  changes (kind, key)
+VALUES
+  ('template', NEW.id);
+END;
+CREATE TRIGGER templates_changes_after_delete
+AFTER
+  DELETE ON templates BEGIN
+INSERT INTO
+  changes (kind, key)
+VALUES
+  ('template', OLD.id);
+END;
+CREATE TRIGGER files_changes_after_insert
+AFTER
+INSERT
+  ON files BEGIN
+INSERT INTO
+  changes (kind, key)
+VALUES
+  ('department', NEW.department_id);
+END;
+CREATE TRIGGER files_changes_after_update
+AFTER
+UPDATE
+  ON files BEGIN
+INSERT INTO
+  changes (kind, key)
+VALUES
+  ('department', NEW.department_id);
+END;
+CREATE TRIGGER files_changes_after_delete
+AFTER
+  DELETE ON files BEGIN
+INSERT INTO
+  changes (kind, key)
+VALUES
+  ('department', OLD.department_id);
+END;
+CREATE TRIGGER departments_changes_after_delete
+AFTER
+  DELETE ON departments BEGIN
+INSERT INTO
+  changes (kind, key)
+VALUES
+  ('department', OLD.id);
+END;
+-- Users are cached by email
+CREATE TRIGGER users_changes_after_insert
+AFTER
+INSERT
+  ON users BEGIN
+INSERT INTO
+  changes (kind, key)
+VALUES
+  ('user', NEW.email);
+END;
+CREATE TRIGGER users_changes_after_update
+AFTER
+UPDATE
+  ON users BEGIN
+INSERT INTO
+  changes (kind, key)
+VALUES
+  ('user', OLD.email);
+INSERT INTO
+  changes (kind, key)
+SELECT
+  'user',
+  NEW.email
+WHERE
+  NEW.email != OLD.email;
+END;
+CREATE TRIGGER users_changes_after_delete
+AFTER
+  DELETE ON users BEGIN
+INSERT INTO
+  changes (kind, key)
+VALUES
+  ('user', OLD.email);
+END;
+-- The people of a department are cached together, so their changes are keyed by
+-- department
+CREATE TRIGGER people_changes_after_insert
+AFTER
+INSERT
+  ON people BEGIN
+INSERT INTO
+  changes (kind, key)
+VALUES
+  ('people', NEW.department);
+END;
+CREATE TRIGGER people_changes_after_update
+AFTER
+UPDATE
+  ON people BEGIN
+INSERT INTO
+  changes (kind, key)
+VALUES
+  ('people', OLD.department);
+INSERT INTO
+  changes (kind, key)
+SELECT
+  'people',
+  NEW.department
+WHERE
+  NEW.department != OLD.department;
+END;
+CREATE TRIGGER people_changes_after_delete
+AFTER
+  DELETE ON people BEGIN
+INSERT INTO
+  changes (kind, key)
+VALUES
+  ('people', OLD.department);
+END;
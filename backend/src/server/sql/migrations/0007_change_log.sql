@@ -0,0 +1,173 @@
+-- Records every row which is inserted, updated or deleted in the tables clients
+-- keep copies of, in order, so that a client which has read everything up to some
+-- sequence number only needs to re-read the rows changed since. Only which row
+-- changed is recorded, not what it changed to. Rows are identified by their
+-- primary key, joined with ':' if it has more than one column. Old changes are
+-- truncated, see DatabaseController.fetch_change_log.
+CREATE TABLE change_log (
+  seq INTEGER PRIMARY KEY AUTOINCREMENT,
+  table_name TEXT NOT NULL,
+  row_key TEXT NOT NULL,
+  operation TEXT NOT NULL CHECK (operation IN ('insert', 'update', 'delete')),
+  changed_at INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER))
+);
+CREATE TRIGGER content_change_log_after_insert
+AFTER
+INSERT
+  ON content BEGIN
+INSERT INTO
+  change_log (table_name, row_key, operation)
+VALUES
+  ('content', NEW.id, 'insert');
+END;
+CREATE TRIGGER content_change_log_after_update
+AFTER
+UPDATE
+  ON content BEGIN
+INSERT INTO
+  change_log (table_name, row_key, operation)
+VALUES
+  ('content', NEW.id, 'update');
+END;
+CREATE TRIGGER content_change_log_after_delete
+AFTER
+  DELETE ON content BEGIN
+INSERT INTO
+  change_log (table_name, row_key, operation)
+VALUES
+  ('content', OLD.id, 'delete');
+END;
+CREATE TRIGGER content_stream_membership_change_log_after_insert
+AFTER
+INSERT
+  ON content_stream_membership BEGIN
+INSERT INTO
+  change_log (table_name, row_key, operation)
+VALUES
+  ('content_stream_membership', NEW.stream || ':' || NEW.content, 'insert');
+END;
+CREATE TRIGGER content_stream_membership_change_log_after_update
+AFTER
+UPDATE
+  ON content_stream_membership BEGIN
+INSERT INTO
+  change_log (table_name, row_key, operation)
+VALUES
+  ('content_stream_membership', NEW.stream || ':' || NEW.content, 'update');
+END;
+CREATE TRIGGER content_stream_membership_change_log_after_delete
+AFTER
+  DELETE ON content_stream_membership BEGIN
+INSERT INTO
+  change_log (table_name, row_key, operation)
+VALUES
+  ('content_stream_membership', OLD.stream || ':' || OLD.content, 'delete');
+END;
+CREATE TRIGGER people_change_log_after_insert
+AFTER
+INSERT
+  ON people BEGIN
+INSERT INTO
+  change_log (table_name, row_key, operation)
+VALUES
+  ('people', NEW.id, 'insert');
+END;
+CREATE TRIGGER people_change_log_after_update
+AFTER
+UPDATE
+  ON people BEGIN
+INSERT INTO
+  change_log (table_name, row_key, operation)
+VALUES
+  ('people', NEW.id, 'update');
+END;
+CREATE TRIGGER people_change_log_after_delete
+AFTER
+  DELETE ON people BEGIN
+INSERT INTO
+  change_log (table_name, row_key, operation)
+VALUES
+  ('people', OLD.id, 'delete');
+END;
+CREATE TRIGGER displays_change_log_after_insert
+AFTER
+INSERT
+  ON displays BEGIN
+INSERT INTO
+  change_log (table_name, row_key, operation)
+VALUES
+  ('displays', NEW.id, 'insert');
+END;
+CREATE TRIGGER displays_change_log_after_update
+AFTER
+UPDATE
+  ON displays BEGIN
+INSERT INTO
+  change_log (table_name, row_key, operation)
+VALUES
+  ('displays', NEW.id, 'update');
+END;
+CREATE TRIGGER displays_change_log_after_delete
+AFTER
+  DELETE ON displays BEGIN
+INSERT INTO
+  change_log (table_name, row_key, operation)
+VALUES
+  ('displays', OLD.id, 'delete');
+END;
+CREATE TRIGGER files_change_log_after_insert
+AFTER
+INSERT
+  ON files BEGIN
+INSERT INTO
+  change_log (table_name, row_key, operation)
+VALUES
+  ('files', NEW.department_id || ':' || NEW.filename, 'insert');
+END;
+CREATE TRIGGER files_change_log_after_update
+AFTER
+UPDATE
+  ON files BEGIN
+INSERT INTO
+  change_log (table_name, row_key, operation)
+VALUES
+  ('files', NEW.department_id || ':' || NEW.filename, 'update');
+END;
+CREATE TRIGGER files_change_log_after_delete
+AFTER
+  DELETE ON files BEGIN
+INSERT INTO
+  change_log (table_name, row_key, operation)
+VALUES
+  ('files', OLD.department_id || ':' || OLD.filename, 'delete');
+END;
+CREATE TRIGGER loadshedding_schedules_change_log_after_insert
+AFTER
+INSERT
+  ON loadshedding_schedules BEGIN
+INSERT INTO
+  change_log (table_name, row_key, operation)
+VALUES
+  ('loadshedding_schedules', NEW.id, 'insert');
+END;
+CREATE TRIGGER loadshedding_schedules_change_log_after_update
+AFTER
+UPDATE
+  ON loadshedding_schedules BEGIN
+INSERT INTO
+  change_log (table_name, row_key, operation)
+VALUES
+  ('loadshedding_schedules', NEW.id, 'update');
+END;
+CREATE TRIGGER loadshedding_schedules_change_log_after_delete
+AFTER
+  DELETE ON loadshedding_schedules BEGIN
+INSERT INTO
+  change_log (table_name, row_key, operation)
+VALUES
+  ('loadshedding_schedules', OLD.id, 'delete');
+END;
+-- Finds a stream's changes by the stream ID at the start of their row key
+CREATE INDEX change_log_by_stream ON change_log(CAST(row_key AS INTEGER), seq)
+WHERE
+  table_name = 'content_stream_membership';
@@ -0,0 +1,16 @@
+-- Each process keeps its metrics in memory and regularly writes them here, so that
+-- any process can report the metrics of the whole deployment. A process's values
+-- are cumulative, so they are simply overwritten.
+CREATE TABLE metrics_processes (
+  process TEXT PRIMARY KEY,
+  -- When the process last wrote its metrics, as a Unix timestamp
+  flushed_at REAL NOT NULL
+);
+CREATE TABLE metrics (
+  process TEXT NOT NULL REFERENCES metrics_processes(process) ON DELETE CASCADE,
+  name TEXT NOT NULL,
+  -- The labels of the series as a JSON object
+  labels TEXT NOT NULL,
+  value REAL NOT NULL,
+  PRIMARY KEY (process, name, labels)
+);
@@ -0,0 +1,8 @@
+-- Display tokens are signed with their display's own secret as well as the app's
+-- secret key, so that they can't be forged without it and a display's tokens can
+-- be revoked by changing it. New displays are given theirs when they are created.
+ALTER TABLE displays ADD COLUMN token_secret TEXT;
+UPDATE
+  displays
+SET
+  token_secret = lower(hex(randomblob(16)));
@@ -0,0 +1,8 @@
+-- When the content was posted, copied from content so that the newest posts in a
+-- stream can be found by walking content_stream_membership_by_posted, however few
+-- of all posts are in the stream
+ALTER TABLE content_stream_membership ADD COLUMN posted INTEGER;
+UPDATE content_stream_membership SET posted = (
+  SELECT posted FROM content WHERE content.id = content_stream_membership.content
+);
+CREATE INDEX content_stream_membership_by_posted ON content_stream_membership(stream, posted, content);
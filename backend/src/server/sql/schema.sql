@@ -40,7 +40,9 @@ CREATE TABLE IF NOT EXISTS content (
   ),
   content_json TEXT NOT NULL,
   blob_mime_type TEXT,
+  -- Empty if the blob is in the blob store under blob_hash
   content_blob BLOB,
+  blob_hash TEXT,
   CHECK (
     (
       content_blob IS NULL
@@ -52,6 +54,14 @@ CREATE TABLE IF NOT EXISTS content (
     )
   )
 );
+-- Resized and re-encoded copies of local images, kept in the blob store
+CREATE TABLE IF NOT EXISTS content_variants (
+  content INTEGER NOT NULL REFERENCES content(id) ON DELETE CASCADE,
+  width INTEGER NOT NULL,
+  mime_type TEXT NOT NULL,
+  blob_hash TEXT NOT NULL,
+  PRIMARY KEY (content, width, mime_type)
+);
 CREATE TABLE IF NOT EXISTS content_stream_membership (
   stream INTEGER NOT NULL REFERENCES content_streams(id) ON DELETE CASCADE,
   content INTEGER NOT NULL REFERENCES content(id) ON DELETE CASCADE,
@@ -63,7 +73,9 @@ CREATE TABLE IF NOT EXISTS people (
   title TEXT NOT NULL,
   full_name TEXT NOT NULL,
   mime_type TEXT NOT NULL,
+  -- Empty if the image is in the blob store under image_hash
   image_data BLOB NOT NULL,
+  image_hash TEXT,
   position TEXT NOT NULL,
   office_hours TEXT NOT NULL,
   office_location TEXT NOT NULL,
@@ -93,8 +105,14 @@ CREATE TABLE IF NOT EXISTS loadshedding_schedules (
 CREATE TABLE IF NOT EXISTS files (
   department_id INTEGER NOT NULL REFERENCES departments(id),
   filename TEXT NOT NULL,
+  -- Empty if the file is in the blob store under file_hash
   file_content BLOB NOT NULL,
+  file_hash TEXT,
   mime_type TEXT NOT NULL,
   PRIMARY KEY (department_id, filename)
 );
 CREATE TABLE IF NOT EXISTS templates (id TEXT PRIMARY KEY, xml TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS content_by_blob_hash ON content(blob_hash);
+CREATE INDEX IF NOT EXISTS person_by_image_hash ON people(image_hash);
+CREATE INDEX IF NOT EXISTS file_by_hash ON files(file_hash);
+CREATE INDEX IF NOT EXISTS content_variant_by_blob_hash ON content_variants(blob_hash);
@@ -1,4 +1,14 @@
 import sqlite3
+from typing import Optional
+
+from server import invalidation
+from server.cache import Cache
+
+# How many users are cached, and for how many seconds at most
+USER_CACHE_SIZE = 1024
+USER_CACHE_TTL = 5 * 60
+
+_cached_users = Cache(max_size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL, name="users")
 
 
 class User:
@@ -38,3 +48,34 @@ class User:
             "department": self.department,
             "permissions": self.permissions,
         }
+
+    @staticmethod
+    def fetch_cached(email: str) -> Optional["User"]:
+        """Get the given user from the user cache, if they are cached"""
+        return _cached_users.get(email)
+
+    @staticmethod
+    def cache(user: "User"):
+        """Cache the given user until they are invalidated or expire"""
+        _cached_users.put(user.user_id, user)
+
+    @staticmethod
+    def invalidate_cached(email: str):
+        """Drop the given user from the user cache"""
+        _cached_users.invalidate(email)
+
+    @staticmethod
+    def invalidate_all_cached():
+        """Drop all users from the user cache"""
+        _cached_users.clear()
+
+
+def _user_changed(email: Optional[str]):
+    if email is None:
+        User.invalidate_all_cached()
+    else:
+        User.invalidate_cached(email)
+
+
+# Users are cached by email, whichever process changes them
+invalidation.on_change("user", _user_changed)
@@ -3,6 +3,7 @@ from pathlib import Path
 
 import pytest
 
+from server.blob_store import BlobStore
 from server.database import DatabaseController
 from server.main import create_app
 
@@ -40,8 +41,10 @@ def runner(app):
 
 
 @pytest.fixture()
-def database(app):
-    db = DatabaseController(sqlite3.connect(":memory:"))
+def database(app, tmp_path):
+    db = DatabaseController(
+        sqlite3.connect(":memory:"), blobs=BlobStore(tmp_path / "blobs")
+    )
 
     with app.app_context():
         db.create_db()
@@ -5,6 +5,7 @@ import typing
 import pytest
 from server.database import DatabaseController
 from server.department.department import Department
+from server.department.person import Person
 from server.display import Display
 from server.free_form_content import (
     Text,
@@ -14,6 +15,7 @@ from server.free_form_content import (
     RemoteImage,
     Caption,
 )
+from server.free_form_content.content_stream import ContentStream
 
 
 def test_post_and_fetch_image(
@@ -223,3 +225,283 @@ def test_create_display(database: DatabaseController):
 def test_display_has_valid_dept(database: DatabaseController):
     with pytest.raises(Exception):
         database.upsert_display(Display("Test Group 2", [], None), 30182)
+
+
+def test_connections_are_pooled(app):
+    with app.app_context():
+        conn = DatabaseController.get().db
+        assert (
+            DatabaseController.get().db is conn
+        ), "the same connection should be used for the whole app context"
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        assert conn.execute("PRAGMA foreign_keys").fetchone()[0] == 1
+
+    with app.app_context():
+        assert (
+            DatabaseController.get().db is conn
+        ), "connections should be reused across app contexts"
+
+
+def test_page_templates_are_cached(database: DatabaseController):
+    template = database.fetch_page_template_by_id("builtin/news.j2.xml")
+    assert template is not None
+    assert (
+        database.fetch_page_template_by_id("builtin/news.j2.xml") is template
+    ), "unchanged templates should not be parsed again"
+
+    database.add_page_template(
+        "test", "<template><name>A</name><properties/></template>"
+    )
+    assert database.fetch_page_template_by_id("test").name == "A"
+
+    database.db.execute(
+        "UPDATE templates SET xml = ? WHERE id = 'test'",
+        ("<template><name>B</name><properties/></template>",),
+    )
+    assert (
+        database.fetch_page_template_by_id("test").name == "B"
+    ), "templates whose XML changed should be parsed again"
+
+    templates = database.fetch_page_templates_by_ids(
+        ["test", "builtin/news.j2.xml", "test", "missing"]
+    )
+    assert set(templates.keys()) == {"test", "builtin/news.j2.xml"}
+    assert templates["builtin/news.j2.xml"] is template
+
+
+def test_blobs_are_deduplicated(database: DatabaseController, test_png_data: bytes):
+    first_id, _ = database.post_content(
+        LocalImage("image/png", test_png_data, None, [1])
+    )
+    second_id, _ = database.post_content(
+        LocalImage("image/png", test_png_data, None, [1])
+    )
+
+    assert (
+        len(list(database.blobs.hashes())) == 1
+    ), "identical blobs should only be stored once"
+    assert database.db.execute(
+        "SELECT length(content_blob) FROM content WHERE id = ?", (first_id,)
+    ).fetchone() == (0,), "blobs in the blob store should not be kept inline"
+
+    database.delete_content_by_id(first_id)
+    fetched = typing.cast(
+        LocalImage, database.fetch_content_by_id(second_id, fetch_blob=True)
+    )
+    assert (
+        fetched.image_data == test_png_data
+    ), "blobs should be kept while still referenced"
+
+    try:
+        with database.db:
+            database._begin_write()
+            database._delete_contents([second_id])
+            raise RuntimeError("the transaction fails after releasing the blob")
+    except RuntimeError:
+        pass
+    database._delete_released_blobs()
+    fetched = typing.cast(
+        LocalImage, database.fetch_content_by_id(second_id, fetch_blob=True)
+    )
+    assert (
+        fetched.image_data == test_png_data
+    ), "blobs should be kept if the transaction releasing them rolls back"
+
+    database.delete_content_by_id(second_id)
+    assert (
+        len(list(database.blobs.hashes())) == 0
+    ), "blobs should be deleted once nothing references them"
+
+
+def test_migrate_blobs_to_store(database: DatabaseController, test_jpg_data: bytes):
+    blobs = database.blobs
+    database.blobs = None
+    content_id, _ = database.post_content(
+        LocalImage("image/jpeg", test_jpg_data, None, [1])
+    )
+
+    _, blob = database.open_content_blob(content_id)
+    # Before Python 3.11, blobs stored inline are read whole rather than opened
+    assert (blob if isinstance(blob, bytes) else blob.read()) == test_jpg_data
+
+    database.blobs = blobs
+    assert database.migrate_blobs_to_store() == 1
+    assert database.migrate_blobs_to_store() == 0, "blobs should only be moved once"
+
+    fetched = typing.cast(
+        LocalImage, database.fetch_content_by_id(content_id, fetch_blob=True)
+    )
+    assert fetched.blob_hash in database.blobs.hashes()
+    assert fetched.image_data == test_jpg_data
+
+    # Blobs still stored inline are moved into the blob store when first opened
+    database.blobs = None
+    content_id, _ = database.post_content(
+        LocalImage("image/jpeg", test_jpg_data, None, [1])
+    )
+    database.blobs = blobs
+    _, path = database.open_content_blob(content_id)
+    with open(path, "rb") as f:
+        assert f.read() == test_jpg_data
+    assert database.migrate_blobs_to_store() == 0
+
+
+def test_migrations_are_applied(database: DatabaseController):
+    (version,) = database.db.execute("SELECT version FROM schema_version").fetchone()
+    assert version >= 1
+
+    plan = database.db.execute(
+        "EXPLAIN QUERY PLAN SELECT membership.content"
+        " FROM content_stream_membership AS membership"
+        " INNER JOIN content ON content.id = membership.content"
+        " WHERE membership.stream = 1 AND (expires_at IS NULL OR expires_at > 0)"
+        " ORDER BY membership.posted DESC, membership.content DESC LIMIT 10"
+    ).fetchall()
+    assert any(
+        "content_stream_membership_by_posted" in detail for *_, detail in plan
+    ), "the latest content in a stream should be found by walking its index"
+    assert not any(
+        "TEMP B-TREE" in detail for *_, detail in plan
+    ), "the latest content should be found without sorting all of it"
+
+
+def test_sweep_content(database: DatabaseController, test_png_data: bytes):
+    expired = LocalImage("image/png", test_png_data, None, [1])
+    expired.expires_at = datetime.fromtimestamp(time.time() - 1)
+    expired_id, _ = database.post_content(expired)
+    kept = Text("Kept", "", [1])
+    kept.expires_at = datetime.fromtimestamp(time.time() + 60 * 60)
+    kept_id, _ = database.post_content(kept)
+
+    assert [post.id for post in database.fetch_content_in_streams([1])] == [
+        kept_id
+    ], "expired content should not be fetched"
+
+    assert database.sweep_content() == 1
+    assert database.fetch_content_by_id(expired_id) is None
+    assert len(list(database.blobs.hashes())) == 0, "blobs should be released"
+
+    stream_id = database.create_content_stream(
+        ContentStream("Retained", "readable", retain_count=2)
+    )
+    in_both_id, _ = database.post_content(Text("In both", "", [1, stream_id]))
+    ids = [database.post_content(Text(str(i), "", [stream_id]))[0] for i in range(3)]
+
+    assert database.sweep_content(batch_size=1) == 2
+    assert [post.id for post in database.fetch_content_in_streams([stream_id])] == [
+        ids[2],
+        ids[1],
+    ], "only the newest posts should be kept"
+    assert database.fetch_content_by_id(ids[0]) is None
+    assert (
+        database.fetch_content_by_id(in_both_id) is not None
+    ), "content still in another stream should be kept"
+
+
+def test_users_are_cached(database: DatabaseController):
+    database.insert_user("A@TEST", "A", "password", 1, "superuser")
+    user = database.load_user("A@TEST")
+    assert user.permissions == "superuser"
+    assert database.load_user("A@TEST") is user, "users should be cached"
+    assert database.load_user("nobody@example.com") is None
+
+    database.delete_user("A@TEST")
+    assert database.load_user("A@TEST") is None, "deleted users should be dropped"
+
+    database.insert_user("B@TEST", "B", "password", 1, "superuser")
+    assert database.load_user("B@TEST").permissions == "superuser"
+
+    # As if another process changed the user
+    database.db.execute(
+        "UPDATE users SET permissions = 'posting_user' WHERE email = 'B@TEST'"
+    )
+    database.db.commit()
+    database.sync_caches()
+    assert (
+        database.load_user("B@TEST").permissions == "posting_user"
+    ), "users changed by another process should be dropped"
+
+
+def test_changes_invalidate_caches(app, database: DatabaseController):
+    with app.app_context():
+        first = Display("First", [("builtin/news.j2.xml", 10, {})])
+        first.id = database.upsert_display(first, 1)
+        second = Display("Second", [("builtin/news.j2.xml", 10, {})])
+        second.id = database.upsert_display(second, 1)
+        database.sync_caches()
+
+        rendered = first.render_cached(database, 1, "token")
+        second.render_cached(database, 1, "token")
+        database.sync_caches()
+        assert Display.fetch_rendered(1, first.id) is rendered, "nothing has changed"
+
+        # As if another process changed the display
+        database.db.execute(
+            "UPDATE displays SET name = 'Changed' WHERE id = ?", (first.id,)
+        )
+        database.db.commit()
+        database.sync_caches()
+        assert Display.fetch_rendered(1, first.id) is None
+        assert Display.fetch_rendered(1, second.id) is not None
+
+        for name in ["Changed again", "Changed once more"]:
+            database.db.execute(
+                "UPDATE displays SET name = ? WHERE id = ?", (name, first.id)
+            )
+        database.db.commit()
+        assert database.trim_changes(time.time() + 1) > 0
+        assert database.fetch_latest_change() > 0, "the latest change should be kept"
+        database.sync_caches()
+        assert (
+            Display.fetch_rendered(1, second.id) is None
+        ), "everything should be dropped when changes were missed"
+
+        person_id = database.upsert_person(
+            Person("Dr", "Name", "", b"", "", "", "", "", ""), 1
+        )
+        database.sync_caches()
+        database.fetch_department_people_json(1)
+        database.sync_caches()
+        assert Person.fetch_cached_department_people(1) is not None
+
+        # As if another process changed the person
+        database.db.execute(
+            "UPDATE people SET position = 'Lecturer' WHERE id = ?", (person_id,)
+        )
+        database.db.commit()
+        database.sync_caches()
+        assert Person.fetch_cached_department_people(1) is None
+
+
+def test_change_log(database: DatabaseController):
+    head = database.fetch_change_log_head()
+
+    content_id, _ = database.post_content(Text("Title", "body", [1]))
+    assert database.delete_content_by_id(content_id)
+    person_id = database.upsert_person(
+        Person("Dr", "Name", "", b"", "", "", "", "", ""), 1
+    )
+    assert database.delete_person(person_id)
+    database.update_loadshedding_schedule(1, "{}", b"{}")
+
+    changes = database.fetch_change_log(head)
+    assert [change[1:] for change in changes] == [
+        ("content", str(content_id), "insert"),
+        ("content_stream_membership", f"1:{content_id}", "insert"),
+        ("content_stream_membership", f"1:{content_id}", "delete"),
+        ("content", str(content_id), "delete"),
+        ("people", str(person_id), "insert"),
+        ("people", str(person_id), "delete"),
+        ("loadshedding_schedules", "1", "insert"),
+    ]
+    assert [change[0] for change in changes] == sorted(change[0] for change in changes)
+    assert database.fetch_change_log(head, tables=["people"]) == [
+        change for change in changes if change[1] == "people"
+    ]
+    assert database.fetch_change_log(changes[-1][0]) == []
+
+    assert database.trim_change_log(time.time() + 1) > 0
+    assert (
+        database.fetch_change_log(head) is None
+    ), "changes which were truncated away should not be skipped over"
+    assert database.fetch_change_log(database.fetch_change_log_head()) == []
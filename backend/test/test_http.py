@@ -1,12 +1,28 @@
+import io
+import json
+import threading
 import time
+import zipfile
+from datetime import datetime, timezone
 from pathlib import Path
 
+import openpyxl
+import PIL.Image
+from itsdangerous import URLSafeSerializer
+
+from server import api
+from server.api import display_bootstrap
+from server.database import DatabaseController
+from server.department.department import Department
+from server.department.person import Person
+from server.display import Display
+from server.display_token import DISPLAY_TOKEN_SALT, make_display_token
 from server.util import combine
 
 data_folder = Path(__file__).parent / "data"
 
 
-def test_post_local_image(client, test_png_data, test_jpg_data):
+def test_post_local_image(client, test_png_data):
     """Test that local images can be posted (both JPG and PNG)"""
 
     jpg_res = client.post(
@@ -50,7 +66,10 @@ def test_post_local_image(client, test_png_data, test_jpg_data):
     assert content[0]["posted"] > content[1]["posted"], "PNG should be posted after JPG"
 
     fetched_jpg = client.get(f"/api/content/{jpg_res.json['id']}/blob")
-    assert fetched_jpg.data == test_jpg_data, "Data should match after roundtrip"
+    # The JPG's metadata is stripped, and its orientation applied, when it is posted
+    fetched_image = PIL.Image.open(io.BytesIO(fetched_jpg.data))
+    assert fetched_image.size == (3024, 4032), "Data should match after roundtrip"
+    assert not fetched_image.getexif(), "Metadata should be stripped"
     assert fetched_jpg.content_type == "image/jpeg", "content-type must be correct"
 
     fetched_png = client.get(f"/api/content/{png_res.json['id']}/blob")
@@ -73,6 +92,22 @@ def test_post_remote_image(client):
     assert content[0]["src"] == "testurl"
 
 
+def test_post_invalid_expiry(client):
+    for expires_at in ["tomorrow", "9" * 20]:
+        res = client.post(
+            "/api/content",
+            data={
+                "type": "link",
+                "url": "testurl",
+                "content_stream": "1",
+                "expires_at": expires_at,
+            },
+        )
+        assert res.status == "400 BAD REQUEST"
+
+    assert client.get("/api/content?stream=1").json["content"] == []
+
+
 def test_post_link(client):
     res = client.post(
         "/api/content", data={"type": "link", "url": "testurl", "content_stream": "1"}
@@ -257,3 +292,762 @@ def test_post_content_stream(client):
         f"/api/content?{'&'.join(f'stream={stream}' for stream in stream_ids)}"
     ).json["content"]
     assert len(all_streams) == 3
+
+
+def test_display_view_is_conditional(app, client):
+    with app.app_context():
+        display = Display("Test Display", [("builtin/news.j2.xml", 10, {})])
+        display.id = DatabaseController.get().upsert_display(display, 1)
+
+    res = client.get(f"/display/1/{display.id}/")
+    assert res.status == "200 OK"
+    etag = res.headers["ETag"]
+
+    res = client.get(f"/display/1/{display.id}/", headers={"If-None-Match": etag})
+    assert res.status == "304 NOT MODIFIED"
+    assert not res.data
+
+    with app.app_context():
+        display.name = "Renamed Display"
+        display.pages = [("builtin/department.j2.xml", 10, {})]
+        DatabaseController.get().upsert_display(display, 1)
+
+    res = client.get(f"/display/1/{display.id}/", headers={"If-None-Match": etag})
+    assert res.status == "200 OK", "changing the display should invalidate its layout"
+    assert res.headers["ETag"] != etag
+    etag = res.headers["ETag"]
+
+    # As if another process changed the display
+    with app.app_context():
+        db = DatabaseController.get().db
+        db.execute(
+            "UPDATE displays SET pages_json = ? WHERE id = ?",
+            (json.dumps([["builtin/news.j2.xml", 10, {}]]), display.id),
+        )
+        db.commit()
+    res = client.get(f"/display/1/{display.id}/", headers={"If-None-Match": etag})
+    assert res.status == "200 OK", "changes from other processes should be seen"
+
+
+def test_display_token(app, client, unauthorized_client):
+    with app.app_context():
+        display = Display("Token Display", [("builtin/news.j2.xml", 10, {})])
+        display.id = DatabaseController.get().upsert_display(display, 1)
+        token = make_display_token(1, display.id)
+
+    assert token in unauthorized_client.get(f"/display/1/{display.id}/").text
+
+    assert unauthorized_client.get(f"/api/content?stream=1&token={token}").is_json
+    assert unauthorized_client.get(
+        "/api/content?stream=1", headers={"Authorization": f"Bearer {token}"}
+    ).is_json
+    assert unauthorized_client.get(f"/api/departments/1/people?token={token}").is_json
+
+    # Tokens are only valid for their own department, can't be tampered with and
+    # only allow reading
+    assert_redirects_login(
+        unauthorized_client.get(f"/api/departments/2/people?token={token}")
+    )
+    assert_redirects_login(
+        unauthorized_client.get(f"/api/content?stream=1&token=x{token}")
+    )
+    assert_redirects_login(
+        unauthorized_client.post(f"/api/content?token={token}", data={})
+    )
+    for display_id in [10**30, -1, "x"]:
+        forged = URLSafeSerializer("forged").dumps([1, display_id])
+        assert_redirects_login(
+            unauthorized_client.get(f"/api/content?stream=1&token={forged}")
+        )
+
+    # Displays may only read their own stream out of the private streams of
+    # displays, while logged in users may read them all
+    with app.app_context():
+        db = DatabaseController.get()
+        other = Display("Other Display", [("builtin/news.j2.xml", 10, {})])
+        other.id = db.upsert_display(other, 1)
+        own_stream = db.fetch_content_stream_for_display(display.id).id
+        other_stream = db.fetch_content_stream_for_display(other.id).id
+        other_department = db.create_department(Department("Other", ""))
+        person_id = db.upsert_person(
+            Person("Dr", "Other", "", b"", *[""] * 5), other_department
+        )
+    assert unauthorized_client.get(
+        f"/api/content?stream=1&stream={own_stream}&token={token}"
+    ).is_json
+    res = unauthorized_client.get(
+        f"/api/content/events?stream={own_stream}&token={token}", buffered=False
+    )
+    assert res.content_type == "text/event-stream"
+    res.close()
+    for url in [
+        f"/api/content?stream=1&stream={other_stream}&token={token}",
+        f"/api/content?stream={other_stream}&since=0&token={token}",
+        f"/api/content/events?stream={other_stream}&token={token}",
+        f"/api/content?stream=x&token={token}",
+    ]:
+        assert_redirects_login(unauthorized_client.get(url))
+    assert client.get(f"/api/content?stream={other_stream}").is_json
+    assert client.get("/api/content?stream=x").status == "400 BAD REQUEST"
+    assert (
+        unauthorized_client.get(
+            f"/api/departments/1/people/{person_id}/image?token={token}"
+        ).status_code
+        == 404
+    ), "people must be in the department the image is fetched through"
+
+    # Displays load the files in their layouts with their token
+    client.post(
+        "/api/department/1/files",
+        data={"department_file_data": (io.BytesIO(b"file"), "shown.txt")},
+    )
+    assert (
+        unauthorized_client.get(
+            f"/api/departments/1/files/shown.txt?token={token}"
+        ).data
+        == b"file"
+    )
+    assert_redirects_login(
+        unauthorized_client.delete(f"/api/departments/1/files/shown.txt?token={token}")
+    )
+    with app.app_context():
+        file_url = "/api/departments/1/files/shown.txt"
+        display.pages = [("builtin/image.j2.xml", 10, {"image": file_url})]
+        DatabaseController.get().upsert_display(display, 1)
+    page = unauthorized_client.get(f"/display/1/{display.id}/").text
+    assert f"{file_url}?token={token}" in page
+
+    # Tokens can't be forged with the app's secret key alone, and can be revoked
+    with app.app_context():
+        forged = URLSafeSerializer(app.secret_key, salt=DISPLAY_TOKEN_SALT).dumps(
+            [1, display.id]
+        )
+    assert_redirects_login(
+        unauthorized_client.get(f"/api/content?stream=1&token={forged}")
+    )
+    res = client.delete(f"/api/departments/1/displays/{display.id}/token")
+    assert res.json == {"revoked": True}
+    assert_redirects_login(
+        unauthorized_client.get(f"/api/content?stream=1&token={token}")
+    )
+    page = unauthorized_client.get(f"/display/1/{display.id}/").text
+    assert token not in page, "the display should be given a new token"
+    assert (
+        unauthorized_client.get(
+            f"/display/{other_department}/{display.id}/"
+        ).status_code
+        == 404
+    )
+
+
+def test_loadshedding_is_conditional(app, client):
+    res = client.get("/api/loadshedding_schedule?region=2")
+    assert res.status == "404 NOT FOUND", "the region hasn't been fetched yet"
+
+    with app.app_context():
+        DatabaseController.get().update_loadshedding_schedule(
+            2, "{}", b'{"name":"Area","events":[]}'
+        )
+
+    res = client.get("/api/loadshedding_schedule?region=2")
+    assert res.json == {"name": "Area", "stage": 0, "next": None, "events": []}
+    etag = res.headers["ETag"]
+    assert (
+        client.get(
+            "/api/loadshedding_schedule?region=2", headers={"If-None-Match": etag}
+        ).status
+        == "304 NOT MODIFIED"
+    )
+
+    now = time.time()
+    event = {
+        "start": datetime.fromtimestamp(now - 60, timezone.utc).isoformat(),
+        "end": datetime.fromtimestamp(now + 60 * 60, timezone.utc).isoformat(),
+        "stage": 2,
+    }
+    with app.app_context():
+        DatabaseController.get().update_loadshedding_schedule(
+            2, "{}", json.dumps({"name": "Area", "events": [event]}).encode("utf-8")
+        )
+
+    res = client.get(
+        "/api/loadshedding_schedule?region=2", headers={"If-None-Match": etag}
+    )
+    assert res.json["stage"] == 2, "a changed summary should not match the old ETag"
+
+
+def test_rss_feeds(app, client, unauthorized_client):
+    feed = "https://example.com/feed.xml"
+    res = client.get(f"/api/rss?url={feed}")
+    assert res.json == {"items": []}, "the feed hasn't been fetched yet"
+    etag = res.headers["ETag"]
+    assert (
+        client.get(f"/api/rss?url={feed}", headers={"If-None-Match": etag}).status
+        == "304 NOT MODIFIED"
+    )
+
+    with app.app_context():
+        db = DatabaseController.get()
+        item = {"title": "Item", "published": 1}
+        db.update_rss_feed(feed, 1, None, None, json.dumps([item]).encode("utf-8"))
+
+    res = client.get(f"/api/rss?url={feed}", headers={"If-None-Match": etag})
+    assert res.json == {"items": [item]}, "fetched items should change the ETag"
+
+    with app.app_context():
+        display = Display("RSS Display", [("builtin/news.j2.xml", 10, {})])
+        display.pages[0][2]["rss_feeds"] = ["https://example.com/shown.xml"]
+        display.id = DatabaseController.get().upsert_display(display, 1)
+        token = make_display_token(1, display.id)
+
+    assert unauthorized_client.get(
+        f"/api/rss?url=https://example.com/shown.xml&token={token}"
+    ).is_json
+    assert_redirects_login(
+        unauthorized_client.get(
+            f"/api/rss?url=https://example.com/other.xml&token={token}"
+        )
+    )
+    with app.app_context():
+        assert list(
+            DatabaseController.get().fetch_rss_feeds(
+                ["https://example.com/shown.xml", "https://example.com/other.xml"]
+            )
+        ) == ["https://example.com/shown.xml"], "displays may only read feeds they show"
+
+    assert client.get("/api/rss?url=file:///etc/passwd").status == "400 BAD REQUEST"
+
+
+def test_people_are_conditional(app, client):
+    url = "/api/departments/1/people"
+    res = client.get(url)
+    etag = res.headers["ETag"]
+    assert client.get(url, headers={"If-None-Match": etag}).status == "304 NOT MODIFIED"
+
+    person_id = client.post(
+        url,
+        data={
+            "title": "Dr",
+            "name": "Test",
+            "position": "",
+            "office_hours": "",
+            "office_location": "",
+            "email": "",
+            "phone": "",
+            "image_data": open(data_folder / "test.png", "rb"),
+        },
+    ).json["id"]
+    res = client.get(url, headers={"If-None-Match": etag})
+    assert res.status == "200 OK", "adding a person should change the ETag"
+    (person,) = [person for person in res.json["people"] if person["id"] == person_id]
+    assert len(person["image_hash"]) == 64
+    etag = res.headers["ETag"]
+
+    # As if another process changed the person
+    with app.app_context():
+        db = DatabaseController.get().db
+        db.execute("UPDATE people SET position = 'Lecturer' WHERE id = ?", (person_id,))
+        db.commit()
+    res = client.get(url, headers={"If-None-Match": etag})
+    assert res.status == "200 OK", "changes from other processes should be seen"
+    assert [person["position"] for person in res.json["people"]] == ["Lecturer"]
+
+    assert client.get("/api/departments/10000/people").status == "404 NOT FOUND"
+
+
+def test_display_bootstrap(app, client):
+    with app.app_context():
+        db = DatabaseController.get()
+        display = Display(
+            "Bootstrap Display",
+            [
+                ("builtin/news.j2.xml", 10, {"streams": ["1"], "fetch_amount": "3"}),
+                ("builtin/department.j2.xml", 10, {}),
+                ("builtin/loadshedding.j2.xml", 10, {"region": "1"}),
+            ],
+        )
+        display.id = db.upsert_display(display, 1)
+        display = db.fetch_display_by_id(display.id)
+        db.update_loadshedding_schedule(1, "{}", b'{"name":"Area","events":[]}')
+        rendered = display.render_cached(db, 1, "token")
+
+    streams = tuple(sorted({1, display.content_stream}))
+    assert rendered.bindings.content == [(streams, "3")]
+    assert rendered.bindings.people
+    assert rendered.bindings.regions == ["1"]
+
+    client.post(
+        "/api/content", data={"type": "link", "url": "url", "content_stream": "1"}
+    )
+    with app.test_request_context():
+        bootstrap = display_bootstrap(1, rendered)
+
+    # The bootstrap should be exactly what the widgets would otherwise fetch
+    res = client.get(f"/api/content?last=3&stream={streams[0]}&stream={streams[1]}")
+    content = bootstrap["content"][f"{streams[0]},{streams[1]}:3"]
+    assert content["page"] == res.json
+    assert content["etag"] == res.headers["ETag"]
+    assert content["cursor"] == int(res.headers["X-Content-Cursor"])
+
+    res = client.get("/api/departments/1/people")
+    assert bootstrap["people"] == {
+        "people": res.json["people"],
+        "etag": res.headers["ETag"],
+    }
+
+    res = client.get("/api/loadshedding_schedule?region=1")
+    assert bootstrap["loadshedding"] == {
+        "1": {"schedule": res.json, "etag": res.headers["ETag"]}
+    }
+
+    res = client.get(f"/display/1/{display.id}/")
+    assert '"bootstrap"' in res.text
+    etag = res.headers["ETag"]
+    res = client.get(f"/display/1/{display.id}/", headers={"If-None-Match": etag})
+    assert res.status == "304 NOT MODIFIED"
+
+    client.post(
+        "/api/content", data={"type": "link", "url": "url2", "content_stream": "1"}
+    )
+    res = client.get(f"/display/1/{display.id}/", headers={"If-None-Match": etag})
+    assert res.status == "200 OK", "the page should change with its bootstrap data"
+    etag = res.headers["ETag"]
+
+    with app.app_context():
+        db = DatabaseController.get()
+        db.update_loadshedding_schedule(1, "{}", b'{"name":"Other","events":[]}')
+    res = client.get(f"/display/1/{display.id}/", headers={"If-None-Match": etag})
+    assert res.status == "200 OK"
+
+
+def test_content_events(client):
+    res = client.post(
+        "/api/content", data={"type": "link", "url": "testurl", "content_stream": "1"}
+    )
+    content_id = res.json["id"]
+    client.delete(f"/api/content/{content_id}")
+
+    res = client.get("/api/content/events?stream=1&cursor=0", buffered=False)
+    assert res.content_type == "text/event-stream"
+    events = res.response
+    assert next(events).startswith(b"retry:")
+
+    posted = next(events).decode("utf-8")
+    assert "event: posted\n" in posted
+    assert f'"id": {content_id}' in posted
+
+    deleted = next(events).decode("utf-8")
+    assert "event: deleted\n" in deleted
+    assert f'"id": {content_id}' in deleted
+    res.close()
+
+
+def test_content_events_are_limited(client, monkeypatch):
+    monkeypatch.setattr(api, "_event_stream_slots", threading.BoundedSemaphore(1))
+
+    res = client.get("/api/content/events?stream=1", buffered=False)
+    assert res.content_type == "text/event-stream"
+    refused = client.get("/api/content/events?stream=1", buffered=False)
+    assert refused.status == "503 SERVICE UNAVAILABLE"
+    assert refused.headers["Retry-After"]
+
+    res.close()
+    res = client.get("/api/content/events?stream=1", buffered=False)
+    assert res.content_type == "text/event-stream", "closed streams should be freed"
+    res.close()
+
+
+def test_metrics(client, unauthorized_client, monkeypatch):
+    client.get("/api/departments/1/people")
+    res = client.get("/api/content/events?stream=1", buffered=False)
+    next(res.response)
+
+    res_metrics = client.get("/api/metrics")
+    assert res_metrics.status_code == 200
+    assert res_metrics.content_type.startswith("text/plain; version=0.0.4")
+    lines = res_metrics.get_data(as_text=True).splitlines()
+    assert "# TYPE campusign_http_request_duration_seconds histogram" in lines
+    assert any(
+        line.startswith("campusign_http_requests_total{")
+        and 'endpoint="api.people_route"' in line
+        and 'status="200"' in line
+        for line in lines
+    )
+    assert any(
+        line.startswith("campusign_http_request_duration_seconds_bucket{")
+        and 'le="+Inf"' in line
+        for line in lines
+    )
+    assert any(
+        line.startswith("campusign_db_queries_total{")
+        and 'endpoint="api.people_route"' in line
+        for line in lines
+    )
+    assert any(
+        line.startswith('campusign_cache_requests_total{cache="department_people"')
+        for line in lines
+    )
+    assert 'campusign_event_streams_open{display=""} 1' in lines
+
+    res.close()
+    lines = client.get("/api/metrics").get_data(as_text=True).splitlines()
+    assert (
+        'campusign_event_streams_open{display=""} 0' in lines
+    ), "closed streams should no longer count"
+
+    assert unauthorized_client.get("/api/metrics").status_code != 200
+    monkeypatch.setenv("CAMPUSIGN_METRICS_TOKEN", "secret")
+    headers = {"Authorization": "Bearer wrong"}
+    assert unauthorized_client.get("/api/metrics", headers=headers).status_code != 200
+    headers = {"Authorization": "Bearer secret"}
+    assert unauthorized_client.get("/api/metrics", headers=headers).status_code == 200
+
+
+def test_content_is_conditional(app, client):
+    res = client.get("/api/content?stream=1&last=5")
+    etag = res.headers["ETag"]
+
+    res = client.get("/api/content?stream=1&last=5", headers={"If-None-Match": etag})
+    assert res.status == "304 NOT MODIFIED"
+
+    res = client.get("/api/content?stream=2&last=5", headers={"If-None-Match": etag})
+    assert res.status == "200 OK", "different streams should have different ETags"
+
+    res = client.post(
+        "/api/content", data={"type": "link", "url": "testurl", "content_stream": "1"}
+    )
+    content_id = res.json["id"]
+    res = client.get("/api/content?stream=1&last=5", headers={"If-None-Match": etag})
+    assert res.status == "200 OK", "posting should change the ETag"
+    assert len(res.json["content"]) == 1
+    etag = res.headers["ETag"]
+
+    client.delete(f"/api/content/{content_id}")
+    res = client.get("/api/content?stream=1&last=5", headers={"If-None-Match": etag})
+    assert res.status == "200 OK", "deleting should change the ETag"
+    assert len(res.json["content"]) == 0
+
+    client.post(
+        "/api/content",
+        data={
+            "type": "link",
+            "url": "testurl",
+            "content_stream": "1",
+            "expires_at": int(time.time()) + 60 * 60,
+        },
+    )
+    res = client.get("/api/content?stream=1&last=5")
+    assert len(res.json["content"]) == 1
+    etag = res.headers["ETag"]
+    with app.app_context():
+        db = DatabaseController.get().db
+        db.execute("UPDATE content SET expires_at = ?", (int(time.time()) - 1,))
+        db.commit()
+    res = client.get("/api/content?stream=1&last=5", headers={"If-None-Match": etag})
+    assert res.status == "200 OK", "content expiring should change the ETag"
+    assert len(res.json["content"]) == 0
+
+    # The stream was empty when this ETag was made
+    etag = client.get("/api/content?stream=2&last=5").headers["ETag"]
+    for stream in ["2", "1"]:
+        client.post(
+            "/api/content",
+            data={"type": "link", "url": "testurl", "content_stream": stream},
+        )
+    with app.app_context():
+        DatabaseController.get().trim_change_log(time.time() + 1)
+    res = client.get("/api/content?stream=2&last=5", headers={"If-None-Match": etag})
+    assert res.status == "200 OK", "trimming the change log should not reuse versions"
+    assert len(res.json["content"]) == 1
+
+
+def test_content_delta(app, client):
+    res = client.get("/api/content?stream=1")
+    cursor = start = int(res.headers["X-Content-Cursor"])
+
+    res = client.get(f"/api/content?stream=1&since={cursor}")
+    assert res.json == {
+        "added": [],
+        "deleted": [],
+        "cursor": cursor,
+        "more": False,
+        "reset": False,
+    }
+
+    ids = []
+    for url in ["url1", "url2"]:
+        res = client.post(
+            "/api/content", data={"type": "link", "url": url, "content_stream": "1"}
+        )
+        ids.append(res.json["id"])
+
+    res = client.get(f"/api/content?stream=1&since={cursor}")
+    assert sorted(post["id"] for post in res.json["added"]) == ids
+    assert res.json["deleted"] == []
+    cursor = res.json["cursor"]
+
+    client.delete(f"/api/content/{ids[0]}")
+    res = client.get(f"/api/content?stream=1&since={cursor}")
+    assert res.json["added"] == []
+    assert res.json["deleted"] == [ids[0]]
+    assert res.json["cursor"] > cursor
+    latest = res.json["cursor"]
+
+    res = client.get(f"/api/content?stream=2&since={cursor}")
+    assert res.json["deleted"] == [], "other streams should not see the deletion"
+
+    # Once the changes since a cursor have been truncated, clients have to start
+    # again
+    with app.app_context():
+        DatabaseController.get().trim_change_log(time.time() + 1)
+    res = client.get(f"/api/content?stream=1&since={start}")
+    assert res.json["reset"]
+    assert not client.get(f"/api/content?stream=1&since={latest}").json["reset"]
+    res = client.get(f"/api/content?stream=1&since={res.json['cursor']}")
+    assert res.json["reset"], "the cursor should not move on without the events"
+
+
+def test_content_blob_ranges(client, test_png_data):
+    res = client.post(
+        "/api/content",
+        data={
+            "type": "local_image",
+            "image_data": open(data_folder / "test.png", "rb"),
+            "content_stream": "1",
+        },
+    )
+    blob_url = f"/api/content/{res.json['id']}/blob"
+
+    res = client.get(blob_url)
+    assert res.data == test_png_data
+    assert res.headers["Accept-Ranges"] == "bytes"
+    assert int(res.headers["Content-Length"]) == len(test_png_data)
+    assert "immutable" in res.headers["Cache-Control"]
+    assert (
+        client.get(blob_url, headers={"If-None-Match": res.headers["ETag"]}).status
+        == "304 NOT MODIFIED"
+    )
+
+    res = client.get(blob_url, headers={"Range": "bytes=10-19"})
+    assert res.status == "206 PARTIAL CONTENT"
+    assert res.data == test_png_data[10:20]
+    assert res.headers["Content-Range"] == f"bytes 10-19/{len(test_png_data)}"
+
+    res = client.get(blob_url, headers={"Range": f"bytes={len(test_png_data)}-"})
+    assert res.status == "416 REQUESTED RANGE NOT SATISFIABLE"
+
+    assert client.get("/api/content/100000/blob").status == "404 NOT FOUND"
+
+
+def test_person_image_is_revalidated(client, test_png_data):
+    def upsert_person(image_path: str, person_id=None):
+        form = {
+            "title": "Dr",
+            "name": "Test",
+            "position": "",
+            "office_hours": "",
+            "office_location": "",
+            "email": "",
+            "phone": "",
+            "image_data": open(data_folder / image_path, "rb"),
+        }
+        if person_id:
+            form["id"] = person_id
+        return client.post("/api/departments/1/people", data=form).json["id"]
+
+    person_id = upsert_person("test.png")
+    image_url = f"/api/departments/1/people/{person_id}/image"
+
+    res = client.get(image_url)
+    assert res.data == test_png_data
+    assert "no-cache" in res.headers["Cache-Control"]
+    etag = res.headers["ETag"]
+    assert (
+        client.get(image_url, headers={"If-None-Match": etag}).status
+        == "304 NOT MODIFIED"
+    )
+
+    upsert_person("test.jpg", person_id)
+    res = client.get(image_url, headers={"If-None-Match": etag})
+    assert res.status == "200 OK", "a changed image should not match the old ETag"
+    assert res.headers["ETag"] != etag
+
+
+def test_content_blob_variants(client, test_jpg_data):
+    res = client.post(
+        "/api/content",
+        data={
+            "type": "local_image",
+            "image_data": open(data_folder / "test.jpg", "rb"),
+            "content_stream": "1",
+        },
+    )
+    blob_url = f"/api/content/{res.json['id']}/blob"
+
+    res = client.get(blob_url)
+    assert "Accept" in res.headers["Vary"]
+    image = PIL.Image.open(io.BytesIO(res.data))
+    assert image.size == (3024, 4032), "EXIF orientation should be applied"
+    assert not image.getexif(), "metadata should be stripped from the original"
+
+    res = client.get(f"{blob_url}?w=1000", headers={"Accept": "image/webp,*/*"})
+    assert res.mimetype == "image/webp"
+    image = PIL.Image.open(io.BytesIO(res.data))
+    assert image.size == (1280, 1707), "EXIF orientation should be applied"
+    assert not image.getexif(), "metadata should be stripped"
+
+    res = client.get(f"{blob_url}?w=100", headers={"Accept": "*/*"})
+    assert res.mimetype == "image/jpeg"
+    assert PIL.Image.open(io.BytesIO(res.data)).width == 320
+
+
+def test_upload_table(client, test_png_data):
+    images = io.BytesIO()
+    with zipfile.ZipFile(images, "w") as zip_file:
+        zip_file.writestr("good.png", test_png_data)
+        zip_file.writestr("bad.png", test_png_data[:100])
+    images.seek(0)
+
+    workbook = openpyxl.Workbook()
+    workbook.active.append(
+        [
+            "title",
+            "full_name",
+            "position",
+            "office_hours",
+            "office_location",
+            "email",
+            "phone",
+            "image_name",
+        ]
+    )
+    workbook.active.append(["Dr", "Good", "", "", "", "", 211234567, "good.png"])
+    workbook.active.append(["Dr", "Bad", "", "", "", "", None, "bad.png"])
+    workbook.active.append(["Dr", "Missing", "", "", "", "", None, "missing.png"])
+    table = io.BytesIO()
+    workbook.save(table)
+    table.seek(0)
+
+    res = client.post(
+        "/api/departments/1/uploadtable",
+        data={
+            "add_table": (table, "people.xlsx"),
+            "images_folder": (images, "images.zip"),
+        },
+    )
+    assert res.json["imported"] == 3
+    assert res.json["errors"] == [
+        {"row": 3, "error": "Invalid image"},
+        {"row": 4, "error": "Image not in the ZIP file"},
+    ]
+
+    people = {
+        person["name"]: person
+        for person in client.get("/api/departments/1/people").json["people"]
+    }
+    assert people["Good"]["phone"] == "211234567"
+    assert people["Good"]["image"] == "true"
+    assert people["Bad"]["image"] == "false"
+
+    # People can be updated by ID from a CSV file, keeping their image
+    good_id = people["Good"]["id"]
+    table = io.BytesIO(
+        "id,title,full_name,position,office_hours,office_location,email,phone\n"
+        f"{good_id},Prof,Good,,,,,\n".encode("utf-8")
+    )
+    res = client.post(
+        "/api/departments/1/uploadtable", data={"add_table": (table, "people.csv")}
+    )
+    assert res.json["errors"] == []
+    res = client.get(f"/api/departments/1/people/{good_id}/image")
+    assert res.data == test_png_data
+
+    # IDs of people in other departments are skipped rather than moved
+    table = io.BytesIO(
+        "id,title,full_name,position,office_hours,office_location,email,phone\n"
+        f"{good_id},Prof,Stolen,,,,,\n".encode("utf-8")
+    )
+    res = client.post(
+        "/api/departments/2/uploadtable", data={"add_table": (table, "people.csv")}
+    )
+    assert res.json["imported"] == 0
+    assert res.json["skipped"] == [good_id]
+    people = client.get("/api/departments/1/people").json["people"]
+    assert {person["id"]: person["name"] for person in people}[good_id] == "Good"
+
+    res = client.post(
+        "/api/departments/1/uploadtable",
+        data={"add_table": (io.BytesIO(b"name\nA\n"), "people.csv")},
+    )
+    assert res.status == "400 BAD REQUEST"
+
+
+def test_content_batch(client, test_png_data):
+    res = client.post(
+        "/api/content/batch",
+        json={
+            "posts": [
+                {"type": "text", "title": "A", "body": "a", "content_stream": [1, 2]},
+                {"type": "link", "url": "https://example.com", "content_stream": 1},
+            ]
+        },
+    )
+    [text, link] = res.json["posts"]
+    assert text["id"] != link["id"]
+    content = client.get("/api/content?stream=2").json["content"]
+    assert [post["id"] for post in content] == [text["id"]]
+
+    res = client.post(
+        "/api/content/batch",
+        data={
+            "0.type": "local_image",
+            "0.image_data": open(data_folder / "test.png", "rb"),
+            "0.content_stream": "1",
+            "1.type": "text",
+            "1.title": "B",
+            "1.body": "b",
+            "1.content_stream": "1",
+        },
+    )
+    [image, _] = res.json["posts"]
+    assert client.get(f"/api/content/{image['id']}/blob").data == test_png_data
+
+    before = client.get("/api/content?stream=1").json["content"]
+    res = client.post(
+        "/api/content/batch",
+        json={"posts": [{"type": "text", "title": "C", "body": "c"}, {"type": "?"}]},
+    )
+    assert res.status == "400 BAD REQUEST"
+    assert (
+        client.get("/api/content?stream=1").json["content"] == before
+    ), "no posts should be made if any is invalid"
+
+
+def test_content_pages(client):
+    posted = client.post(
+        "/api/content/batch",
+        json={
+            "posts": [
+                {"type": "text", "title": str(i), "body": "", "content_stream": 1}
+                for i in range(5)
+            ]
+        },
+    ).json["posts"]
+    ids = [post["id"] for post in reversed(posted)]
+
+    page = client.get("/api/content?stream=1&last=2").json
+    assert [post["id"] for post in page["content"]] == ids[:2]
+    page = client.get(f"/api/content?stream=1&last=2&before={page['before']}").json
+    assert [post["id"] for post in page["content"]] == ids[2:4]
+    page = client.get(f"/api/content?stream=1&last=2&before={page['before']}").json
+    assert [post["id"] for post in page["content"]] == ids[4:]
+    assert "before" not in page, "there should be no older posts"
+
+    page = client.get(f"/api/content?stream=1&last=2&after={page['after']}").json
+    assert [post["id"] for post in page["content"]] == ids[2:4]
+
+    assert client.get("/api/content?stream=1&before=1").status == "400 BAD REQUEST"
+    assert len(client.get("/api/content?stream=1&last=100000").json["content"]) == 5
+    assert (
+        len(client.get("/api/content?stream=1&last=-1").json["content"]) == 1
+    ), "negative amounts should not lift the limit"
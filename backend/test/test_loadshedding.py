@@ -0,0 +1,152 @@
+import json
+import threading
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from server.database import DatabaseController
+from server.loadshedding import (
+    LoadsheddingFetcher,
+    current_summary,
+    summarize_schedule,
+)
+
+
+class StubESPHandler(BaseHTTPRequestHandler):
+    """Answers like the ESP API, with the responses set on the server"""
+
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_GET(self):  # noqa: N802 (the name is set by BaseHTTPRequestHandler)
+        url = urlparse(self.path)
+        if url.path == "/business/2.0/api_allowance":
+            status, body = 200, json.dumps({"allowance": self.server.allowance})
+        else:
+            area_id = parse_qs(url.query)["id"][0]
+            status, body = self.server.areas[area_id]
+
+        data = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture()
+def esp_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubESPHandler)
+    server.connections = 0
+    server.allowance = {"count": 0, "limit": 50, "type": "daily"}
+    server.areas = {}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_fetcher(app, esp_server):
+    schedule = json.dumps({"events": [], "info": {"name": "A"}})
+    esp_server.areas = {"a": (200, schedule), "b": (500, "{}")}
+    fetcher = LoadsheddingFetcher(
+        app,
+        regions=["a", "b"],
+        host="127.0.0.1",
+        port=esp_server.server_port,
+        https=False,
+        key="key",
+    )
+
+    with app.app_context():
+        db = DatabaseController.get()
+        assert fetcher.fetch_due(db) == {1: True, 2: False}
+        assert db.fetch_loadshedding_schedule(1) == (schedule,)
+        assert json.loads(db.fetch_loadshedding_summary(1)[0])["name"] == "A"
+        assert db.fetch_loadshedding_schedule(2) is None
+        assert fetcher.failures == {1: 0, 2: 1}
+        assert fetcher.fetch_due(db) == {}, "no region should be due again yet"
+        summary, _ = db.fetch_loadshedding_summary(1)
+        assert not db.update_loadshedding_schedule(
+            1, schedule, summary
+        ), "unchanged schedules should not be written"
+
+        esp_server.areas["b"] = (200, schedule)
+        fetcher.next_fetch = {1: 0, 2: 0}
+        assert fetcher.fetch_due(db) == {1: True, 2: True}
+        assert fetcher.failures == {1: 0, 2: 0}
+        assert esp_server.connections <= 3, "connections should be kept alive"
+
+        esp_server.allowance["count"] = 49
+        fetcher.next_fetch = {1: 0, 2: 0}
+        assert fetcher.fetch_due(db) == {}, "the allowance should not be exceeded"
+
+
+def test_summarize_schedule():
+    def event(start: str, end: str, stage: int):
+        return {
+            "start": f"2023-10-02T{start}:00+02:00",
+            "end": f"2023-10-02T{end}:00+02:00",
+            "note": f"Stage {stage}",
+        }
+
+    schedule = {
+        "events": [event("20:00", "22:30", 4), event("04:00", "06:30", 2)]
+        + [event("12:00", "14:30", 3)],
+        "info": {"name": "Area", "region": "City"},
+        "schedule": {"days": [{"date": "2023-10-02", "stages": [[]] * 8}]},
+    }
+    now = datetime.fromisoformat("2023-10-02T13:00:00+02:00")
+
+    summary = summarize_schedule(json.dumps(schedule), now)
+    current, etag = current_summary(summary, now)
+    assert json.loads(current) == {
+        "name": "Area",
+        "stage": 3,
+        "next": {
+            "start": "2023-10-02T20:00:00+02:00",
+            "end": "2023-10-02T22:30:00+02:00",
+            "stage": 4,
+        },
+        "events": [
+            {
+                "start": "2023-10-02T12:00:00+02:00",
+                "end": "2023-10-02T14:30:00+02:00",
+                "stage": 3,
+            },
+            json.loads(current)["next"],
+        ],
+    }
+
+    # The summary is only made when the schedule is fetched, but should always be
+    # up to date when it is sent
+    later = datetime.fromisoformat("2023-10-02T21:00:00+02:00")
+    current, later_etag = current_summary(summary, later)
+    assert json.loads(current) == {
+        "name": "Area",
+        "stage": 4,
+        "next": None,
+        "events": [
+            {
+                "start": "2023-10-02T20:00:00+02:00",
+                "end": "2023-10-02T22:30:00+02:00",
+                "stage": 4,
+            }
+        ],
+    }
+    assert later_etag != etag
+
+
+def test_leases(database: DatabaseController):
+    assert database.acquire_lease("test", "a", 60)
+    assert not database.acquire_lease("test", "b", 60), "the lease is held by a"
+    assert database.acquire_lease("test", "a", 0), "holders can renew the lease"
+    assert database.acquire_lease("test", "b", 60), "expired leases can be taken"
@@ -0,0 +1,151 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from server.database import DatabaseController
+from server import rss
+from server.rss import RSSPoller, check_public_url, parse_feed
+
+RSS_FEED = b"""<?xml version="1.0"?>
+<!DOCTYPE rss [<!ENTITY secret SYSTEM "file:///etc/passwd">]>
+<rss version="2.0" xmlns:media="http://search.yahoo.com/mrss/">
+  <channel>
+    <title>News</title>
+    <link>https://example.com/</link>
+    <item>
+      <title>Older</title>
+      <link>https://example.com/older</link>
+      <description><![CDATA[<p>Body</p>]]></description>
+      <pubDate>Mon, 02 Oct 2023 10:00:00 +0200</pubDate>
+      <media:content url="https://example.com/older.jpg" medium="image" />
+    </item>
+    <item>
+      <title>Newer &secret;</title>
+      <link>https://example.com/newer</link>
+      <pubDate>Tue, 03 Oct 2023 10:00:00 +0200</pubDate>
+      <enclosure url="https://example.com/newer.png" type="image/png" />
+    </item>
+  </channel>
+</rss>
+"""
+
+ATOM_FEED = b"""<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+  <title>Blog</title>
+  <entry>
+    <title>Post</title>
+    <link href="https://example.com/post" />
+    <summary>Summary</summary>
+    <updated>2023-10-02T08:00:00Z</updated>
+  </entry>
+</feed>
+"""
+
+
+def test_parse_feed():
+    assert parse_feed(RSS_FEED) == [
+        {
+            "title": "Newer",
+            "link": "https://example.com/newer",
+            "body": None,
+            "image": "https://example.com/newer.png",
+            "published": 1696320000,
+        },
+        {
+            "title": "Older",
+            "link": "https://example.com/older",
+            "body": "<p>Body</p>",
+            "image": "https://example.com/older.jpg",
+            "published": 1696233600,
+        },
+    ], "external entities should not be expanded"
+
+    assert parse_feed(ATOM_FEED) == [
+        {
+            "title": "Post",
+            "link": "https://example.com/post",
+            "body": "Summary",
+            "image": None,
+            "published": 1696233600,
+        }
+    ]
+
+
+class StubFeedHandler(BaseHTTPRequestHandler):
+    """Serves the server's feed, answering conditional requests with its ETag"""
+
+    def do_GET(self):  # noqa: N802 (the name is set by BaseHTTPRequestHandler)
+        self.server.requests += 1
+        if self.headers.get("If-None-Match") == self.server.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/rss+xml")
+        self.send_header("Content-Length", str(len(self.server.feed)))
+        self.send_header("ETag", self.server.etag)
+        self.end_headers()
+        self.wfile.write(self.server.feed)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture()
+def feed_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubFeedHandler)
+    server.requests = 0
+    server.feed = RSS_FEED
+    server.etag = '"1"'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_poller(app, database: DatabaseController, feed_server, monkeypatch):
+    url = f"http://127.0.0.1:{feed_server.server_port}/feed.xml"
+    database.register_rss_feeds([url])
+    poller = RSSPoller(app, interval=0)
+
+    assert poller.poll_due(database) == 0, "feeds on private addresses are refused"
+    assert feed_server.requests == 0
+
+    monkeypatch.setattr(rss, "RSS_ALLOW_PRIVATE_ADDRESSES", True)
+    assert poller.poll_due(database) == 1
+    _, items_json, items_hash = database.fetch_rss_feeds([url])[url]
+    assert [item["title"] for item in json.loads(items_json)] == ["Newer", "Older"]
+
+    assert poller.poll_due(database) == 1
+    assert feed_server.requests == 2
+    assert (
+        database.fetch_rss_feeds([url])[url][2] == items_hash
+    ), "unchanged feeds should keep their items"
+
+    feed_server.feed = ATOM_FEED
+    feed_server.etag = '"2"'
+    assert poller.poll_due(database) == 1
+    _, items_json, _ = database.fetch_rss_feeds([url])[url]
+    assert [item["title"] for item in json.loads(items_json)] == ["Post"]
+
+    assert database.delete_stale_rss_feeds(time.time() + 1) == 1
+    assert poller.poll_due(database) == 0, "stale feeds should not be polled"
+
+
+def test_check_public_url():
+    check_public_url("http://8.8.8.8/feed.xml")
+    for url in [
+        "file:///etc/passwd",
+        "http://127.0.0.1/feed.xml",
+        "http://localhost:8000/feed.xml",
+        "http://10.0.0.1/feed.xml",
+        "http://169.254.169.254/latest/meta-data/",
+        "http://[::1]/feed.xml",
+        "http://[::ffff:192.168.0.1]/feed.xml",
+    ]:
+        with pytest.raises(ValueError):
+            check_public_url(url)
@@ -268,7 +268,8 @@ export function showContent () {
         return dirty
       },
       period: 250,
-      builder: () => new ContentStream({ streams, editable: true })
+      builder: () =>
+        new ContentStream({ streams, editable: true, fetchAmount: 20 })
     }),
     targetElement: document.getElementById('root'),
     departmentId: 0,
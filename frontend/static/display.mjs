@@ -1,7 +1,7 @@
 import { Root } from './widgets/root.mjs'
 import { deserializeWidgetFromXML } from './widgets/deserializable/widget_deserialization_factory.mjs'
 
-export function main ({ department, displayContentStream, layout }) {
+export function main ({ department, displayContentStream, layout, token, bootstrap }) {
   window.addEventListener('error', function (error) {
     const div = document.getElementById('errors')
     div.hidden = false
@@ -14,6 +14,8 @@ export function main ({ department, displayContentStream, layout }) {
     child: deserializeWidgetFromXML(layout),
     targetElement: document.getElementById('root'),
     departmentId: department,
-    displayContentStream
+    displayContentStream,
+    displayToken: token,
+    bootstrap
   })
 }
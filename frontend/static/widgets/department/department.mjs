@@ -1,7 +1,7 @@
 import { Person } from './person.mjs'
 import { WithRefresh } from '../dynamic/with_refresh.mjs'
 import { DeserializableWidget } from '../deserializable/deserializable_widget.mjs'
-import { Root } from '../root.mjs'
+import { Root, withDisplayToken } from '../root.mjs'
 import { Container } from '../containers/container.mjs'
 import { PaginatedContainer } from '../containers/paginated_container.mjs'
 
@@ -16,6 +16,7 @@ export class Department extends DeserializableWidget {
     this.children = []
     this.pageSize = parseInt(pageSize)
     this.page = -1
+    this.etag = null
     this.rotationPeriod = (rotateEveryNSec || 10) * 1000
   }
 
@@ -27,25 +28,34 @@ export class Department extends DeserializableWidget {
    */
   async refresh () {
     const endpoint = `/api/departments/${Root.getInstance().getDepartment()}/people`
-    const update = await fetch(endpoint).then(res => res.json())
-
-    let dirty = update.people.length !== this.children.length
-    if (!dirty) {
-      for (let i = 0; i < update.people.length; i++) {
-        dirty = dirty || update.people[i].id !== this.children[i].id
-
-        if (dirty) {
-          break
-        }
-      }
+    const res = await fetch(
+      withDisplayToken(endpoint),
+      this.etag ? { headers: { 'If-None-Match': this.etag } } : undefined
+    )
+    if (res.status === 304) {
+      return false
     }
-    if (dirty) {
-      this.children = update.people.map(Person.fromJSON)
+
+    // The browser also revalidates the people with their ETag, so unchanged people keep the same one
+    const etag = res.headers.get('ETag')
+    if (etag && etag === this.etag) {
+      return false
     }
-    return dirty
+
+    const update = await res.json()
+    this.etag = etag
+    this.children = update.people.map(Person.fromJSON)
+    return true
   }
 
   build () {
+    // Start from the people sent along with the layout, if there are any, rather than waiting for them to be fetched
+    const bootstrap = Root.getInstance().takeBootstrap('people')
+    if (bootstrap) {
+      this.etag = bootstrap.etag
+      this.children = bootstrap.people.map(Person.fromJSON)
+    }
+
     return new WithRefresh({
       refresh: () => this.refresh(),
       period: REFRESH_INTERVAL_MS,
@@ -1,7 +1,7 @@
 import { Container } from '../containers/container.mjs'
 import { Visibility } from '../visibility.mjs'
 import { Widget } from '../widget.mjs'
-import { Root } from '../root.mjs'
+import { Root, withDisplayToken } from '../root.mjs'
 
 /**
  * A {@link Widget} which displays a people and all of their details.
@@ -20,6 +20,7 @@ export class Person extends Widget {
    * @param {string} email the person's email address
    * @param {string} phone the person's phone number
    * @param {boolean} hasimage the person's phone number
+   * @param {?string} imageHash the hash of the person's image, which changes whenever the image does
    */
   constructor ({
     id,
@@ -31,7 +32,8 @@ export class Person extends Widget {
     officeLocation,
     email,
     phone,
-    hasimage
+    hasimage,
+    imageHash
   }) {
     super()
     this.id = id
@@ -44,6 +46,7 @@ export class Person extends Widget {
     this.email = email
     this.phone = phone
     this.hasimage = hasimage
+    this.imageHash = imageHash
   }
 
   /**
@@ -63,7 +66,8 @@ export class Person extends Widget {
       email: obj.email,
       phone: obj.phone,
       department: Root.getInstance().getDepartment(),
-      hasimage: obj.image
+      hasimage: obj.image,
+      imageHash: obj.image_hash
     })
   }
 
@@ -87,14 +91,19 @@ export class Person extends Widget {
     })
   }
 
-  static makeImage (department, id, value) {
+  static makeImage (department, id, value, imageHash) {
     if (value === 'false') {
       value = false
     } else {
       value = true
     }
+    // Versioning the URL by the image's hash means a changed image is fetched afresh, while an unchanged one is
+    // served from the browser's cache
+    const version = imageHash ? `?v=${imageHash}` : ''
     const imageElement = document.createElement('img')
-    imageElement.src = `/api/departments/${department}/people/${id}/image`
+    imageElement.src = withDisplayToken(
+      `/api/departments/${department}/people/${id}/image${version}`
+    )
     imageElement.className = 'person_image'
     return new Visibility({
       visible: Boolean(value),
@@ -106,7 +115,7 @@ export class Person extends Widget {
     return new Container({
       children: [
         Person.makeHeader(`${this.title} ${this.name}`),
-        Person.makeImage(this.department, this.id, this.hasimage),
+        Person.makeImage(this.department, this.id, this.hasimage, this.imageHash),
         Person.makeText(
           `Position: ${this.position}`,
           'person_position',
@@ -0,0 +1,114 @@
+import { withDisplayToken } from '../root.mjs'
+
+// How long to wait for other widgets to subscribe before connecting, so that building a layout only opens one stream
+const CONNECT_DELAY_MS = 100
+// How long to poll for before trying again when the server refuses the stream, such as when it has too many open
+const RECONNECT_DELAY_MS = 1000 * 60
+
+/**
+ * The server's content event stream, shared by every widget on the page. Each open stream ties up a worker on the
+ * server, so a display only ever opens one, for all the content streams its widgets show.
+ */
+class ContentEvents {
+  constructor () {
+    this.subscribers = []
+    this.source = null
+    this.streams = ''
+    this.cursor = null
+    this.connected = false
+    this.pendingConnect = null
+  }
+
+  /**
+   * Listen for changes to the given subscriber's streams.
+   *
+   * @param {{streams: number[], ready: function(), changed: function(), lost: function()}} subscriber called when
+   *   the stream connects, when content in one of its streams changes, and when the stream is lost
+   */
+  subscribe (subscriber) {
+    this.subscribers.push(subscriber)
+
+    const streams = new Set(this.streams.split(',').map(id => parseInt(id)))
+    if (this.connected && subscriber.streams.every(stream => streams.has(stream))) {
+      subscriber.ready()
+    } else if (this.pendingConnect === null) {
+      this.pendingConnect = setTimeout(() => this.connect(), CONNECT_DELAY_MS)
+    }
+  }
+
+  /**
+   * (Re)open the event stream for all the streams subscribed to. Reconnecting resumes from the last event seen, so
+   * no events are missed in between.
+   *
+   * @private
+   */
+  connect () {
+    this.pendingConnect = null
+
+    const streams = [
+      ...new Set(this.subscribers.flatMap(subscriber => subscriber.streams))
+    ].sort((a, b) => a - b)
+    if (
+      typeof window.EventSource === 'undefined' ||
+      streams.length === 0 ||
+      (this.source && streams.join(',') === this.streams)
+    ) {
+      return
+    }
+
+    if (this.source) {
+      this.source.close()
+    }
+
+    this.streams = streams.join(',')
+    const params = streams.map(stream => `stream=${stream}`)
+    if (this.cursor !== null) {
+      params.push(`cursor=${this.cursor}`)
+    }
+    this.source = new window.EventSource(
+      withDisplayToken(`/api/content/events?${params.join('&')}`)
+    )
+
+    this.source.addEventListener('ready', event => {
+      this.cursor = event.lastEventId
+      this.connected = true
+      this.subscribers.forEach(subscriber => subscriber.ready())
+    })
+
+    const changed = event => {
+      this.cursor = event.lastEventId
+      const { stream } = JSON.parse(event.data)
+      this.subscribers
+        .filter(subscriber => subscriber.streams.includes(stream))
+        .forEach(subscriber => subscriber.changed())
+    }
+    this.source.addEventListener('posted', changed)
+    this.source.addEventListener('deleted', changed)
+
+    const source = this.source
+    source.addEventListener('error', () => {
+      this.connected = false
+      this.subscribers.forEach(subscriber => subscriber.lost())
+
+      // The browser reconnects by itself after dropped connections, but gives up when the server refuses the stream
+      if (source.readyState === window.EventSource.CLOSED && this.source === source) {
+        setTimeout(() => {
+          if (this.source === source) {
+            this.source = null
+            this.connect()
+          }
+        }, RECONNECT_DELAY_MS)
+      }
+    })
+  }
+}
+
+const contentEvents = new ContentEvents()
+
+/**
+ * Listen for content being posted to or deleted from the given subscriber's streams, through the event stream shared
+ * by the whole page. See {@link ContentEvents#subscribe}.
+ */
+export function subscribeToContentEvents (subscriber) {
+  contentEvents.subscribe(subscriber)
+}
@@ -4,11 +4,13 @@ import { Container } from '../containers/container.mjs'
 import { deserializeFreeFormContent } from './free_form_content_factory.mjs'
 import { PaginatedContainer } from '../containers/paginated_container.mjs'
 import { RSSItem } from './rss_item.mjs'
-import { Root } from '../root.mjs'
+import { Root, withDisplayToken } from '../root.mjs'
+import { subscribeToContentEvents } from './content_events.mjs'
 import { ApiError } from '../../config.mjs'
 
 const REFRESH_INTERVAL_MS = 5000
-const RSS_REFRESH_INTERVAL_MS = 1000 * 60 * 60 // 1 hour
+const RSS_REFRESH_INTERVAL_MS = 1000 * 60 * 5 // The server polls the feeds themselves
+const OLDER_PAGE_SIZE = 20 // How many older posts an editable stream loads at once
 
 /**
  * A container which displays a live view of all the {@link FreeFormContent} on the server.
@@ -41,6 +43,41 @@ export class ContentStream extends DeserializableWidget {
     this.refreshedTimes = 0
     this.editable = editable || false
     this.skipIntrinsicStream = skipIntrinsicStream || false
+    this.events = null
+    this.eventsConnected = false
+    this.stale = true
+    this.etag = null
+    this.cursor = null
+    this.content = []
+    this.olderCursor = null
+    this.rssItems = []
+    this.rssEtag = null
+  }
+
+  /**
+   * Subscribe to the server's content event stream so that the content only needs to be fetched when it has
+   * actually changed. While the event stream is unavailable, {@link refresh} falls back to polling.
+   *
+   * @private
+   */
+  subscribe () {
+    const markStale = () => {
+      this.stale = true
+    }
+
+    this.events = {
+      streams: this.streams,
+      ready: () => {
+        this.eventsConnected = true
+      },
+      changed: markStale,
+      lost: () => {
+        // Anything could have changed while disconnected, so poll until the stream reconnects
+        this.eventsConnected = false
+        markStale()
+      }
+    }
+    subscribeToContentEvents(this.events)
   }
 
   /**
@@ -50,18 +87,29 @@ export class ContentStream extends DeserializableWidget {
    * @returns {Promise<boolean>}
    */
   async refresh () {
-    const params = this.streams.map(stream => `stream=${stream}`)
-    const amt = this.fetchAmount ? `last=${this.fetchAmount}&` : ''
-    const update = await fetch(`/api/content?${amt}${params.join('&')}`).then(
-      res => res.json()
-    )
-
     const rssRefresh =
       this.refreshedTimes %
         Math.floor(RSS_REFRESH_INTERVAL_MS / REFRESH_INTERVAL_MS) ===
       0
 
-    let dirty = rssRefresh
+    if (this.eventsConnected && !this.stale && !rssRefresh) {
+      // Nothing has changed on the server since the last fetch
+      this.refreshedTimes += 1
+      return false
+    }
+
+    this.stale = false
+
+    const changed = await this.fetchContent()
+    const rssChanged = rssRefresh && (await this.fetchRSS())
+    if (!changed && !rssChanged) {
+      // The free form content hasn't changed since the last fetch
+      this.refreshedTimes += 1
+      return false
+    }
+
+    const update = { content: this.content }
+    let dirty = rssChanged
 
     if (!dirty) {
       // eslint-disable-next-line space-in-parens
@@ -88,38 +136,158 @@ export class ContentStream extends DeserializableWidget {
     }
 
     if (dirty) {
-      const childrenAndPosted = update.content.map(
-        content => [deserializeFreeFormContent(content), content.posted * 1000] // posted is in secs
-      )
-
-      if (rssRefresh) {
-        for (const rss of this.rssFeeds) {
-          const res = await fetch(rss)
-          const text = await res.text()
-          const dom = new window.DOMParser().parseFromString(text, 'text/xml')
-
-          const items = Array.from(dom.querySelectorAll('item'))
-
-          for (const item of items) {
-            const published = new Date(
-              item.querySelector('pubDate').textContent
-            ).getTime()
-            childrenAndPosted.push([RSSItem.parseFromXML(item), published])
-          }
-        }
+      this.buildChildren()
+    }
+
+    this.refreshedTimes += 1
+    return dirty
+  }
+
+  /**
+   * Rebuild {@link children} from {@link content} and {@link rssItems}, newest first.
+   *
+   * @private
+   */
+  buildChildren () {
+    const childrenAndPosted = this.content.map(
+      content => [deserializeFreeFormContent(content), content.posted * 1000] // posted is in secs
+    )
+
+    for (const item of this.rssItems) {
+      childrenAndPosted.push([
+        RSSItem.fromJSON(item),
+        (item.published || 0) * 1000 // published is in secs
+      ])
+    }
+
+    childrenAndPosted.sort(([_a, aPosted], [_b, bPosted]) => bPosted - aPosted)
+
+    this.children = childrenAndPosted
+      .slice(0, this.editable ? undefined : this.fetchAmount)
+      .map(([child, _posted]) => child)
+  }
+
+  /**
+   * Start from the content sent along with the layout, if there is any, rather than waiting for it to be fetched.
+   * The first refresh then only fetches what has changed since.
+   *
+   * @private
+   */
+  useBootstrap () {
+    const streams = [...new Set(this.streams)].sort((a, b) => a - b)
+    const bootstrap = Root.getInstance().takeBootstrap(
+      'content',
+      `${streams.join(',')}:${this.fetchAmount}`
+    )
+    if (!bootstrap) {
+      return
+    }
+
+    this.content = bootstrap.page.content
+    this.olderCursor = bootstrap.page.before || null
+    this.etag = bootstrap.etag
+    this.cursor = bootstrap.cursor
+    this.buildChildren()
+  }
+
+  /**
+   * Fetch the items of {@link rssFeeds}, which the server polls and parses on behalf of every display.
+   *
+   * @private
+   * @returns {Promise<boolean>} whether the items changed
+   */
+  async fetchRSS () {
+    if (this.rssFeeds.length === 0) {
+      return false
+    }
+
+    const params = this.rssFeeds.map(url => `url=${encodeURIComponent(url)}`)
+    const res = await fetch(withDisplayToken(`/api/rss?${params.join('&')}`))
+    if (!res.ok) {
+      return false
+    }
+
+    // The browser revalidates the items with their ETag, so unchanged items keep the same one
+    const etag = res.headers.get('ETag')
+    if (etag && etag === this.rssEtag) {
+      return false
+    }
+
+    this.rssEtag = etag
+    this.rssItems = (await res.json()).items
+    return true
+  }
+
+  /**
+   * Bring {@link content} up to date with the server. Once the content has been fetched in full, only the changes
+   * since the last fetch are fetched.
+   *
+   * @private
+   * @returns {Promise<boolean>} whether the content changed
+   */
+  async fetchContent () {
+    const params = this.streams.map(stream => `stream=${stream}`)
+
+    if (this.cursor !== null) {
+      const delta = await fetch(
+        withDisplayToken(`/api/content?since=${this.cursor}&${params.join('&')}`)
+      ).then(res => res.json())
+
+      if (delta.reset) {
+        // The server no longer knows what changed since the cursor, so fetch it all again
+        this.cursor = null
+        return this.fetchContent()
+      }
+
+      this.cursor = delta.cursor
+      this.stale ||= delta.more
+
+      if (delta.added.length === 0 && delta.deleted.length === 0) {
+        return false
       }
 
-      childrenAndPosted.sort(
-        ([_a, aPosted], [_b, bPosted]) => bPosted - aPosted
-      )
+      const removed = new Set([
+        ...delta.deleted,
+        ...delta.added.map(content => content.id)
+      ])
+      const content = this.content
+        .filter(content => !removed.has(content.id))
+        .concat(delta.added)
+      content.sort((a, b) => b.posted - a.posted || b.id - a.id)
 
-      this.children = childrenAndPosted
-        .slice(0, this.fetchAmount)
-        .map(([child, _posted]) => child)
+      if (
+        this.fetchAmount &&
+        delta.deleted.length !== 0 &&
+        content.length < this.fetchAmount
+      ) {
+        // Older content may need to take the place of what was deleted, so fetch it all again
+        this.cursor = null
+        return this.fetchContent()
+      }
+
+      // Editable streams keep any older posts that were loaded too
+      this.content = this.editable ? content : content.slice(0, this.fetchAmount)
+      return true
     }
 
-    this.refreshedTimes += 1
-    return dirty
+    const amt = this.fetchAmount ? `last=${this.fetchAmount}&` : ''
+    const res = await fetch(
+      withDisplayToken(`/api/content?${amt}${params.join('&')}`),
+      this.etag ? { headers: { 'If-None-Match': this.etag } } : undefined
+    )
+
+    const cursor = parseInt(res.headers.get('X-Content-Cursor'))
+    this.cursor = isNaN(cursor) ? null : cursor
+
+    if (res.status === 304) {
+      return false
+    }
+
+    this.etag = res.headers.get('ETag')
+    const page = await res.json()
+    this.content = page.content
+    this.olderCursor = page.before || null
+    return true
   }
 
   static fromXML (tag) {
@@ -146,6 +314,14 @@ export class ContentStream extends DeserializableWidget {
       this.streams.push(Root.getInstance().getDisplayContentStream())
     }
 
+    if (this.cursor === null) {
+      this.useBootstrap()
+    }
+
+    if (!this.events) {
+      this.subscribe()
+    }
+
     return new WithRefresh({
       refresh: () => this.refresh(),
       period: REFRESH_INTERVAL_MS,
@@ -154,27 +330,19 @@ export class ContentStream extends DeserializableWidget {
         // post in the feed
         let editableChildren
         if (this.editable) {
-          editableChildren = this.children.map(child => {
-            const renderedChild = child.render()
-            const childDiv = document.createElement('div')
-            childDiv.appendChild(renderedChild)
-            childDiv.className = 'deletable-content'
-
-            const deleteButton = document.createElement('button')
-            deleteButton.className = 'delete-content icon-button'
-            deleteButton.addEventListener('click', event =>
-              deleteContent(child.id, event)
-            )
-
-            const icon = document.createElement('span')
-            icon.className = 'material-symbols-outlined button-icon'
-            icon.innerText = 'delete'
-            deleteButton.append(icon)
+          editableChildren = this.children.map(child =>
+            renderDeletable(child)
+          )
 
-            childDiv.appendChild(deleteButton)
-
-            return childDiv
-          })
+          if (this.olderCursor) {
+            const loadOlderButton = document.createElement('button')
+            loadOlderButton.className = 'load-older-content'
+            loadOlderButton.innerText = 'Load older posts'
+            loadOlderButton.addEventListener('click', () =>
+              this.loadOlder(loadOlderButton)
+            )
+            editableChildren.push(loadOlderButton)
+          }
         }
 
         if (this.pageSize) {
@@ -204,11 +372,67 @@ export class ContentStream extends DeserializableWidget {
     })
   }
 
+  /**
+   * Load the next page of posts older than those shown, and show them before the given button. They are kept in
+   * {@link content} from then on, so they are updated along with the rest of the content.
+   *
+   * @private
+   * @param {HTMLButtonElement} button the button which loads older posts
+   * @returns {Promise<void>}
+   */
+  async loadOlder (button) {
+    const params = this.streams.map(stream => `stream=${stream}`)
+    const page = await fetch(
+      `/api/content?before=${this.olderCursor}&last=${OLDER_PAGE_SIZE}&${params.join('&')}`
+    ).then(res => res.json())
+
+    const known = new Set(this.content.map(content => content.id))
+    const older = page.content.filter(content => !known.has(content.id))
+    this.content = this.content.concat(older)
+    this.olderCursor = page.before || null
+
+    for (const content of older) {
+      button.before(renderDeletable(deserializeFreeFormContent(content)))
+    }
+
+    if (!this.olderCursor) {
+      button.remove()
+    }
+  }
+
   className () {
     return 'content-stream'
   }
 }
 
+/**
+ * Render a post along with a button to delete it.
+ *
+ * @param {FreeFormContent} child the post
+ * @returns {HTMLDivElement}
+ */
+function renderDeletable (child) {
+  const renderedChild = child.render()
+  const childDiv = document.createElement('div')
+  childDiv.appendChild(renderedChild)
+  childDiv.className = 'deletable-content'
+
+  const deleteButton = document.createElement('button')
+  deleteButton.className = 'delete-content icon-button'
+  deleteButton.addEventListener('click', event =>
+    deleteContent(child.id, event)
+  )
+
+  const icon = document.createElement('span')
+  icon.className = 'material-symbols-outlined button-icon'
+  icon.innerText = 'delete'
+  deleteButton.append(icon)
+
+  childDiv.appendChild(deleteButton)
+
+  return childDiv
+}
+
 /**
  * Delete a post. This can't be a form since HTML doesn't allow
  * `DELETE` as the method of a form.
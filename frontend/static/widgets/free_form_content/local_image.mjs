@@ -2,6 +2,14 @@ import { FreeFormContent } from './free_form_content.mjs'
 import { Caption } from '../caption.mjs'
 import { ContentAndCaption } from '../containers/content_and_caption.mjs'
 
+/**
+ * The widths the server keeps resized copies of images at. Keep in sync with
+ * `VARIANT_WIDTHS` in `image_variants.py`.
+ *
+ * @type {int[]}
+ */
+const VARIANT_WIDTHS = [320, 1280, 1920]
+
 /**
  * A piece of {@link FreeFormContent} which displays an image stored on the CampuSign server.
  *
@@ -33,6 +41,12 @@ export class LocalImage extends FreeFormContent {
   build () {
     const img = document.createElement('img')
     img.src = `/api/content/${this.id}/blob`
+    // Let the browser pick the smallest copy which is sharp on this screen. Captioned
+    // images are shown at most 300px wide.
+    img.srcset = VARIANT_WIDTHS
+      .map(width => `/api/content/${this.id}/blob?w=${width} ${width}w`)
+      .join(', ')
+    img.sizes = this.caption ? '300px' : '100vw'
     return new ContentAndCaption({
       content: img,
       caption: this.caption
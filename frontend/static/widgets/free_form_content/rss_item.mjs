@@ -12,33 +12,11 @@ export class RSSItem extends Widget {
     this.body = body
   }
 
-  static parseFromXML (item) {
-    let imageSrc = null
-
-    const imageEltLink = item.querySelector('image link')
-    const imgElt = item.querySelector('img')
-    const mediaElt = Array.from(
-      item.getElementsByTagName('media:content')
-    ).find(elt => elt.getAttribute('medium') === 'image')
-
-    if (imageEltLink) {
-      imageSrc = imageEltLink.textContent
-    } else if (imgElt) {
-      imageSrc = imgElt.src
-    } else if (mediaElt) {
-      imageSrc = mediaElt.getAttribute('url')
-    }
-
-    const titleElt = item.querySelector('title')
-    const bodyElt = item.querySelector('description')
-    const linkElt = item.querySelector(':scope > link')
-
-    return new RSSItem({
-      imageSrc,
-      title: titleElt ? titleElt.textContent : null,
-      link: linkElt ? linkElt.textContent : null,
-      body: bodyElt ? bodyElt.textContent : null
-    })
+  /**
+   * Deserialize an item as returned by the /api/rss endpoint.
+   */
+  static fromJSON ({ image, link, title, body }) {
+    return new RSSItem({ imageSrc: image, link, title, body })
   }
 
   build () {
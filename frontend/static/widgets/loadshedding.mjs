@@ -2,31 +2,51 @@ import { WithRefresh } from './dynamic/with_refresh.mjs'
 import { importFromNpm } from '../util.mjs'
 import { DeserializableWidget } from './deserializable/deserializable_widget.mjs'
 import { Container } from './containers/container.mjs'
+import { Root } from './root.mjs'
 const { default: moment } = await importFromNpm('moment')
 
 /**
  * A widget which displays the current loadshedding schedule.
  */
 export class Loadshedding extends DeserializableWidget {
-  constructor () {
+  /**
+   * @param {string} [region] the number of the region whose schedule is shown
+   */
+  constructor ({ region } = {}) {
     super()
+    this.region = region || 1
     this.scheduleJsonData = null
+    this.etag = null
   }
 
   async fetch_loadshedding () {
     try {
-      const response = await fetch('/api/loadshedding_schedule')
+      // The summary is revalidated with its ETag, so this is usually a 304
+      const response = await fetch(
+        `/api/loadshedding_schedule?region=${this.region}`,
+        this.etag ? { headers: { 'If-None-Match': this.etag } } : undefined
+      )
+      if (response.status === 304) {
+        return
+      }
       if (!response.ok) {
         throw new Error('Failed to fetch load shedding schedule')
       }
-      const data = await response.json()
-      this.scheduleJsonData = JSON.parse(data[0])
+      this.etag = response.headers.get('ETag')
+      this.scheduleJsonData = await response.json()
     } catch (error) {
       console.error('Error fetching load shedding schedule:', error)
     }
   }
 
   build () {
+    // Start from the schedule sent along with the layout, if there is one, rather than waiting for it to be fetched
+    const bootstrap = Root.getInstance().takeBootstrap('loadshedding', `${this.region}`)
+    if (bootstrap) {
+      this.etag = bootstrap.etag
+      this.scheduleJsonData = bootstrap.schedule
+    }
+
     return new WithRefresh({
       refresh: () => this.fetch_loadshedding(),
       period: 1000 * 60 * 5,
@@ -67,7 +87,7 @@ export class Loadshedding extends DeserializableWidget {
       }
 
       // gets the stage number
-      const stage = todayEvents[0].note.match(/\d+/)[0]
+      const stage = todayEvents[0].stage
       todayEvents.sort((a, b) => a.start.localeCompare(b.start))
       const schedule = [`Stage ${stage}`, 'Loadshedding today:']
       // gets the times for the day
@@ -116,7 +136,7 @@ export class Loadshedding extends DeserializableWidget {
   }
 
   static fromXML (tag) {
-    return new Loadshedding()
+    return new Loadshedding({ region: tag.attribute('region') })
   }
 
   className () {
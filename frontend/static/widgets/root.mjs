@@ -7,6 +7,22 @@ let root
  */
 export const testExports = { destroyRoot }
 
+/**
+ * Add this display's token to the given API URL, so that the display can use the API without logging in. The URL is
+ * left as it is when there is no token, such as in the configuration UI.
+ * @param {string} url
+ * @returns {string}
+ */
+export function withDisplayToken (url) {
+  const token = root && root.displayToken
+  if (!token) {
+    return url
+  }
+
+  const separator = url.includes('?') ? '&' : '?'
+  return `${url}${separator}token=${encodeURIComponent(token)}`
+}
+
 /**
  * Destroy the root. Used only in testing for teardown.
  */
@@ -22,9 +38,11 @@ function destroyRoot () {
  * The global root element of the page. This can only be created once, through its {@link create} method.
  */
 export class Root {
-  constructor (departmentId, displayContentStream) {
+  constructor (departmentId, displayContentStream, displayToken, bootstrap) {
     this.departmentId = departmentId
     this.displayContentStream = displayContentStream
+    this.displayToken = displayToken
+    this.bootstrap = bootstrap || {}
     this.watchedElements = []
   }
 
@@ -35,12 +53,14 @@ export class Root {
    * @param {HTMLElement} targetElement
    * @param {number} departmentId the departments ID of this display
    * @param {number} displayContentStream the inherent content stream ID for this display
+   * @param {string} [displayToken] the token this display uses to read from the API without logging in
+   * @param {object} [bootstrap] the data the display's widgets start with, sent along with the layout
    */
-  static create ({ child, targetElement, departmentId, displayContentStream }) {
+  static create ({ child, targetElement, departmentId, displayContentStream, displayToken, bootstrap }) {
     if (root) {
       throw new RootAlreadyExistsError()
     } else {
-      root = new Root(departmentId, displayContentStream)
+      root = new Root(departmentId, displayContentStream, displayToken, bootstrap)
     }
 
     root.mutationObserver = new window.MutationObserver(
@@ -86,6 +106,26 @@ export class Root {
   getDisplayContentStream () {
     return this.displayContentStream
   }
+
+  /**
+   * Take the data a widget starts with from the bootstrap data sent along with the layout, if there is any. Each piece
+   * can only be taken once, since it is out of date as soon as the widget has refreshed.
+   *
+   * @param {string} kind `content`, `people` or `loadshedding`
+   * @param {string} [key] which content or loadshedding region
+   * @returns {?object}
+   */
+  takeBootstrap (kind, key) {
+    let data
+    if (key === undefined) {
+      data = this.bootstrap[kind]
+      delete this.bootstrap[kind]
+    } else {
+      data = (this.bootstrap[kind] || {})[key]
+      delete (this.bootstrap[kind] || {})[key]
+    }
+    return data || null
+  }
 }
 
 function isInDocument (element) {
@@ -135,7 +135,7 @@ async function checkUploadPerson (formData) {
   const fetched = people[0]
   assert.equal(fetched.id, id)
 
-  assert.deepStrictEqual(fetched, { id, ...formData })
+  assert.deepStrictEqual(fetched, { id, image_hash: null, ...formData })
   return id
 }
 